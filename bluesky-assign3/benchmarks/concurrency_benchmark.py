@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Check that adaptive concurrency limits converge to what the upstream can take
+
+Runs offline against the load generator's stand-in CDN, started in its own process so
+its request handling does not compete with the workers for the GIL. Worker threads
+download one small blob in a loop for a fixed time, once with a fixed number of requests in flight
+(one per thread) and once through HostLimiters, in two scenarios:
+
+    unlimited    the stand-in has latency but no capacity limit: the adaptive limit
+                 must not lose throughput to latency jitter
+    capacity     the stand-in answers 429 beyond --capacity requests in flight: the
+                 time-averaged limit over the second half of the run must settle near
+                 the capacity
+
+The run fails (exit status 1) when a check does not hold.
+
+Usage:
+    python benchmarks/concurrency_benchmark.py
+    python benchmarks/concurrency_benchmark.py --capacity 6 --latency_ms 30 --threads 32 --seconds 10
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+
+@contextmanager
+def stand_in(port: int, latency_ms: float, capacity=None):
+    """Run the stand-in in a subprocess and yield its CDN URL"""
+    import requests
+
+    command = [sys.executable, "-m", "pylabel.loadgen", "serve", "--port", str(port), "--posts", "1",
+               "--image_sides", "64", "64", "--cdn_latency_ms", str(latency_ms)]
+    if capacity is not None:
+        command += ["--cdn_capacity", str(capacity)]
+    process = subprocess.Popen(command, cwd=PROJECT_DIR, stdout=subprocess.DEVNULL)
+    cdn_url = f"http://127.0.0.1:{port + 1}"
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Stand-in server on port {port} exited with status {process.returncode}")
+            try:
+                requests.get(cdn_url, timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        yield cdn_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_load(cdn_url: str, threads: int, seconds: float, adaptive: bool) -> dict:
+    """Download one blob from every thread until the time is up"""
+    from pylabel.concurrency import HostLimiters, host_of
+    from pylabel.latency_budget import download
+
+    url = f"{cdn_url}/img/feed_thumbnail/plain/did:plc:loadgen000000/bafyloadp0@jpeg"
+    limiters = HostLimiters() if adaptive else None
+    counts = {'ok': 0, 'failed': 0}
+    samples = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def worker():
+        while time.monotonic() < stop_at:
+            ok = download(url, timeout=5) is not None
+            with lock:
+                counts['ok' if ok else 'failed'] += 1
+
+    def sampler():
+        limiter = limiters.for_host(host_of(url))
+        while time.monotonic() < stop_at:
+            samples.append(limiter.limit)
+            time.sleep(0.02)
+
+    if limiters is not None:
+        limiters.install()
+    try:
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        if limiters is not None:
+            pool.append(threading.Thread(target=sampler))
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    finally:
+        if limiters is not None:
+            limiters.uninstall()
+
+    result = {'requests_per_second': counts['ok'] / seconds, 'failed': counts['failed']}
+    if limiters is not None:
+        settled = samples[len(samples) // 2:]
+        result['mean_limit'] = sum(settled) / len(settled) if settled else 0
+        result['limiter'] = limiters.stats()[host_of(url)]
+    return result
+
+
+def main():
+    """Main function for the concurrency convergence check"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=8)
+    parser.add_argument("--latency_ms", type=float, default=30)
+    parser.add_argument("--capacity", type=int, default=8)
+    parser.add_argument("--port", type=int, default=18700,
+                        help="Port of the stand-in's XRPC server; its CDN listens on the next port")
+    parser.add_argument("--min_throughput_ratio", type=float, default=0.8,
+                        help="Adaptive vs. fixed throughput required without a capacity limit")
+    parser.add_argument("--limit_tolerance", type=float, default=0.5,
+                        help="Allowed relative distance of the settled limit from the capacity")
+    args = parser.parse_args()
+
+    failures = []
+    for scenario, capacity in (("unlimited", None), ("capacity", args.capacity)):
+        results = {}
+        for adaptive in (False, True):
+            with stand_in(args.port, args.latency_ms, capacity) as cdn_url:
+                results[adaptive] = run_load(cdn_url, args.threads, args.seconds, adaptive)
+        fixed, adaptive = results[False], results[True]
+        print(f"{scenario}: fixed {fixed['requests_per_second']:.1f} req/s ({fixed['failed']} failed), "
+              f"adaptive {adaptive['requests_per_second']:.1f} req/s ({adaptive['failed']} failed), "
+              f"settled limit {adaptive['mean_limit']:.1f}")
+        print(f"  limiter: {adaptive['limiter']}")
+
+        if capacity is None:
+            ratio = adaptive['requests_per_second'] / max(fixed['requests_per_second'], 1e-9)
+            if ratio < args.min_throughput_ratio:
+                failures.append(f"{scenario}: adaptive throughput is {ratio:.0%} of fixed")
+        elif abs(adaptive['mean_limit'] - capacity) > args.limit_tolerance * capacity:
+            failures.append(f"{scenario}: limit settled at {adaptive['mean_limit']:.1f}, capacity is {capacity}")
+
+    if failures:
+        print("\nCONCURRENCY CHECK FAILED:")
+        for message in failures:
+            print(f"  {message}")
+        sys.exit(1)
+    print("\nAdaptive limits converge")
+
+
+if __name__ == "__main__":
+    main()
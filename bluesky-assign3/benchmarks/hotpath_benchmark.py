@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the labeler hot paths
+
+Runs fully offline: texts, images and hash databases are synthetic (seeded, so every run
+measures the same work), and the labelers are built from a local labeler inputs
+directory with no client. Each benchmark is timed with timeit, keeping the fastest of
+several repeats, and reported as time per call.
+
+Covered:
+    keywords.*        check_keyword loop vs. one compiled pattern, for several list sizes
+    policy_text.*     _analyze_post_content and _explicit_intensity on short, long and
+                      hashtag-heavy texts without sexual terms (the early exit), and on
+                      texts with terms, with and without solicitation phrases
+    automated_text.*  the automated labeler's T&S and news keyword rules, on texts
+                      without and with matches
+    phash.*           PHash of decoded images, and decode + hash of JPEGs, by image size;
+                      per-image loop vs. hash_many batch over many decoded images
+    match.*           matching one hash against reference sets of several sizes
+    construct.*       labeler construction
+
+The committed baseline, benchmarks/hotpath_baseline.json, is what --baseline compares
+against by default. Timings depend on the machine, so regenerate it on the machine that
+runs the comparison (and commit it again whenever a change makes a hot path faster or
+knowingly slower):
+
+    python benchmarks/hotpath_benchmark.py --output benchmarks/hotpath_baseline.json
+
+Usage:
+    python benchmarks/hotpath_benchmark.py --baseline
+    python benchmarks/hotpath_benchmark.py --baseline hotpath.json --tolerance 0.25
+    python benchmarks/hotpath_benchmark.py -k phash -k match
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+DEFAULT_BASELINE = os.path.join(PROJECT_DIR, "benchmarks", "hotpath_baseline.json")
+
+SEED = 5342
+WORDS = ("the a post today news photo just love great new time people see look share "
+         "friend city game music food weather update thread reply follow week").split()
+
+
+def _text(rng: random.Random, words: int, hashtags: int = 0, extra=()) -> str:
+    tokens = [rng.choice(WORDS) for _ in range(words)]
+    tokens += [f"#{rng.choice(WORDS)}{rng.randint(0, 99)}" for _ in range(hashtags)]
+    tokens += extra
+    rng.shuffle(tokens)
+    return " ".join(tokens)
+
+
+def _image(rng, size: int):
+    """Smooth synthetic RGB image, so hashes are not dominated by noise"""
+    import cv2
+    import numpy as np
+
+    low = rng.integers(0, 256, size=(8, 8, 3)).astype(np.float32)
+    return np.ascontiguousarray(cv2.resize(low, (size, size), interpolation=cv2.INTER_CUBIC)
+                                .clip(0, 255).astype(np.uint8))
+
+
+def build_benchmarks(inputs_dir: str) -> List[Tuple[str, Callable[[], object]]]:
+    """
+    Build the benchmark cases
+
+    Args:
+        inputs_dir: Labeler inputs directory used by the labelers
+
+    Returns:
+        List of (name, zero-argument callable) pairs
+    """
+    import cv2
+    import numpy as np
+
+    from pylabel import AutomatedLabeler, PolicyProposalLabeler, check_keyword, compile_keywords, read_csv_column
+    from pylabel.image_fingerprint import ImageFingerprinter, ReferenceSet, make_hasher
+
+    rng = random.Random(SEED)
+    np_rng = np.random.default_rng(SEED)
+    cases = []
+
+    # Keyword matching: the per-keyword loop vs. the single compiled alternation
+    post = _text(rng, 40)
+    for size in (10, 100, 1000):
+        keywords = [f"kw{i}{rng.choice(WORDS)}" for i in range(size)]
+        pattern = compile_keywords(keywords)
+        cases.append((f"keywords.check_keyword_loop[{size}]",
+                      lambda keywords=keywords: any(check_keyword(k, post) for k in keywords)))
+        cases.append((f"keywords.compiled[{size}]", lambda pattern=pattern: pattern.search(post)))
+
+    # Text rules of the policy labeler
+    policy = PolicyProposalLabeler(None, inputs_dir)
+    terms = sorted(policy.primary_terms)
+    texts = {
+        "short": _text(rng, 12),
+        "long": _text(rng, 300),
+        "hashtags": _text(rng, 10, hashtags=25),
+        # Sexual terms get past the early exit into the solicitation, context and intensity rules
+        "terms": _text(rng, 30, extra=rng.sample(terms, 3)),
+        "solicitation": _text(rng, 30, extra=[*rng.sample(terms, 2), "send me your pics", "dm me"]),
+        "terms_long": _text(rng, 300, extra=rng.sample(terms, 6)),
+    }
+    for kind, text in texts.items():
+        cases.append((f"policy_text.analyze_post_content[{kind}]",
+                      lambda text=text: policy._analyze_post_content(text)))
+        cases.append((f"policy_text.explicit_intensity[{kind}]",
+                      lambda text=text: policy._explicit_intensity(text)))
+
+    # Text rules of the automated labeler
+    automated = AutomatedLabeler(None, inputs_dir)
+    ts_words = read_csv_column(os.path.join(inputs_dir, "t-and-s-words.csv"), "Word")
+    news_domains = read_csv_column(os.path.join(inputs_dir, "news-domains.csv"), "Domain")
+    texts = {
+        "short": _text(rng, 12),
+        "long": _text(rng, 300),
+        "matches": _text(rng, 30, extra=[rng.choice(ts_words), f"https://www.{rng.choice(news_domains)}/news/1"]),
+    }
+    for kind, text in texts.items():
+        cases.append((f"automated_text.moderate_text[{kind}]", lambda text=text: automated._moderate_text(text)))
+
+    # Perceptual hashing by image size
+    phash = make_hasher('phash')
+    fingerprinter = ImageFingerprinter(['phash'])
+    for size in (64, 256, 1024, 2048):
+        image = _image(np_rng, size)
+        jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+        cases.append((f"phash.compute[{size}px]", lambda image=image: phash.compute(image)))
+        cases.append((f"phash.decode_and_hash_jpeg[{size}px]",
+                      lambda jpeg=jpeg: fingerprinter.fingerprint(jpeg)))
+
+    # Per-image PHash vs. one vectorized batch over many decoded images
+    batch = [_image(np_rng, 128) for _ in range(256)]
+    cases.append(("phash.loop[256x128px]", lambda: [phash.compute(image) for image in batch]))
+    cases.append(("phash.hash_many[256x128px]", lambda: fingerprinter.hash_many(batch)))
+
+    # Hash matching against reference sets of different sizes
+    probe = np_rng.integers(0, 2, size=64).astype(bool)
+    for size in (25, 1000, 100_000):
+        reference = ReferenceSet(f"synthetic{size}", 'phash',
+                                 np_rng.integers(0, 2, size=(size, 64)).astype(bool), 0.3)
+        cases.append((f"match.reference_set[{size}]", lambda reference=reference: reference.matches_vector(probe)))
+
+    # Labeler construction (reads dictionaries, hashes the dog reference images)
+    cases.append(("construct.automated_labeler", lambda: AutomatedLabeler(None, inputs_dir)))
+    cases.append(("construct.policy_proposal_labeler", lambda: PolicyProposalLabeler(None, inputs_dir)))
+    return cases
+
+
+def measure(name: str, func: Callable[[], object], repeat: int, min_time: float) -> Dict:
+    """
+    Time a benchmark, keeping the fastest of several repeats
+
+    Args:
+        name: Benchmark name
+        func: Zero-argument callable to time
+        repeat: Number of timing repeats
+        min_time: Minimum duration of one repeat in seconds
+
+    Returns:
+        Dictionary with the time per call in microseconds and the calls per repeat
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {"name": name, "per_call_us": best * 1e6, "calls": number}
+
+
+def _machine() -> str:
+    return f"{platform.machine()} {platform.processor() or platform.system()}, {os.cpu_count()} CPUs"
+
+
+def compare(results: List[Dict], baseline_file: str, tolerance: float) -> List[str]:
+    """
+    Compare results with a stored baseline
+
+    Returns:
+        List of messages describing benchmarks that got slower than the tolerance allows
+    """
+    with open(baseline_file, "r") as f:
+        stored = json.load(f)
+    baseline = {entry["name"]: entry for entry in stored["benchmarks"]}
+    if stored.get("machine") not in (None, _machine()):
+        print(f"Note: the baseline was recorded on {stored['machine']}, not on {_machine()}")
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if not previous:
+            continue
+        limit = previous["per_call_us"] * (1 + tolerance)
+        if result["per_call_us"] > limit:
+            regressions.append(
+                f"{result['name']}: {result['per_call_us']:.1f} us "
+                f"(baseline {previous['per_call_us']:.1f} us, "
+                f"{result['per_call_us'] / previous['per_call_us'] - 1:+.0%})"
+            )
+    return regressions
+
+
+def main():
+    """Main function for the hot-path benchmark"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", type=str, default=os.path.join(PROJECT_DIR, "labeler-inputs"),
+                        help="Labeler inputs directory")
+    parser.add_argument("-k", dest="filters", action="append", default=[],
+                        help="Only run benchmarks whose name contains this string (repeatable)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repeats per benchmark")
+    parser.add_argument("--min_time", type=float, default=0.2, help="Minimum seconds per repeat")
+    parser.add_argument("--output", type=str, help="Write results as JSON to this file")
+    parser.add_argument("--baseline", type=str, nargs="?", const=DEFAULT_BASELINE,
+                        help="Fail if slower than this stored result file (default: the committed baseline)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown vs. baseline")
+    args = parser.parse_args()
+
+    cases = build_benchmarks(args.inputs)
+    if args.filters:
+        cases = [(name, func) for name, func in cases if any(f in name for f in args.filters)]
+
+    results = []
+    for name, func in cases:
+        result = measure(name, func, args.repeat, args.min_time)
+        results.append(result)
+        print(f"{name:<50} {result['per_call_us']:12.2f} us/call")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "machine": _machine(), "seed": SEED, "benchmarks": results},
+                      f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nHOT-PATH REGRESSIONS:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print("\nNo hot-path regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Startup benchmark for the pylabel package and its command-line entry points
+
+Each entry point is imported in a fresh interpreter under `python -X importtime`. The
+import-time report is parsed to get the total import time and the heaviest top-level
+imports, and the wall-clock time of the whole interpreter run is recorded as well.
+
+Usage:
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --output startup.json
+    python benchmarks/startup_benchmark.py --baseline startup.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by each entry point; the scripts guard main() so importing is safe
+ENTRY_POINTS = [
+    "pylabel",
+    "pylabel.label",
+    "pylabel.automated_labeler",
+    "pylabel.policy_proposal_labeler",
+    "test_labeler",
+    "test_policy_labeler",
+    "get_post_test",
+    "debug_post_analyzer",
+]
+
+
+def parse_importtime(stderr: str) -> Tuple[int, List[Tuple[str, int]]]:
+    """
+    Parse the report written by `python -X importtime`
+
+    Args:
+        stderr: Standard error of the interpreter run
+
+    Returns:
+        Tuple of (total cumulative microseconds, [(module, cumulative microseconds)] for the
+        top-level imports)
+    """
+    total = 0
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        # Nested imports are indented below the module that triggered them
+        if name.startswith("  "):
+            continue
+        cumulative_us = int(cumulative.strip())
+        total += cumulative_us
+        top_level.append((name.strip(), cumulative_us))
+    return total, top_level
+
+
+def measure(module: str, repeat: int, top: int) -> Dict:
+    """
+    Measure the import cost of one entry point, keeping the fastest of several runs
+
+    Args:
+        module: Module to import
+        repeat: Number of fresh interpreter runs
+        top: Number of heaviest top-level imports to report
+
+    Returns:
+        Dictionary with import time, wall-clock time and the heaviest imports
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=PROJECT_DIR, capture_output=True, text=True,
+        )
+        wall = time.perf_counter() - start
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "unknown error"
+            return {"module": module, "error": error}
+        total_us, top_level = parse_importtime(proc.stderr)
+        if best is None or total_us < best["import_time_ms"] * 1000:
+            best = {
+                "module": module,
+                "import_time_ms": total_us / 1000,
+                "wall_time_ms": wall * 1000,
+                "heaviest_imports": [
+                    {"module": name, "cumulative_ms": us / 1000}
+                    for name, us in sorted(top_level, key=lambda item: -item[1])[:top]
+                ],
+            }
+    return best
+
+
+def compare(results: List[Dict], baseline_file: str, tolerance: float) -> List[str]:
+    """
+    Compare results with a stored baseline
+
+    Returns:
+        List of messages describing entry points that got slower than the tolerance allows
+    """
+    with open(baseline_file, "r") as f:
+        baseline = {entry["module"]: entry for entry in json.load(f)["entry_points"]}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["module"])
+        if not previous or "error" in result or "error" in previous:
+            continue
+        limit = previous["import_time_ms"] * (1 + tolerance)
+        if result["import_time_ms"] > limit:
+            regressions.append(
+                f"{result['module']}: {result['import_time_ms']:.1f} ms "
+                f"(baseline {previous['import_time_ms']:.1f} ms)"
+            )
+    return regressions
+
+
+def main():
+    """Main function for the startup benchmark"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Interpreter runs per entry point")
+    parser.add_argument("--top", type=int, default=5, help="Heaviest imports to report per entry point")
+    parser.add_argument("--output", type=str, help="Write results as JSON to this file")
+    parser.add_argument("--baseline", type=str, help="Fail if slower than this stored result file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown vs. baseline")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS, help="Entry points to measure")
+    args = parser.parse_args()
+
+    results = [measure(module, args.repeat, args.top) for module in args.modules]
+
+    for result in results:
+        if "error" in result:
+            print(f"{result['module']:<36} failed: {result['error']}")
+            continue
+        print(f"{result['module']:<36} import {result['import_time_ms']:8.1f} ms"
+              f"   wall {result['wall_time_ms']:8.1f} ms")
+        for heavy in result["heaviest_imports"]:
+            print(f"    {heavy['module']:<32} {heavy['cumulative_ms']:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "entry_points": results}, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nSTARTUP REGRESSIONS:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print("\nNo startup regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -68,7 +68,7 @@ def analyze_post_details(url, client):
         
         # Extract image URLs
         labeler = PolicyProposalLabeler(client, "labeler-inputs")
-        image_urls = labeler._extract_image_urls(post.value)
+        image_urls = labeler._extract_image_urls(post)
         print(f"Image URLs found: {len(image_urls)}")
         for url in image_urls:
             print(f"  - {url}")
@@ -1,4 +1,126 @@
-"""Init file for module"""
-from .automated_labeler import *
-from .label import *
-from .policy_proposal_labeler import *
\ No newline at end of file
+"""Init file for module
+
+Submodules are loaded lazily on first attribute access (PEP 562) so that importing
+pylabel, or running a light entry point such as `python -m pylabel.label`, does not pull
+in the image and data libraries used by the labelers.
+"""
+import importlib
+
+# Public name -> submodule that defines it
+_LAZY_ATTRS = {
+    "AccountAggregator": "account_aggregator",
+    "AccountRule": "account_aggregator",
+    "account_labeler": "account_aggregator",
+    "parse_account_rule": "account_aggregator",
+    "AutomatedLabeler": "automated_labeler",
+    "T_AND_S_LABEL": "automated_labeler",
+    "DOG_LABEL": "automated_labeler",
+    "THRESH": "automated_labeler",
+    "check_keyword": "automated_labeler",
+    "compile_keywords": "automated_labeler",
+    "iter_chunks": "backfill",
+    "run_backfill": "backfill",
+    "score_record": "backfill",
+    "ImageCascade": "cascade",
+    "AdaptiveLimiter": "concurrency",
+    "HostLimiters": "concurrency",
+    "EvaluationJournal": "evaluation",
+    "as_label_list": "evaluation",
+    "compute_metrics": "evaluation",
+    "pending_cases": "evaluation",
+    "ImageFingerprinter": "image_fingerprint",
+    "ReferenceSet": "image_fingerprint",
+    "batch_phash": "image_fingerprint",
+    "load_reference_sets": "image_fingerprint",
+    "parse_hash": "image_fingerprint",
+    "iter_csv_records": "inputs",
+    "iter_json_records": "inputs",
+    "read_csv_column": "inputs",
+    "read_csv_rows": "inputs",
+    "did_from_handle": "label",
+    "post_from_url": "label",
+    "label_account": "label",
+    "label_post": "label",
+    "make_client": "label",
+    "sync_account_labels": "label",
+    "sync_post_labels": "label",
+    "LabelLedger": "label_ledger",
+    "BudgetExceeded": "latency_budget",
+    "Deadline": "latency_budget",
+    "LatencyBudget": "latency_budget",
+    "FaultProfile": "loadgen",
+    "LoadProfile": "loadgen",
+    "StandInServer": "loadgen",
+    "SyntheticCorpus": "loadgen",
+    "NegativeCache": "negative_cache",
+    "NegativeCacheHit": "negative_cache",
+    "PolicyProposalLabeler": "policy_proposal_labeler",
+    "SEXUAL_CONTENT_LABEL": "policy_proposal_labeler",
+    "PostContext": "post_context",
+    "PostVerdict": "post_context",
+    "set_cdn_url": "post_context",
+    "LabelerRunner": "runner",
+    "ClassPolicy": "scheduler",
+    "Priority": "scheduler",
+    "PriorityScheduler": "scheduler",
+    "RiskClassifier": "scheduler",
+    "Profiler": "profiling",
+    "maybe_profile": "profiling",
+    "stage": "profiling",
+    "NearDuplicateIndex": "text_fingerprint",
+    "estimate_similarity": "text_fingerprint",
+    "minhash": "text_fingerprint",
+    "FeatureCache": "threshold_sweep",
+    "sweep_automated": "threshold_sweep",
+    "sweep_policy": "threshold_sweep",
+    "VerdictStore": "verdict_store",
+    "ruleset_hash": "verdict_store",
+    "ShardedSupervisor": "workers",
+    "author_from_url": "workers",
+    "author_key": "workers",
+    "handle_resolver": "workers",
+    "session_client_factory": "workers",
+    "shard_for": "workers",
+}
+
+_SUBMODULES = {
+    "account_aggregator",
+    "automated_labeler",
+    "backfill",
+    "cascade",
+    "concurrency",
+    "evaluation",
+    "image_fingerprint",
+    "inputs",
+    "label",
+    "label_ledger",
+    "latency_budget",
+    "loadgen",
+    "negative_cache",
+    "policy_proposal_labeler",
+    "post_context",
+    "profiling",
+    "runner",
+    "scheduler",
+    "text_fingerprint",
+    "threshold_sweep",
+    "verdict_store",
+    "workers",
+}
+
+__all__ = sorted(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        module = importlib.import_module(f".{_LAZY_ATTRS[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS) | _SUBMODULES)
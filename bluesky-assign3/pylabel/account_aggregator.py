@@ -0,0 +1,293 @@
+"""Memory-bounded rolling aggregation of post verdicts per account
+
+The aggregator turns per-post verdicts into account-level actions. For every account it
+keeps time-bucketed counters of moderated posts and of posts that received each watched
+label, covering a rolling window (for example 28 buckets of 6 hours = one week). When an
+account crosses the threshold of a rule, the rule's account label is applied once.
+
+All counters live in preallocated NumPy arrays with one row per account slot, so memory
+is fixed by the capacity no matter how many accounts are seen. Accounts that have been
+idle longest are evicted (LRU) when the slots run out. Each verdict updates one row in
+O(labels x buckets) time; nothing is ever recomputed from history.
+
+A post is counted once: every account slot remembers 64-bit hashes of its most recent
+post URIs, so moderating the same post again (a rerun, a resumed journal, a verdict
+reused from the verdict store) does not inflate its author's counts. Verdicts are
+bucketed by the post's createdAt rather than by when the post was moderated.
+"""
+
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+import time
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+    from .label_ledger import LabelLedger
+
+
+class AccountRule(NamedTuple):
+    """Apply account_label once an account has min_posts posts with post_label in the
+    window and they make up at least min_ratio of its moderated posts"""
+    post_label: str
+    account_label: str
+    min_posts: int
+    min_ratio: float = 0.0
+
+
+def parse_account_rule(spec: str) -> AccountRule:
+    """
+    Parse a rule given as post_label:account_label:min_posts[:min_ratio]
+
+    Args:
+        spec: Rule specification, e.g. "sexual-content:sexual-content-account:5:0.5"
+
+    Returns:
+        The parsed AccountRule
+    """
+    parts = spec.split(':')
+    if len(parts) not in (3, 4):
+        raise ValueError(f"Invalid account rule {spec!r}; expected post_label:account_label:min_posts[:min_ratio]")
+    min_ratio = float(parts[3]) if len(parts) == 4 else 0.0
+    return AccountRule(parts[0], parts[1], int(parts[2]), min_ratio)
+
+
+def account_labeler(labeler_client: "Client", ledger: Optional["LabelLedger"] = None,
+                    dry_run: bool = False) -> Callable[[str, str], None]:
+    """
+    Build an on_threshold callback that applies the account label through Ozone
+
+    Args:
+        labeler_client: Client proxied to the labeler service
+        ledger: Optional label ledger, so accounts that already carry the label are skipped
+        dry_run: Only print the accounts that would be labeled
+
+    Returns:
+        Callable taking (did, account_label)
+    """
+    from .label import label_account, sync_account_labels
+
+    def apply(did: str, account_label: str):
+        if dry_run:
+            print(f"Account {did} crossed the threshold for {account_label}")
+        elif ledger is not None:
+            sync_account_labels(labeler_client, did, [account_label], ledger, managed={account_label})
+        else:
+            label_account(labeler_client, did, [account_label])
+
+    return apply
+
+
+def post_timestamp(post: Any) -> Optional[float]:
+    """
+    Return the createdAt time of a post as a Unix timestamp
+
+    Args:
+        post: Post as returned by post_from_url
+
+    Returns:
+        The timestamp, capped at now since createdAt is set by the client, or None if the
+        post has no parsable createdAt
+    """
+    created_at = getattr(getattr(post, 'value', None), 'created_at', None)
+    if not created_at:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(created_at.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+    return min(timestamp, time.time())
+
+
+def _post_hash(post_uri: str) -> int:
+    # 0 marks an empty slot in the recent-post arrays
+    return int.from_bytes(hashlib.blake2b(post_uri.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class AccountAggregator:
+    """
+    Rolling per-account verdict counters with fixed memory and LRU eviction
+
+    Usage:
+        aggregator = AccountAggregator([AccountRule("sexual-content", "sexual-content-account", 5, 0.5)],
+                                       on_threshold=account_labeler(labeler_client))
+        aggregator.record_post(post, labels)
+    """
+
+    def __init__(self, rules: Iterable[AccountRule], capacity: int = 100_000,
+                 bucket_seconds: int = 6 * 3600, num_buckets: int = 28,
+                 on_threshold: Optional[Callable[[str, str], None]] = None,
+                 recent_posts: int = 16):
+        """
+        Args:
+            rules: Account rules to evaluate
+            capacity: Maximum number of accounts tracked at once
+            bucket_seconds: Width of one time bucket
+            num_buckets: Number of buckets in the rolling window
+            on_threshold: Called with (did, account_label) when an account crosses a rule
+            recent_posts: Number of post URIs remembered per account to skip verdicts
+                of posts that were already counted
+        """
+        import numpy as np
+
+        self.rules = list(rules)
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.on_threshold = on_threshold
+
+        # Counter row 0 counts every moderated post; row i + 1 counts posts with the
+        # i-th watched label
+        self.watched_labels = sorted({rule.post_label for rule in self.rules})
+        self._label_rows = {label: row + 1 for row, label in enumerate(self.watched_labels)}
+
+        self._counts = np.zeros((capacity, len(self.watched_labels) + 1, num_buckets), dtype=np.uint16)
+        self._bucket_epochs = np.full((capacity, num_buckets), -1, dtype=np.int64)
+        self._triggered = np.zeros((capacity, len(self.rules)), dtype=bool)
+        self._count_max = np.iinfo(self._counts.dtype).max
+        self._recent = np.zeros((capacity, recent_posts), dtype=np.uint64)
+        self._recent_next = np.zeros(capacity, dtype=np.int64)
+
+        # DID -> slot, in least- to most-recently-used order
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._free = list(range(capacity - 1, -1, -1))
+        self.evictions = 0
+        self.triggers = 0
+        self.duplicates = 0
+
+    def memory_bytes(self) -> int:
+        """Return the size of the preallocated counter arrays"""
+        return (self._counts.nbytes + self._bucket_epochs.nbytes + self._triggered.nbytes
+                + self._recent.nbytes + self._recent_next.nbytes)
+
+    def _slot_for(self, did: str) -> int:
+        slot = self._slots.get(did)
+        if slot is not None:
+            self._slots.move_to_end(did)
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        else:
+            # Evict the account that has been idle longest and reuse its row
+            _, slot = self._slots.popitem(last=False)
+            self._counts[slot] = 0
+            self._bucket_epochs[slot] = -1
+            self._triggered[slot] = False
+            self._recent[slot] = 0
+            self._recent_next[slot] = 0
+            self.evictions += 1
+        self._slots[did] = slot
+        return slot
+
+    def record_post(self, post: Any, labels: Iterable[str]) -> List[str]:
+        """
+        Add the verdict of a fetched post, keyed by its URI and bucketed by its createdAt
+
+        Args:
+            post: Post as returned by post_from_url
+            labels: Labels the post received (empty for a clean post)
+
+        Returns:
+            Account labels triggered by this verdict
+        """
+        return self.record(post.uri.split('/')[2], labels, post_timestamp(post), post.uri)
+
+    def record(self, did: str, labels: Iterable[str], timestamp: Optional[float] = None,
+               post_uri: Optional[str] = None) -> List[str]:
+        """
+        Add a post verdict for an account and apply any account label it triggers
+
+        Args:
+            did: DID of the post author
+            labels: Labels the post received (empty for a clean post)
+            timestamp: Time of the post; defaults to now
+            post_uri: AT URI of the post; a post already counted among the account's
+                recent posts is skipped
+
+        Returns:
+            Account labels triggered by this verdict
+        """
+        epoch = int((time.time() if timestamp is None else timestamp) // self.bucket_seconds)
+        bucket = epoch % self.num_buckets
+        slot = self._slot_for(did)
+
+        if post_uri is not None:
+            post_hash = _post_hash(post_uri)
+            recent = self._recent[slot]
+            if (recent == post_hash).any():
+                self.duplicates += 1
+                return []
+
+        counts = self._counts[slot]
+        epochs = self._bucket_epochs[slot]
+        if epochs[bucket] != epoch:
+            if epochs[bucket] > epoch:
+                # Verdict older than the window this bucket now holds; nothing to count
+                return []
+            counts[:, bucket] = 0
+            epochs[bucket] = epoch
+
+        if post_uri is not None:
+            recent[self._recent_next[slot] % len(recent)] = post_hash
+            self._recent_next[slot] += 1
+
+        labels = set(labels)
+        rows = [0] + [self._label_rows[label] for label in labels if label in self._label_rows]
+        for row in rows:
+            if counts[row, bucket] < self._count_max:
+                counts[row, bucket] += 1
+
+        if len(rows) == 1:
+            return []
+        return self._evaluate(did, slot, epoch, labels)
+
+    def _evaluate(self, did: str, slot: int, epoch: int, labels: set) -> List[str]:
+        live = self._bucket_epochs[slot] > epoch - self.num_buckets
+        totals = self._counts[slot][:, live].sum(axis=1)
+        triggered = []
+        for index, rule in enumerate(self.rules):
+            if rule.post_label not in labels or self._triggered[slot, index]:
+                continue
+            flagged = int(totals[self._label_rows[rule.post_label]])
+            if flagged >= rule.min_posts and flagged >= rule.min_ratio * int(totals[0]):
+                self._triggered[slot, index] = True
+                self.triggers += 1
+                triggered.append(rule.account_label)
+                if self.on_threshold is not None:
+                    self.on_threshold(did, rule.account_label)
+        return triggered
+
+    def window_counts(self, did: str, now: Optional[float] = None) -> Dict[str, int]:
+        """
+        Return an account's counts over the current window without touching its LRU position
+
+        Args:
+            did: DID of the account
+            now: Reference time; defaults to now
+
+        Returns:
+            Dictionary with the number of moderated posts ('posts') and per watched label
+        """
+        slot = self._slots.get(did)
+        if slot is None:
+            return {}
+        epoch = int((time.time() if now is None else now) // self.bucket_seconds)
+        live = self._bucket_epochs[slot] > epoch - self.num_buckets
+        totals = self._counts[slot][:, live].sum(axis=1)
+        counts = {'posts': int(totals[0])}
+        for label, row in self._label_rows.items():
+            counts[label] = int(totals[row])
+        return counts
+
+    def stats(self) -> dict:
+        """Return occupancy, eviction and trigger counts"""
+        return {
+            'tracked_accounts': len(self._slots),
+            'capacity': self.capacity,
+            'evictions': self.evictions,
+            'triggers': self.triggers,
+            'duplicates': self.duplicates,
+            'memory_bytes': self.memory_bytes(),
+        }
@@ -1,16 +1,24 @@
 """Implementation of automated moderator"""
 
-from perception.hashers import PHash
-from .label import post_from_url
-from atproto import Client
-from typing import List
-from io import BytesIO
-from PIL import Image
-import pandas as pd
-import requests
+from .cascade import ImageCascade
+from .image_fingerprint import ImageFingerprinter, ReferenceSet, load_reference_sets, parse_hash
+from .inputs import read_csv_column, read_csv_rows
+from .latency_budget import BudgetExceeded, Deadline, LatencyBudget, download
+from .negative_cache import NegativeCache
+from .post_context import IMAGE_RESOLUTION_VERSION, PostContext, PostVerdict, resolve_image_urls
+from .profiling import stage
+from .verdict_store import VerdictStore, ruleset_hash
+from typing import TYPE_CHECKING, List, Optional, Tuple
 import os
 import re
 
+# perception and requests are heavy imports; they are loaded by the code paths
+# that hash or download images
+if TYPE_CHECKING:
+    from atproto import Client
+
+    from .account_aggregator import AccountAggregator
+
 
 T_AND_S_LABEL = "t-and-s"
 DOG_LABEL = "dog"  
@@ -26,6 +34,18 @@ def check_keyword(keyword, post):
     return found is not None
 
 
+def compile_keywords(keywords):
+    """
+    Compile a list of keywords into a single case-insensitive whole-word pattern.
+
+    Matches exactly when check_keyword would match for at least one of the keywords,
+    but the pattern is built once and can be shared read-only across worker processes.
+    """
+    if not keywords:
+        return re.compile(r'(?!)')
+    return re.compile(r'\b(?:' + '|'.join(keywords) + r')\b', re.IGNORECASE)
+
+
 class AutomatedLabeler:
     """
     Automated labeler implementation.
@@ -35,89 +55,172 @@ class AutomatedLabeler:
     Milestone 4: Detect and label posts containing dog images based on perceptual hash matching.
     """
 
-    def __init__(self, client: Client, input_dir):
+    name = "automated"
+
+    def __init__(self, client: "Client", input_dir, verdict_store: Optional[VerdictStore] = None,
+                 account_aggregator: Optional["AccountAggregator"] = None,
+                 latency_budget: Optional[LatencyBudget] = None,
+                 negative_cache: Optional[NegativeCache] = None,
+                 cascade: Optional[ImageCascade] = None):
         self.client = client
+        self.verdict_store = verdict_store
+        self.account_aggregator = account_aggregator
+        self.latency_budget = latency_budget
+        self.negative_cache = negative_cache
+        self.cascade = cascade
 
         # === Milestone 2: Load T&S Keywords ===
         # Load trusted-and-safety related words and domains from CSV files
         ts_domain_path = os.path.join(input_dir, 't-and-s-domains.csv')
         ts_word_path = os.path.join(input_dir, 't-and-s-words.csv')
 
-        domains = pd.read_csv(ts_domain_path)['Domain'].tolist()
-        words = pd.read_csv(ts_word_path)['Word'].tolist()
+        domains = read_csv_column(ts_domain_path, 'Domain')
+        words = read_csv_column(ts_word_path, 'Word')
 
         # Combine both into a single list for matching
         self.ts_keywords = domains + words 
+        self.ts_pattern = compile_keywords(self.ts_keywords)
 
 
         # === Milestone 3: Load News Domain Sources ===
         # Load list of [Domain, Source] pairs from news-domains.csv
         news_domain = os.path.join(input_dir, 'news-domains.csv')
-        self.news_source = pd.read_csv(news_domain).values.tolist()
+        self.news_source = read_csv_rows(news_domain, ['Domain', 'Source'])
+        self.news_patterns = [(compile_keywords([keyword]), source) for keyword, source in self.news_source]
 
 
         # === Milestone 4: Load dog perceptual hashes using perception ===
-        self.hasher = PHash()
-        self.dog_hashes = []
+        # Reference images are hashed with PHash, as one vectorized batch;
+        # dog-image-hashes.json may add external hash lists of any supported type. Each
+        # image is decoded once and hashed with every type the reference sets need.
+        reference_fingerprinter = ImageFingerprinter(['phash'])
+        self.hasher = reference_fingerprinter.hashers['phash']
+        dog_images = []
         dog_img_dir = os.path.join(input_dir, "dog-list-images")
         if os.path.exists(dog_img_dir):
             for filename in os.listdir(dog_img_dir):
                 if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
                     image_path = os.path.join(dog_img_dir, filename)
                     try:
-                        dog_hash = self.hasher.compute(image_path)
-                        self.dog_hashes.append(dog_hash)
+                        dog_images.append(reference_fingerprinter.decode(image_path))
                     except Exception as e:
                         print(f"Error hashing {filename}: {e}")
+        dog_vectors = [fingerprint['phash'] for fingerprint in reference_fingerprinter.hash_many(dog_images)]
+        self.dog_hashes = [self.hasher.vector_to_string(dog_vector) for dog_vector in dog_vectors]
+        self.dog_reference_sets = [ReferenceSet('dog-list-images', 'phash', dog_vectors, THRESH)]
+        dog_hash_file = os.path.join(input_dir, "dog-image-hashes.json")
+        if os.path.exists(dog_hash_file):
+            self.dog_reference_sets += load_reference_sets(dog_hash_file, 'phash', THRESH)
+        self.image_hash_types = {reference.hash_type for reference in self.dog_reference_sets}
+        self.fingerprinter = ImageFingerprinter(self.image_hash_types)
+
+        # Every label this labeler can apply
+        self.label_values = {T_AND_S_LABEL, DOG_LABEL} | {source for _, source in self.news_source}
+
+        # Version each moderation stage by the rules it uses, so stored verdicts are
+        # invalidated when (and only when) the relevant inputs change
+        image_rules = [THRESH, sorted(str(dog_hash) for dog_hash in self.dog_hashes),
+                       [reference.version() for reference in self.dog_reference_sets[1:]],
+                       IMAGE_RESOLUTION_VERSION]
+        if self.cascade is not None:
+            image_rules.append(self.cascade.version())
+        self.ruleset_versions = {
+            'text': ruleset_hash(self.ts_keywords, self.news_source),
+            'image': ruleset_hash(*image_rules),
+        }
 
     
     """
     Extract image URLs from a post.
     """
-    def _extract_image_urls(self, post) -> List[str]:
-        image_urls = []
-        
-        if hasattr(post, 'value') and hasattr(post.value, 'embed'):
-            embed = post.value.embed
-            if hasattr(embed, 'images'):
-                for image in embed.images:
-                    if hasattr(image, 'image') and hasattr(image.image, 'ref'):
-                        did = post.uri.split('/')[2]
-                        img_cid = image.image.ref.link
-                    
-                    # Try feed_fullsize first
-                    full_url = f"https://cdn.bsky.app/img/feed_fullsize/plain/{did}/{img_cid}@jpeg"
-                    try:
-                        response = requests.head(full_url, timeout=3)
-                        if response.status_code == 200:
-                            image_urls.append(full_url)
-                            continue
-                    except requests.RequestException:
-                        pass
-
-                    # Fallback to feed_thumbnail
-                    thumb_url = f"https://cdn.bsky.app/img/feed_thumbnail/plain/{did}/{img_cid}@jpeg"
-                    image_urls.append(thumb_url)
-
-        return image_urls
+    def _extract_image_urls(self, post, deadline: Optional[Deadline] = None) -> List[str]:
+        return resolve_image_urls(post, deadline)
 
     """
     Determine whether an image matches any dog reference image.
     """
     def _is_dog_image(self, image_url: str) -> bool:
-        
+        return bool(self._dog_image_verdict(image_url))
+
+    """
+    Determine whether a PHash (string or vector) matches any dog reference hash of that type.
+    """
+    def _matches_dog_hash(self, image_hash) -> bool:
+        if isinstance(image_hash, str):
+            image_hash = parse_hash('phash', image_hash)
+        return self._matches_dog_fingerprint({'phash': image_hash})
+
+    """
+    Determine whether an image fingerprint matches any dog reference set.
+    """
+    def _matches_dog_fingerprint(self, fingerprint) -> bool:
+        return any(reference.matches(fingerprint) for reference in self.dog_reference_sets)
+
+    """
+    Like _is_dog_image, but return None when the image could not be downloaded or hashed.
+    Raises BudgetExceeded when the deadline passes first.
+    """
+    def _dog_image_verdict(self, image_url: str, deadline: Optional[Deadline] = None) -> Optional[bool]:
         try:
-            response = requests.get(image_url, timeout=10)
-            if response.status_code != 200:
-                return False
-            image = Image.open(BytesIO(response.content))
-            image_hash = self.hasher.compute(image)
-            return any(self.hasher.compute_distance(image_hash, dog_hash) <= THRESH for dog_hash in self.dog_hashes)
+            with stage('download'):
+                content = download(image_url, deadline, timeout=10, negative_cache=self.negative_cache)
+            if content is None:
+                return None
+            with stage('hash'):
+                fingerprint = self.fingerprinter.fingerprint(content)
+            with stage('match'):
+                return self._matches_dog_fingerprint(fingerprint)
+        except BudgetExceeded:
+            raise
         except Exception as e:
+            if deadline is not None and deadline.expired():
+                raise BudgetExceeded() from e
             print(f"Failed to process image {image_url}: {e}")
-            return False
+            return None
+
 
 
+    def _moderate_text(self, post_text: str) -> List[str]:
+        """
+        Apply the keyword rules (Milestones 2 and 3) to the post text.
+        """
+        labels = set()
+
+        # === Milestone 2: T&S keyword matching ===
+        if self.ts_pattern.search(post_text):
+            labels.add(T_AND_S_LABEL)
+
+        # === Milestone 3: News source keyword matching ===
+        for pattern, source in self.news_patterns:
+            if pattern.search(post_text):
+                labels.add(source)
+
+        return list(labels)
+
+    def _moderate_images(self, context: PostContext) -> Tuple[List[str], bool]:
+        """
+        Apply dog image detection (Milestone 4) to the images attached to the post.
+
+        Images are read from the post context, so they are downloaded and decoded once
+        however many labelers check them. With a cascade, images are screened by their
+        thumbnail first. Returns the labels and whether the verdict is complete, i.e. no
+        image failed to download or hash before a match was found.
+        Raises BudgetExceeded when the deadline passes before every image was checked.
+        """
+        complete = True
+        for image_url in context.image_urls():
+            context.check_deadline()
+            if self.cascade is not None:
+                matched = self.cascade.match(context, image_url, self.dog_reference_sets, self.image_hash_types)
+            else:
+                fingerprint = context.fingerprint(image_url, self.image_hash_types)
+                with stage('match'):
+                    matched = None if fingerprint is None else self._matches_dog_fingerprint(fingerprint)
+            if matched is None:
+                complete = False
+            elif matched:
+                return [DOG_LABEL], True
+        return [], complete
 
     def moderate_post(self, url: str) -> List[str]:
         """
@@ -126,28 +229,67 @@ class AutomatedLabeler:
         Milestone 2: Label post with 't-and-s' if it contains any T&S keywords.
         Milestone 3: Add label corresponding to the source if a news keyword is found.
         Milestone 4: Add label 'dog' if any attached image is perceptually similar to a known dog image.
+
+        With a latency budget, image work is abandoned when the budget runs out and the
+        text verdict is returned alone; the budget records the post as degraded. With a
+        negative cache, posts recently not found or forbidden raise NegativeCacheHit
+        without a request.
         """
-        labels = set()
+        return self.moderate_post_verdict(url)[0]
+
+    def moderate_post_verdict(self, url: str) -> PostVerdict:
+        """
+        Moderate a post like moderate_post and report whether the verdict is degraded
+
+        Returns:
+            PostVerdict with the labels, whether they are the text verdict alone, and the
+            post's URI and CID
+        """
+        deadline = self.latency_budget.deadline() if self.latency_budget is not None else None
 
         # Fetch post content using the provided client
-        post = post_from_url(self.client, url)
+        context = PostContext.fetch(self.client, url, self.fingerprinter, deadline, self.negative_cache,
+                                    probe_fullsize=self.cascade is None)
+        labels = self.moderate_context(context)
+
+        if self.latency_budget is not None:
+            self.latency_budget.record(url, deadline, context.degraded)
+        return context.verdict(labels)
+
+    def moderate_context(self, context: PostContext) -> List[str]:
+        """
+        Apply moderation to a fetched post, reading its text and images from the context.
+
+        With a verdict store, the text and image verdicts of an unchanged post are reused
+        as long as the rules of the corresponding stage have not changed. With an account
+        aggregator, the verdict is also counted towards the author's account-level rules.
+        If the context's deadline passes during the image stage, the text verdict is
+        returned alone and the context is marked degraded.
+        """
+        post = context.post
         post_text = post.value.text
 
-        # === Milestone 2: T&S keyword matching ===
-        for keyword in self.ts_keywords:
-            if check_keyword(keyword, post_text):
-                labels.add(T_AND_S_LABEL)
+        with stage('text'):
+            if self.verdict_store is None:
+                labels = set(self._moderate_text(post_text))
+            else:
+                labels = set(self.verdict_store.cached(
+                    self.name, post, 'text', self.ruleset_versions['text'],
+                    lambda: (self._moderate_text(post_text), True)))
 
-        # === Milestone 3: News source keyword matching ===
-        for keyword, source in self.news_source:
-            if check_keyword(keyword, post_text):
-                labels.add(source)
+        try:
+            with stage('image'):
+                if self.verdict_store is None:
+                    labels |= set(self._moderate_images(context)[0])
+                else:
+                    labels |= set(self.verdict_store.cached(
+                        self.name, post, 'image', self.ruleset_versions['image'],
+                        lambda: self._moderate_images(context)))
+        except BudgetExceeded:
+            context.degraded = True
 
-        # === Milestone 4: Dog image detection ===
-        image_urls = self._extract_image_urls(post)
-        for image_url in image_urls:
-            if self._is_dog_image(image_url):
-                labels.add(DOG_LABEL)
-                break
+        # A degraded verdict is incomplete; the post is counted when it is rechecked
+        if self.account_aggregator is not None and not context.degraded:
+            self.account_aggregator.record_post(post, labels)
 
-        return list(labels) if labels else []
\ No newline at end of file
+        return list(labels) if labels else []
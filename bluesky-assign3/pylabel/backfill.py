@@ -0,0 +1,363 @@
+"""Offline bulk backfill of labeler verdicts over archived posts
+
+Streams post records from a JSON Lines or Parquet archive in chunks, scores each post
+with the text and image-hash rules of both labelers across a process pool, and writes
+one row of verdicts per post to a columnar output file (Parquet, or CSV). Nothing is
+fetched from the network, so history can be re-labeled quickly when a policy changes.
+
+Archive records have these fields:
+    uri           Post URI (required)
+    cid           Post CID
+    text          Post text
+    image_paths   Paths of the post's images, relative to --image_root (or absolute)
+    image_phashes Precomputed PHash strings of the post's images, used instead of files
+
+A record that cannot be parsed or scored (a truncated line, a malformed hash) does not stop
+the run: its row carries the failure in the error column and no labels.
+
+Usage:
+    python -m pylabel.backfill labeler-inputs archive.jsonl verdicts.parquet --workers 8
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional
+
+from .automated_labeler import DOG_LABEL, AutomatedLabeler
+from .image_fingerprint import ImageFingerprinter, parse_hash
+from .policy_proposal_labeler import SEXUAL_CONTENT_LABEL, PolicyProposalLabeler
+from .profiling import maybe_profile, stage
+
+OUTPUT_COLUMNS = ["uri", "cid", "automated_labels", "policy_labels", "labels", "images_hashed", "error"]
+
+# Labelers shared with the forked pool workers (see _score_chunk)
+_LABELERS: Dict[str, Any] = {}
+
+# Set on a placeholder record for an archive line that is not a JSON object
+_PARSE_ERROR = '_parse_error'
+
+
+def count_records(path: str) -> Optional[int]:
+    """
+    Count the records in an archive without parsing them
+
+    Returns:
+        Number of records, or None if it cannot be determined cheaply
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    count = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def iter_chunks(path: str, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Stream an archive as lists of at most chunk_size post records
+
+    Args:
+        path: JSON Lines (.jsonl) or Parquet (.parquet) archive
+        chunk_size: Records per chunk
+
+    Returns:
+        Iterator over chunks of records
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+        return
+
+    chunk = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = {_PARSE_ERROR: f"line {number}: {e}"}
+            if not isinstance(record, dict):
+                record = {_PARSE_ERROR: f"line {number}: not a JSON object"}
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def fingerprint_images(records: List[Dict[str, Any]], fingerprinter: ImageFingerprinter,
+                       image_root: str) -> Dict[str, Any]:
+    """
+    Decode the images of a chunk of records and hash them as one batch
+
+    Returns:
+        Dictionary of image path -> fingerprint, or the error message if the image
+        could not be decoded
+    """
+    results, paths, images = {}, [], []
+    for record in records:
+        image_paths = record.get('image_paths') or []
+        if not isinstance(image_paths, list):
+            continue  # score_record reports it
+        for image_path in image_paths:
+            if image_path in results:
+                continue
+            try:
+                with stage('hash'):
+                    images.append(fingerprinter.decode(os.path.join(image_root, image_path)))
+                paths.append(image_path)
+                results[image_path] = None
+            except Exception as e:
+                results[image_path] = str(e)
+    with stage('hash'):
+        results.update(zip(paths, fingerprinter.hash_many(images)))
+    return results
+
+
+def error_row(record: Dict[str, Any], error: str) -> Dict[str, Any]:
+    """Return the output row of a post that could not be scored"""
+    return {"uri": record.get('uri'), "cid": record.get('cid'), "automated_labels": '', "policy_labels": '',
+            "labels": '', "images_hashed": 0, "error": error}
+
+
+def score_record(record: Dict[str, Any], automated: AutomatedLabeler, policy: PolicyProposalLabeler,
+                 fingerprinter: ImageFingerprinter, image_root: str,
+                 image_fingerprints: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Score one archived post with the text and image-hash rules of both labelers
+
+    Each image is decoded once and fingerprinted with every hash type either labeler's
+    reference sets use; each reference set is matched against the hash of its own type.
+
+    Args:
+        image_fingerprints: Fingerprints from fingerprint_images; images are decoded
+            and hashed one at a time when omitted
+
+    Returns:
+        Output row for the post
+    """
+    if _PARSE_ERROR in record:
+        return error_row(record, record[_PARSE_ERROR])
+    text = record.get('text') or ''
+    with stage('text'):
+        automated_labels = set(automated._moderate_text(text))
+        policy_labels = set(policy._moderate_text(text))
+    errors = []
+
+    fingerprints = []
+    for image_hash in record.get('image_phashes') or []:
+        try:
+            fingerprints.append({'phash': parse_hash('phash', image_hash)})
+        except (TypeError, ValueError) as e:
+            errors.append(f"phash {image_hash!r}: {e}")
+    for image_path in record.get('image_paths') or []:
+        if image_fingerprints is not None:
+            fingerprint = image_fingerprints[image_path]
+            if isinstance(fingerprint, str):
+                errors.append(f"{image_path}: {fingerprint}")
+            else:
+                fingerprints.append(fingerprint)
+            continue
+        try:
+            with stage('hash'):
+                fingerprints.append(fingerprinter.fingerprint(os.path.join(image_root, image_path)))
+        except Exception as e:
+            errors.append(f"{image_path}: {e}")
+
+    with stage('match'):
+        for fingerprint in fingerprints:
+            if automated._matches_dog_fingerprint(fingerprint):
+                automated_labels.add(DOG_LABEL)
+            if not policy_labels and policy._matches_known_fingerprint(fingerprint):
+                policy_labels.add(SEXUAL_CONTENT_LABEL)
+
+    return {
+        "uri": record.get('uri'),
+        "cid": record.get('cid'),
+        "automated_labels": ','.join(sorted(automated_labels)),
+        "policy_labels": ','.join(sorted(policy_labels)),
+        "labels": ','.join(sorted(automated_labels | policy_labels)),
+        "images_hashed": len(fingerprints),
+        "error": '; '.join(errors) or None,
+    }
+
+
+def _score_chunk(chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Pool task: score a chunk with the labelers inherited from the parent process"""
+    # Hash the chunk's images as one batch, then match them per record
+    image_fingerprints = fingerprint_images(chunk, _LABELERS['fingerprinter'], _LABELERS['image_root'])
+    rows = []
+    for record in chunk:
+        try:
+            rows.append(score_record(record, _LABELERS['automated'], _LABELERS['policy'], _LABELERS['fingerprinter'],
+                                     _LABELERS['image_root'], image_fingerprints))
+        except Exception as e:
+            rows.append(error_row(record, repr(e)))
+    return rows
+
+
+class _CsvOutput:
+    def __init__(self, path: str):
+        import csv
+
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=OUTPUT_COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, rows: List[Dict[str, Any]]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetOutput:
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ("uri", pa.string()), ("cid", pa.string()), ("automated_labels", pa.string()),
+            ("policy_labels", pa.string()), ("labels", pa.string()),
+            ("images_hashed", pa.int32()), ("error", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, rows: List[Dict[str, Any]]):
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def open_output(path: str):
+    """Open a Parquet (.parquet) or CSV output writer for verdict rows"""
+    if path.endswith('.parquet'):
+        return _ParquetOutput(path)
+    return _CsvOutput(path)
+
+
+class ProgressReporter:
+    """Periodically print progress, throughput and ETA"""
+
+    def __init__(self, total: Optional[int], interval: float = 5.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self._last_report = self.start
+
+    def update(self, count: int, force: bool = False):
+        self.done += count
+        now = time.time()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        message = f"{self.done}"
+        if self.total:
+            remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+            message += f"/{self.total} ({self.done / self.total:.1%}), ETA {remaining:.0f}s"
+        print(f"Backfill: {message}, {rate:.1f} posts/s, elapsed {elapsed:.0f}s", flush=True)
+
+
+def run_backfill(input_dir: str, archive: str, output: str, workers: int = 1, chunk_size: int = 500,
+                 image_root: Optional[str] = None, progress_interval: float = 5.0,
+                 count: bool = True) -> int:
+    """
+    Score every post in an archive and write the verdicts
+
+    Args:
+        input_dir: Labeler inputs directory
+        archive: JSON Lines or Parquet archive of post records
+        output: Output file (.parquet for Parquet, anything else for CSV)
+        workers: Number of worker processes
+        chunk_size: Records per task
+        image_root: Directory relative image paths are resolved against (defaults to
+            the archive's directory)
+        progress_interval: Seconds between progress reports
+        count: Count the archive first so progress can show an ETA
+
+    Returns:
+        Number of posts scored
+    """
+    _LABELERS['automated'] = AutomatedLabeler(None, input_dir)
+    _LABELERS['policy'] = PolicyProposalLabeler(None, input_dir)
+    _LABELERS['fingerprinter'] = ImageFingerprinter(_LABELERS['automated'].image_hash_types
+                                                    | _LABELERS['policy'].image_hash_types)
+    _LABELERS['image_root'] = image_root or os.path.dirname(os.path.abspath(archive))
+
+    progress = ProgressReporter(count_records(archive) if count else None, progress_interval)
+    writer = open_output(output)
+    chunks = iter_chunks(archive, chunk_size)
+    try:
+        if workers <= 1:
+            for chunk in chunks:
+                rows = _score_chunk(chunk)
+                writer.write(rows)
+                progress.update(len(rows))
+        else:
+            # Labelers were built above, so the forked workers share them copy-on-write.
+            # At most 2 chunks per worker are in flight, keeping memory bounded however
+            # large the archive is, and results are written in archive order.
+            with mp.get_context("fork").Pool(workers) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(_score_chunk, (chunk,)))
+                    while len(pending) >= 2 * workers:
+                        rows = pending.popleft().get()
+                        writer.write(rows)
+                        progress.update(len(rows))
+                while pending:
+                    rows = pending.popleft().get()
+                    writer.write(rows)
+                    progress.update(len(rows))
+    finally:
+        writer.close()
+    progress.update(0, force=True)
+    return progress.done
+
+
+def main():
+    """Main function for the backfill command"""
+    parser = argparse.ArgumentParser(description="Offline backfill of labeler verdicts over a post archive")
+    parser.add_argument("labeler_inputs_dir", type=str)
+    parser.add_argument("archive", type=str, help="JSON Lines (.jsonl) or Parquet (.parquet) post archive")
+    parser.add_argument("output", type=str, help="Output file: .parquet for Parquet, otherwise CSV")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk_size", type=int, default=500)
+    parser.add_argument("--image_root", type=str, help="Directory relative image paths are resolved against")
+    parser.add_argument("--progress_interval", type=float, default=5.0)
+    parser.add_argument("--no_count", action="store_true", help="Skip counting the archive (no ETA)")
+    parser.add_argument("--profile", type=str, metavar="PREFIX",
+                        help="Profile the run, writing PREFIX.collapsed and PREFIX.txt (use --workers 1)")
+    parser.add_argument("--profile_mode", choices=["sampling", "deterministic"], default="sampling",
+                        help="sampling: low overhead, hot functions by sample count; deterministic: cProfile, "
+                             "exact call times in PREFIX.txt. PREFIX.collapsed is sampled, with stage labels, in both")
+    parser.add_argument("--profile_allocations", action="store_true",
+                        help="Also report the top allocation sites (tracemalloc; slows the run down)")
+    args = parser.parse_args()
+
+    with maybe_profile(args.profile, args.profile_mode, args.profile_allocations):
+        total = run_backfill(args.labeler_inputs_dir, args.archive, args.output, workers=args.workers,
+                             chunk_size=args.chunk_size, image_root=args.image_root,
+                             progress_interval=args.progress_interval, count=not args.no_count)
+    print(f"Wrote verdicts for {total} posts to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Coarse-to-fine image matching that screens images by their CDN thumbnail
+
+Almost every attached image is far from every reference hash, yet each one costs a
+fullsize download (up to 2000px) and decode. An ImageCascade checks the feed_thumbnail
+of the image first. Perceptual hashes are computed from a small grayscale resize of the
+image, so the thumbnail hash is expected to differ from the fullsize hash by only a few
+bits. Only when the thumbnail is within a wider
+"maybe" band of some reference set (its max_distance plus margin) is the fullsize image
+fetched and hashed for the precise decision; every other image is resolved as not
+matching from the thumbnail alone.
+
+As long as the thumbnail-to-fullsize hash drift stays below the margin, the cascade
+gives the same verdicts as hashing every fullsize image. Images without a thumbnail
+variant (non-CDN URLs, or posts whose fullsize image is missing) are checked directly.
+When the thumbnail exists but cannot be downloaded or decoded, the image is decided on the
+fullsize image and counted as a fallback, so a failing thumbnail path shows up in the stats
+instead of passing for images that never had a thumbnail. Labelers using a cascade resolve
+image URLs without the HEAD check of the fullsize image; when the fullsize image then cannot
+be fetched, the in-band thumbnail decides, as it would have after a failed HEAD check.
+
+Usage:
+    cascade = ImageCascade(margin=0.0625)
+    labeler = AutomatedLabeler(client, input_dir, cascade=cascade)
+    ...
+    print(cascade.stats())   # fraction of images resolved at each stage
+"""
+
+import threading
+from typing import TYPE_CHECKING, Iterable, Optional, Sequence
+
+from .post_context import thumbnail_url
+from .profiling import stage
+
+if TYPE_CHECKING:
+    from .image_fingerprint import ReferenceSet
+    from .post_context import PostContext
+
+# Outcomes counted by an ImageCascade
+COARSE = "coarse"      # resolved from the thumbnail
+FINE = "fine"          # thumbnail in the maybe band, decided on the fullsize image
+DIRECT = "direct"      # no thumbnail variant or no fullsize image, decided on the one there is
+FALLBACK = "fallback"  # thumbnail failed to download or decode, decided on the image itself
+FAILED = "failed"      # the image could not be downloaded or decoded
+
+
+class ImageCascade:
+    """Thumbnail-first matching of a post's images against reference sets"""
+
+    def __init__(self, margin: float = 0.0625):
+        """
+        Args:
+            margin: Normalized Hamming distance added to each reference set's
+                max_distance to form the band in which the fullsize image is checked
+        """
+        self.margin = margin
+        self._lock = threading.Lock()
+        self.counts = {COARSE: 0, FINE: 0, DIRECT: 0, FALLBACK: 0, FAILED: 0}
+        self.matches = 0
+
+    def version(self) -> str:
+        """Return a string identifying the cascade's rules, for image ruleset versions"""
+        return f"cascade:{self.margin}"
+
+    def _count(self, outcome: str, matched: bool = False):
+        with self._lock:
+            self.counts[outcome] += 1
+            self.matches += matched
+
+    def in_band(self, fingerprint, reference_sets: Sequence["ReferenceSet"]) -> bool:
+        """Check whether any reference set is within its max_distance plus the margin"""
+        for reference in reference_sets:
+            distance = reference.min_distance(fingerprint)
+            if distance is not None and distance <= reference.max_distance + self.margin:
+                return True
+        return False
+
+    def match(self, context: "PostContext", image_url: str, reference_sets: Sequence["ReferenceSet"],
+              hash_types: Iterable[str]) -> Optional[bool]:
+        """
+        Match one image of a post, screening it by its thumbnail first
+
+        Args:
+            context: Post context the thumbnail and image are read from
+            image_url: URL of the image, as returned by context.image_urls()
+            reference_sets: Reference sets the image is matched against
+            hash_types: Hash types the reference sets need
+
+        Returns:
+            Whether any reference set matches, or None if the image could not be
+            downloaded or decoded
+
+        Raises:
+            BudgetExceeded: If the deadline passed before the image was checked
+        """
+        hash_types = list(hash_types)
+        thumbnail = thumbnail_url(image_url)
+        outcome = DIRECT
+        thumbnail_fingerprint = None
+        if thumbnail is not None:
+            thumbnail_fingerprint = context.fingerprint(thumbnail, hash_types)
+            if thumbnail_fingerprint is None:
+                outcome = FALLBACK
+            else:
+                with stage('match'):
+                    if not self.in_band(thumbnail_fingerprint, reference_sets):
+                        self._count(COARSE)
+                        return False
+                outcome = FINE
+
+        fingerprint = context.fingerprint(image_url, hash_types)
+        if fingerprint is None and thumbnail_fingerprint is not None:
+            # No fullsize image: the thumbnail is the only variant, as with a failed HEAD check
+            fingerprint, outcome = thumbnail_fingerprint, DIRECT
+        if fingerprint is None:
+            self._count(FAILED)
+            return None
+        with stage('match'):
+            matched = any(reference.matches(fingerprint) for reference in reference_sets)
+        self._count(outcome, matched)
+        return matched
+
+    def stats(self) -> dict:
+        """Return the number and fraction of images resolved at each stage"""
+        with self._lock:
+            counts = dict(self.counts)
+            matches = self.matches
+        images = sum(counts.values())
+        return {
+            'images': images,
+            **counts,
+            'matches': matches,
+            **{f'{outcome}_rate': counts[outcome] / images if images else 0 for outcome in counts},
+        }
@@ -0,0 +1,320 @@
+"""Adaptive per-host concurrency limits for appview and CDN requests
+
+A fixed number of concurrent requests is wrong most of the time: too low wastes
+throughput, too high gets 429s from the appview behind client.get_post and throttling
+from cdn.bsky.app. Once HostLimiters are installed, every post fetch, image URL
+resolution and image download goes through limit(url), which blocks until the host's
+limiter has a free slot. Each limiter adjusts its limit with AIMD, as in TCP congestion
+control:
+
+    - a successful request while the limit was in use raises the limit by 1/limit, so it
+      grows by about one per round of requests
+    - a throttled response (429, 503), a 5xx, a timeout or connection error, or a rising
+      latency gradient multiplies the limit by backoff, at most once per smoothed round
+      trip so one congestion event is one cut
+
+The latency gradient compares a short-window average of the host's latency with a
+long-window average: only when recent requests are consistently latency_tolerance times
+slower than the long-run level does latency count as congestion, so ordinary jitter of
+single requests does not. Latency is the time to the response headers: requests reports
+it as response.elapsed, and atproto clients are timed by an httpx response hook
+(time_responses), so parsing and waiting on other threads of this process do not count.
+Client errors such as 404, and failures after the post's deadline passed (the request
+timeout was cut short by the latency budget), carry no congestion signal and leave the
+limit unchanged.
+
+Without installed limiters limit() does nothing, so serial runs pay no cost. Limits are
+per process: forked workers each inherit their own copy.
+
+Usage:
+    limiters = HostLimiters()
+    with limiters:
+        ...  # fetch, resolve and download through the labelers
+    print(limiters.stats())
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+OK = "ok"
+THROTTLED = "throttled"
+ERROR = "error"
+CANCELLED = "cancelled"
+
+THROTTLE_STATUSES = {429, 503}
+_TRANSPORT_ERRORS = {"Timeout", "TimeoutError", "ConnectionError", "NetworkError"}
+
+# Limiters used by limit(); None when adaptive concurrency is off
+_active: Optional["HostLimiters"] = None
+
+# Request being made under limit() by the current thread, for the response hook
+_local = threading.local()
+
+
+def classify_status(status_code: int) -> str:
+    """Map an HTTP status code to a request outcome"""
+    if status_code in THROTTLE_STATUSES:
+        return THROTTLED
+    if status_code >= 500:
+        return ERROR
+    return OK
+
+
+def classify_exception(error: BaseException) -> str:
+    """Map an exception raised by a request to an outcome"""
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is not None:
+        return classify_status(status_code)
+    if any(cls.__name__ in _TRANSPORT_ERRORS for cls in type(error).__mro__):
+        return ERROR
+    # Deadline aborts and programming errors say nothing about the host
+    return CANCELLED
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the requests in flight to one host"""
+
+    def __init__(self, initial_limit: float = 4, min_limit: float = 1, max_limit: float = 64,
+                 backoff: float = 0.7, latency_tolerance: Optional[float] = 3.0,
+                 short_window: int = 10, long_window: int = 200, warmup: int = 20):
+        """
+        Args:
+            initial_limit: Starting number of requests in flight
+            min_limit: Smallest limit
+            max_limit: Largest limit
+            backoff: Factor the limit is multiplied by on congestion
+            latency_tolerance: Short-window latency above this multiple of the
+                long-window latency counts as congestion; None to react to errors and
+                throttling only
+            short_window: Number of requests the short-window latency average spans
+            long_window: Number of requests the long-window latency average spans
+            warmup: Successful requests needed before latency is judged
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.short_weight = 1 / short_window
+        self.long_weight = 1 / long_window
+        self.warmup = warmup
+        self.in_flight = 0
+        self.samples = 0
+        self.short_latency: Optional[float] = None
+        self.long_latency: Optional[float] = None
+        self._last_decrease = float('-inf')
+        self._condition = threading.Condition()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+        self.max_in_flight = 0
+        self.total_wait = 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a free slot
+
+        Returns:
+            False if no slot was free within the timeout
+        """
+        start = time.monotonic()
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < max(int(self.limit), 1), timeout):
+                return False
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.total_wait += time.monotonic() - start
+            return True
+
+    def release(self, latency: float, outcome: str = OK):
+        """
+        Free a slot and adjust the limit from the request's latency and outcome
+
+        Args:
+            latency: Seconds the request took (time to response headers when known)
+            outcome: OK, THROTTLED, ERROR or CANCELLED
+        """
+        now = time.monotonic()
+        with self._condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if outcome != CANCELLED:
+                self.requests += 1
+                self._update(latency, outcome, saturated, now)
+            self._condition.notify_all()
+
+    def _update(self, latency: float, outcome: str, saturated: bool, now: float):
+        if outcome == THROTTLED:
+            self.throttled += 1
+        elif outcome == ERROR:
+            self.errors += 1
+        else:
+            self.samples += 1
+            if self.short_latency is None:
+                self.short_latency = self.long_latency = latency
+            else:
+                self.short_latency += self.short_weight * (latency - self.short_latency)
+                self.long_latency += self.long_weight * (latency - self.long_latency)
+
+        congested = outcome in (THROTTLED, ERROR) or (
+            self.latency_tolerance is not None and self.samples >= self.warmup
+            and self.short_latency > self.latency_tolerance * max(self.long_latency, 1e-3))
+        if congested:
+            # One multiplicative decrease per round trip, however many requests saw it
+            if now - self._last_decrease >= (self.short_latency or 0):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.decreases += 1
+                self._last_decrease = now
+        elif saturated and self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.increases += 1
+
+    def stats(self) -> dict:
+        """Return the current limit, in-flight requests and congestion counters"""
+        with self._condition:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'short_latency': self.short_latency,
+                'long_latency': self.long_latency,
+                'mean_wait': self.total_wait / self.requests if self.requests else 0,
+            }
+
+
+class Request:
+    """Outcome of one limited request, reported by the code making it"""
+
+    def __init__(self):
+        self.outcome = OK
+        self.latency: Optional[float] = None
+        self.start = time.monotonic()
+
+    def record(self, response):
+        """Record an HTTP response: its status and, when available, its time to headers"""
+        self.outcome = classify_status(response.status_code)
+        elapsed = getattr(response, 'elapsed', None)
+        if elapsed is not None:
+            self.latency = elapsed.total_seconds()
+
+    def record_headers(self, status_code: int):
+        """Record a response whose headers just arrived, timing the request up to now"""
+        self.outcome = classify_status(status_code)
+        self.latency = time.monotonic() - self.start
+
+
+class HostLimiters:
+    """One AdaptiveLimiter per host, created on first use"""
+
+    def __init__(self, **limiter_args):
+        """
+        Args:
+            limiter_args: Arguments of every AdaptiveLimiter (initial_limit, max_limit, ...)
+        """
+        self.limiter_args = limiter_args
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, host: str) -> AdaptiveLimiter:
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AdaptiveLimiter(**self.limiter_args)
+            return self._limiters[host]
+
+    def install(self):
+        """Route limit() through these limiters"""
+        global _active
+        _active = self
+
+    def uninstall(self):
+        global _active
+        if _active is self:
+            _active = None
+
+    def __enter__(self) -> "HostLimiters":
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def stats(self) -> Dict[str, dict]:
+        """Return the limiter metrics of every host"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.stats() for host, limiter in sorted(limiters.items())}
+
+
+def _response_hook(response):
+    request = getattr(_local, 'request', None)
+    if request is not None:
+        request.record_headers(response.status_code)
+
+
+def time_responses(client):
+    """
+    Time an atproto client's requests under limit() to their response headers
+
+    Installs an httpx response hook on the client, so the latency a limiter sees leaves
+    out reading and parsing the body and any wait for other threads of this process.
+    Clients that are not httpx based are left alone and timed by wall clock.
+    """
+    http = getattr(getattr(client, 'request', None), '_client', None)
+    hooks = getattr(http, 'event_hooks', None)
+    if hooks is not None and _response_hook not in hooks.get('response', ()):
+        http.event_hooks = {**hooks, 'response': [*hooks.get('response', ()), _response_hook]}
+
+
+def host_of(target: str) -> str:
+    """Return the host of a URL, or the target itself if it is not a URL"""
+    return urlsplit(target).netloc or target
+
+
+@contextmanager
+def limit(target: str, deadline=None) -> Iterator[Request]:
+    """
+    Hold a slot of the target host's limiter for the duration of a request
+
+    Args:
+        target: URL or host of the request
+        deadline: Deadline of the post being moderated, if any; waiting for a slot
+            past it raises BudgetExceeded
+
+    Yields:
+        Request the caller records the response on; exceptions are classified
+        automatically, and failures after the deadline passed count as cancelled
+    """
+    limiters = _active
+    request = Request()
+    if limiters is None:
+        yield request
+        return
+
+    limiter = limiters.for_host(host_of(target))
+    if not limiter.acquire(None if deadline is None else max(deadline.remaining(), 0)):
+        from .latency_budget import BudgetExceeded
+
+        raise BudgetExceeded()
+    request.start = time.monotonic()
+    previous, _local.request = getattr(_local, 'request', None), request
+    try:
+        yield request
+    except BaseException as e:
+        # A timeout cut short by the post's latency budget says nothing about the host
+        request.outcome = CANCELLED if deadline is not None and deadline.expired() else classify_exception(e)
+        raise
+    finally:
+        _local.request = previous
+        latency = request.latency if request.latency is not None else time.monotonic() - request.start
+        limiter.release(latency, request.outcome)
@@ -0,0 +1,265 @@
+"""Resumable, journaled evaluation of labelers against labeled test posts
+
+Every per-post result is appended to a JSON Lines journal as soon as it is known, so an
+interrupted evaluation can be restarted and will skip the posts already in the journal.
+Final metrics are computed by streaming the journal, so memory use does not grow with
+the number of posts evaluated.
+
+Journal records look like:
+    {"url": ..., "expected": [...], "actual": [...], "success": true, "elapsed": 0.27, "degraded": false}
+
+A degraded record holds the text verdict alone, because the post's latency budget ran out
+before its images were checked. It is kept for the record but is neither counted as done
+(a resumed run evaluates the post again) nor scored by compute_metrics.
+"""
+
+import hashlib
+import json
+import math
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+def as_label_list(labels: Any) -> List[str]:
+    """
+    Normalize a labeler verdict to a sorted list of labels
+
+    Args:
+        labels: None, a single label or an iterable of labels
+
+    Returns:
+        Sorted list of labels (empty when no label applies)
+    """
+    if labels is None:
+        return []
+    if isinstance(labels, str):
+        return [labels]
+    return sorted(labels)
+
+
+class EvaluationJournal:
+    """
+    Append-only JSON Lines journal of per-post evaluation results
+
+    A journal without a path keeps its records in memory, for short runs that do not need
+    to survive interruption.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: Journal file; created if missing and appended to if it exists
+        """
+        self.path = path
+        self._records: List[Dict[str, Any]] = []
+        self._file = None
+        if path:
+            self._file = open(path, 'a', encoding='utf-8')
+            # Terminate a line torn by a crash so the next record starts on its own line
+            if self._file.tell() > 0:
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self._file.write('\n')
+
+    def completed_digests(self):
+        """
+        Return 64-bit hashes of the URLs with a complete result, as a sorted NumPy array
+
+        Eight bytes per journaled post instead of a set of URL strings, for resuming long
+        runs; look URLs up with is_completed().
+        """
+        import numpy as np
+
+        digests = np.fromiter((_url_digest(record['url']) for record in self.iter_records()
+                               if not record.get('degraded')), dtype=np.uint64)
+        return np.unique(digests)
+
+    def completed_urls(self) -> Set[str]:
+        """Return the URLs that already have a complete (not degraded) result in the journal"""
+        return {record['url'] for record in self.iter_records() if not record.get('degraded')}
+
+    def append(self, url: str, expected: Any, actual: Any, elapsed: Optional[float] = None,
+               degraded: bool = False) -> Dict[str, Any]:
+        """
+        Record the result for one post and flush it to disk
+
+        Args:
+            url: URL of the post
+            expected: Expected label(s)
+            actual: Label(s) produced by the labeler
+            elapsed: Processing time in seconds, if measured
+            degraded: Whether the verdict is the text verdict alone, left pending
+
+        Returns:
+            The journal record
+        """
+        expected, actual = as_label_list(expected), as_label_list(actual)
+        record = {
+            'url': url,
+            'expected': expected,
+            'actual': actual,
+            'success': expected == actual,
+            'elapsed': elapsed,
+            'degraded': degraded,
+        }
+        if self._file is None:
+            self._records.append(record)
+        else:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+        return record
+
+    def iter_records(self) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the records in the journal
+
+        A truncated last line (from a crash mid-write) is ignored; the post it belonged to
+        is simply evaluated again.
+        """
+        if self._file is None:
+            yield from self._records
+            return
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def close(self):
+        """Close the journal file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _url_digest(url: str) -> int:
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def is_completed(digests, url: str) -> bool:
+    """Check whether a URL is among the sorted digests returned by completed_digests()"""
+    import numpy as np
+
+    if not len(digests):
+        return False
+    digest = np.uint64(_url_digest(url))
+    index = int(np.searchsorted(digests, digest))
+    return index < len(digests) and digests[index] == digest
+
+
+def pending_cases(cases: Iterable[Tuple[str, Any]], journal: EvaluationJournal) -> Iterator[Tuple[str, Any]]:
+    """
+    Filter out the (url, expected) cases that already have a complete result in the journal
+
+    Cases are filtered lazily, and the journal's URLs are held as 64-bit hashes, so memory
+    stays small however many posts the journal and the cases cover. expected can be any
+    value carried along with the URL, e.g. the whole input row. Posts with only degraded
+    results stay pending, so they are rechecked on resume.
+
+    Args:
+        cases: Iterable of (url, expected label(s)) pairs
+        journal: Journal of a previous, possibly interrupted, run
+
+    Returns:
+        Iterator over the cases still to be evaluated
+    """
+    done = journal.completed_digests()
+    if len(done):
+        print(f"Resuming: skipping {len(done)} posts already in the journal")
+    for url, expected in cases:
+        if not is_completed(done, url):
+            yield url, expected
+
+
+def compute_metrics(records: Iterable[Dict[str, Any]], include_results: bool = False) -> Dict[str, Any]:
+    """
+    Compute evaluation metrics in a single streaming pass over journal records
+
+    A post counts as positive when it is expected to receive at least one label. Degraded
+    records are not scored; 'degraded' counts the posts whose latest record is degraded,
+    i.e. that still await a recheck. The returned dictionary has the same shape as
+    PolicyProposalLabeler.test_labeler.
+
+    Args:
+        records: Journal records
+        include_results: Also return the per-URL success map (memory grows with the run)
+
+    Returns:
+        Dictionary with accuracy, precision, recall, F1, confusion matrix and timing stats
+    """
+    results = {}
+    total = correct = 0
+    # 64-bit hashes of the URLs whose latest record so far is degraded
+    degraded = set()
+    true_positives = false_positives = false_negatives = true_negatives = 0
+    # Welford's online algorithm for the processing time mean and variance
+    timed, mean_time, m2_time = 0, 0.0, 0.0
+    max_time, min_time = 0.0, math.inf
+
+    for record in records:
+        if record.get('degraded'):
+            degraded.add(_url_digest(record['url']))
+            continue
+        degraded.discard(_url_digest(record['url']))
+        total += 1
+        correct += record['success']
+        if include_results:
+            results[record['url']] = record['success']
+
+        expected, actual = record['expected'], record['actual']
+        if expected and actual == expected:
+            true_positives += 1
+        elif expected:
+            false_negatives += 1
+        elif actual:
+            false_positives += 1
+        else:
+            true_negatives += 1
+
+        elapsed = record.get('elapsed')
+        if elapsed is not None:
+            timed += 1
+            delta = elapsed - mean_time
+            mean_time += delta / timed
+            m2_time += delta * (elapsed - mean_time)
+            max_time = max(max_time, elapsed)
+            min_time = min(min_time, elapsed)
+
+    precision = true_positives / (true_positives + false_positives) if (true_positives + false_positives) > 0 else 0
+    recall = true_positives / (true_positives + false_negatives) if (true_positives + false_negatives) > 0 else 0
+    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0
+
+    metrics = {
+        "total": total,
+        "correct": correct,
+        "accuracy": correct / total if total > 0 else 0,
+        "degraded": len(degraded),
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "confusion_matrix": {
+            "true_positives": true_positives,
+            "false_positives": false_positives,
+            "false_negatives": false_negatives,
+            "true_negatives": true_negatives
+        },
+        "performance": {
+            "avg_processing_time": mean_time if timed else 0,
+            "max_processing_time": max_time if timed else 0,
+            "min_processing_time": min_time if timed else 0,
+            "std_processing_time": math.sqrt(m2_time / timed) if timed else 0
+        }
+    }
+    if include_results:
+        metrics["results"] = results
+    return metrics
@@ -0,0 +1,342 @@
+"""Decode-once image fingerprinting with several perceptual hash types
+
+Decoding an image dominates the cost of hashing it. An ImageFingerprinter decodes an image
+once into an RGB array and computes every configured hash type (PHash, DHash, wavelet,
+block-mean, average) from that one buffer. The buffer is handed to each perception hasher
+unchanged, because the hashers normalize differently (RGB or BGR grayscale weights, resize
+before or after the grayscale conversion); sharing a single grayscale image would give
+hashes that no longer match reference lists built with the standard hashers.
+
+A ReferenceSet holds the hashes of known images of one hash type, together with its match
+threshold, and is matched against the hash of that type in a fingerprint. Reference
+vectors are decoded once into a NumPy matrix, so a match costs one vectorized comparison.
+Reference files can therefore mix external hash lists of different types.
+
+Many images can be hashed at once with hash_many(). PHash then runs as a batch: each image
+is only converted to grayscale and resized (phash_prepare), the small images are stacked
+into one array, and the DCT and median threshold run once over the whole stack
+(batch_phash). The result is bit-identical to PHash.compute, with the Python overhead of
+the DCT and thresholding paid once per batch instead of once per image.
+"""
+
+import hashlib
+import json
+from io import BytesIO
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+# Hash type name -> perception hasher class
+HASH_TYPES = {
+    'phash': 'PHash',
+    'dhash': 'DHash',
+    'wavelet': 'WaveletHash',
+    'blockmean': 'BlockMean',
+    'average': 'AverageHash',
+}
+
+_HASHERS: Dict[str, Any] = {}
+
+
+def make_hasher(hash_type: str):
+    """Return the shared perception hasher for a hash type"""
+    if hash_type not in HASH_TYPES:
+        raise ValueError(f"Unknown hash type {hash_type!r}; expected one of {sorted(HASH_TYPES)}")
+    if hash_type not in _HASHERS:
+        from perception import hashers
+
+        _HASHERS[hash_type] = getattr(hashers, HASH_TYPES[hash_type])()
+    return _HASHERS[hash_type]
+
+
+def parse_hash(hash_type: str, value: Union[str, int], hash_format: str = 'auto'):
+    """
+    Convert a stored hash to a boolean vector
+
+    Args:
+        hash_type: Hash type the value was computed with
+        value: Hash as a perception base64 or hex string, or as an integer (or decimal
+            string) whose bits are the hash, most significant bit first
+        hash_format: 'base64', 'hex', 'int' or 'auto' to detect the format. A string of
+            decimal digits is read as an integer, unless it has exactly as many digits as
+            the hex form of the hash: it could be either then, so an explicit format is
+            required
+
+    Returns:
+        NumPy boolean vector of the hasher's hash length
+
+    Raises:
+        ValueError: If the value is malformed, or ambiguous and hash_format is 'auto'
+    """
+    import numpy as np
+
+    hasher = make_hasher(hash_type)
+    length = hasher.hash_length
+    if hash_format == 'auto':
+        if isinstance(value, int):
+            hash_format = 'int'
+        elif value.isdigit():
+            if len(value) == (length + 3) // 4:
+                raise ValueError(f"{value!r} could be a hex or a decimal {hash_type} hash; "
+                                 f"set hash_format to 'hex' or 'int'")
+            hash_format = 'int'
+        else:
+            for candidate in ('base64', 'hex'):
+                try:
+                    return parse_hash(hash_type, value, candidate)
+                except Exception:
+                    # perception raises plain Exceptions for malformed strings
+                    continue
+            raise ValueError(f"Cannot parse {value!r} as a {hash_type} hash")
+
+    if hash_format == 'int':
+        number = int(value)
+        if number < 0 or number >= 1 << length:
+            raise ValueError(f"{value!r} does not fit in a {length}-bit hash")
+        bits = np.unpackbits(np.frombuffer(number.to_bytes((length + 7) // 8, 'big'), dtype=np.uint8))
+        return bits[-length:].astype(bool)
+    vector = hasher.string_to_vector(value, hash_format=hash_format)
+    if vector.size != length:
+        raise ValueError(f"{value!r} is not a {length}-bit hash")
+    return vector.astype(bool)
+
+
+def phash_prepare(pixels, hasher=None):
+    """
+    Convert a decoded image to the small grayscale image PHash takes the DCT of
+
+    Args:
+        pixels: RGB array
+        hasher: PHash instance whose parameters to use; the shared one when omitted
+
+    Returns:
+        Square uint8 array of side hash_size * highfreq_factor
+    """
+    import cv2
+
+    hasher = hasher or make_hasher('phash')
+    size = hasher.hash_size * hasher.highfreq_factor
+    image = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    if hasher.box_filter:
+        kernel_size = round(size * 7 / 32)
+        image = cv2.boxFilter(image, ddepth=-1, ksize=(kernel_size, kernel_size))
+    return cv2.resize(image, dsize=(size, size), interpolation=cv2.INTER_AREA)
+
+
+def _phash_bits(images, hasher=None):
+    """Boolean (N, hash_length) PHash matrix of a stack of prepared images"""
+    import numpy as np
+    import scipy.fftpack
+
+    hasher = hasher or make_hasher('phash')
+    low, high = hasher.freq_shift, hasher.freq_shift + hasher.hash_size
+    images = np.asarray(images)
+    if not len(images):
+        return np.zeros((0, hasher.hash_length), dtype=bool)
+    # Same transforms as PHash, along the per-image axes; the row transform only
+    # needs the columns that are kept
+    dct = scipy.fftpack.dct(images, axis=2)[:, :, low:high]
+    dct = scipy.fftpack.dct(dct, axis=1)[:, low:high, :].reshape(len(images), -1)
+    if hasher.exclude_first_term:
+        dct = dct[:, 1:]
+    return dct >= np.median(dct, axis=1, keepdims=True)
+
+
+def batch_phash(images, hasher=None):
+    """
+    Compute the PHashes of many images with one vectorized DCT
+
+    Args:
+        images: (N, S, S) stack of images returned by phash_prepare
+        hasher: PHash instance whose parameters to use; the shared one when omitted
+
+    Returns:
+        (N, ceil(hash_length / 8)) uint8 array of packed hashes, most significant bit
+        first; each row's base64 encoding equals PHash's hash string
+    """
+    import numpy as np
+
+    return np.packbits(_phash_bits(images, hasher), axis=1)
+
+
+def unpack_hashes(packed, hash_length: int = 64):
+    """Convert packed hashes from batch_phash back to a boolean (N, hash_length) matrix"""
+    import numpy as np
+
+    return np.unpackbits(packed, axis=1)[:, :hash_length].astype(bool)
+
+
+class ImageFingerprinter:
+    """
+    Compute several hash types of an image from a single decode
+
+    Usage:
+        fingerprinter = ImageFingerprinter(['phash', 'dhash'])
+        fingerprint = fingerprinter.fingerprint(image_bytes)
+        if reference_set.matches(fingerprint): ...
+    """
+
+    def __init__(self, hash_types: Iterable[str] = ('phash',)):
+        """
+        Args:
+            hash_types: Hash types computed for every image
+        """
+        self.hash_types = sorted(set(hash_types))
+        self.hashers = {hash_type: make_hasher(hash_type) for hash_type in self.hash_types}
+        self.decodes = 0
+
+    def decode(self, image):
+        """
+        Decode an image into a contiguous RGB array
+
+        Args:
+            image: Raw bytes, a file path, a PIL image or an RGB array
+        """
+        from perception.hashers import tools
+
+        if isinstance(image, (bytes, bytearray)):
+            image = BytesIO(image)
+        self.decodes += 1
+        return tools.to_image_array(image)
+
+    def fingerprint(self, image, hash_types: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Decode an image once and compute its hashes
+
+        Args:
+            image: Raw bytes, a file path, a PIL image or an RGB array
+            hash_types: Subset of the configured hash types; all when omitted
+
+        Returns:
+            Dictionary of hash type -> boolean hash vector
+        """
+        return self.hash(self.decode(image), hash_types)
+
+    def hash_many(self, images: Iterable[Any], hash_types: Optional[Iterable[str]] = None,
+                  batch_size: int = 4096) -> List[Dict[str, Any]]:
+        """
+        Compute hashes of many decoded images, running PHash as a vectorized batch
+
+        Args:
+            images: RGB arrays returned by decode()
+            hash_types: Hash types to compute; all configured types when omitted
+            batch_size: Number of images per DCT batch, bounding memory use
+
+        Returns:
+            One dictionary of hash type -> boolean hash vector per image, in order
+        """
+        hash_types = list(self.hash_types if hash_types is None else hash_types)
+        others = [hash_type for hash_type in hash_types if hash_type != 'phash']
+        fingerprints, prepared = [], []
+
+        def flush():
+            for fingerprint, bits in zip(fingerprints[len(fingerprints) - len(prepared):],
+                                         _phash_bits(prepared, self.hashers.get('phash'))):
+                fingerprint['phash'] = bits
+            prepared.clear()
+
+        for pixels in images:
+            fingerprints.append(self.hash(pixels, others))
+            if 'phash' in hash_types:
+                prepared.append(phash_prepare(pixels, self.hashers.get('phash')))
+                if len(prepared) >= batch_size:
+                    flush()
+        if prepared:
+            flush()
+        return fingerprints
+
+    def hash(self, pixels, hash_types: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Compute hashes of an already decoded image
+
+        Args:
+            pixels: RGB array returned by decode()
+            hash_types: Hash types to compute; all configured types when omitted
+
+        Returns:
+            Dictionary of hash type -> boolean hash vector
+        """
+        return {hash_type: (self.hashers.get(hash_type) or make_hasher(hash_type))._compute(pixels).astype(bool)
+                for hash_type in (self.hash_types if hash_types is None else hash_types)}
+
+
+class ReferenceSet:
+    """Hashes of known images of one hash type, with the distance at which they match"""
+
+    def __init__(self, name: str, hash_type: str, hashes: Iterable[Any], max_distance: float,
+                 hash_format: str = 'auto'):
+        """
+        Args:
+            name: Name of the set, used in logs and stats
+            hash_type: Hash type the hashes were computed with
+            hashes: Hash strings, integers or boolean vectors
+            max_distance: Largest normalized Hamming distance (fraction of differing
+                bits) at which an image matches a reference hash
+            hash_format: Format of string hashes (see parse_hash)
+        """
+        import numpy as np
+
+        self.name = name
+        self.hash_type = hash_type
+        self.max_distance = max_distance
+        self.hash_length = make_hasher(hash_type).hash_length
+        vectors = [value if isinstance(value, np.ndarray) else parse_hash(hash_type, value, hash_format)
+                   for value in hashes]
+        self.vectors = (np.array(vectors, dtype=bool) if vectors
+                        else np.zeros((0, self.hash_length), dtype=bool))
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def distances(self, vector):
+        """Return the normalized Hamming distance of a hash vector to every reference hash"""
+        return (self.vectors != vector).mean(axis=1)
+
+    def matches_vector(self, vector) -> bool:
+        """Check a hash vector of this set's hash type against the reference hashes"""
+        return bool(len(self.vectors)) and bool((self.distances(vector) <= self.max_distance).any())
+
+    def matches(self, fingerprint: Dict[str, Any]) -> bool:
+        """Check the hash of this set's type in a fingerprint; False if it was not computed"""
+        vector = fingerprint.get(self.hash_type)
+        return vector is not None and self.matches_vector(vector)
+
+    def min_distance(self, fingerprint: Dict[str, Any]) -> Optional[float]:
+        """Return the distance to the closest reference hash, or None if there is nothing to compare"""
+        vector = fingerprint.get(self.hash_type)
+        if vector is None or not len(self.vectors):
+            return None
+        return float(self.distances(vector).min())
+
+    def version(self) -> str:
+        """Return a hash of the set's type, threshold and contents for ruleset versioning"""
+        digest = hashlib.sha256(f"{self.hash_type}:{self.max_distance}:".encode('utf-8'))
+        digest.update(self.vectors.tobytes())
+        return digest.hexdigest()[:16]
+
+
+def load_reference_sets(path: str, default_hash_type: str = 'phash',
+                        default_max_distance: float = 0.15) -> List[ReferenceSet]:
+    """
+    Load reference sets from a JSON file
+
+    The file holds either a plain list of hashes of the default type, or one object (or a
+    list of objects) of the form {"name": ..., "hash_type": "dhash", "max_distance": 0.1,
+    "hash_format": "hex", "hashes": [...]}; missing keys take the defaults.
+
+    Args:
+        path: JSON file
+        default_hash_type: Hash type of plain lists and of sets without "hash_type"
+        default_max_distance: Threshold of sets without "max_distance"
+
+    Returns:
+        List of reference sets
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [data]
+    if not data or not isinstance(data[0], dict):
+        data = [{"hashes": data}]
+    return [ReferenceSet(entry.get("name", f"set{index}"), entry.get("hash_type", default_hash_type),
+                         entry.get("hashes", []), entry.get("max_distance", default_max_distance),
+                         entry.get("hash_format", 'auto'))
+            for index, entry in enumerate(data)]
@@ -0,0 +1,80 @@
+"""Lightweight loaders for labeler input files
+
+The labeler inputs are small CSV and JSON files, so they are read with the standard
+library instead of pandas, which would otherwise dominate labeler start-up time.
+"""
+
+import csv
+import json
+from typing import Any, Dict, Iterator, List
+
+
+def iter_csv_records(path: str) -> Iterator[Dict[str, str]]:
+    """
+    Stream the rows of a CSV file with a header row
+
+    Args:
+        path: Path to the CSV file
+
+    Returns:
+        Iterator over rows as dictionaries keyed by column name; blank rows are skipped
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if any(value for value in row.values()):
+                yield row
+
+
+def read_csv_column(path: str, column: str) -> List[str]:
+    """
+    Read a single column of a CSV file
+
+    Args:
+        path: Path to the CSV file
+        column: Name of the column to read
+
+    Returns:
+        List of the non-empty values of the column, in file order
+    """
+    return [row[column] for row in iter_csv_records(path) if row.get(column)]
+
+
+def read_csv_rows(path: str, columns: List[str]) -> List[List[str]]:
+    """
+    Read the given columns of a CSV file as a list of rows
+
+    Args:
+        path: Path to the CSV file
+        columns: Names of the columns to read, in output order
+
+    Returns:
+        List of rows, each a list of values in the order of columns
+    """
+    return [[row[column] for column in columns] for row in iter_csv_records(path)]
+
+
+def iter_json_records(path: str) -> Iterator[Any]:
+    """
+    Stream records from a JSON array file or a JSON Lines file
+
+    JSON Lines files (.jsonl) are read one line at a time; anything else is parsed as a
+    single JSON document and, if it is a list, its items are yielded.
+
+    Args:
+        path: Path to the JSON or JSON Lines file
+
+    Returns:
+        Iterator over the decoded records
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+        data = json.load(f)
+    if isinstance(data, list):
+        yield from data
+    else:
+        yield data
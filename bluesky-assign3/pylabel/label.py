@@ -2,17 +2,41 @@
 
 import argparse
 import os
-from typing import List
+from typing import TYPE_CHECKING, List, Optional, Set
 
-import requests
-from atproto import Client, models
-from atproto_client.models.com.atproto.admin.defs import RepoRef
-from atproto_client.models.com.atproto.repo.strong_ref import Main
 from dotenv import load_dotenv
 
+from .concurrency import limit, time_responses
+
+# atproto and requests take a large share of startup time, so they are imported
+# inside the functions that use them rather than at module import
+if TYPE_CHECKING:
+    from atproto import Client
+
+    from .label_ledger import LabelLedger
+
 load_dotenv(override=True)
 USERNAME = os.getenv("USERNAME")
 PW = os.getenv("PW")
+# Appview/PDS the clients talk to; bsky.social unless set, e.g. to the load generator's stand-in
+APPVIEW_URL = os.getenv("APPVIEW_URL")
+
+
+def make_client(appview_url: Optional[str] = None) -> "Client":
+    """
+    Build an (unauthenticated) atproto Client
+
+    Args:
+        appview_url: XRPC base URL; defaults to the APPVIEW_URL environment variable,
+            then to bsky.social
+
+    Returns:
+        The client
+    """
+    from atproto import Client
+
+    base_url = appview_url or APPVIEW_URL
+    return Client(base_url=base_url) if base_url else Client()
 
 def did_from_handle(handle: str):
     """
@@ -24,6 +48,8 @@ def did_from_handle(handle: str):
     Returns:
         str: The DID associated with the input handle.
     """
+    import requests
+
     # via: https://github.com/skygaze-ai/atproto-101
     return requests.get(
         "https://bsky.social/xrpc/com.atproto.identity.resolveHandle",
@@ -32,26 +58,34 @@ def did_from_handle(handle: str):
     ).json()["did"]
 
 
-def post_from_url(client: Client, url: str):
+def post_from_url(client: "Client", url: str):
     """
     Retrieve a Bluesky post from its URL
     """
     parts = url.split("/")
     rkey = parts[-1]
     handle = parts[-3]
-    return client.get_post(rkey, handle)
+    time_responses(client)
+    with limit(getattr(client, "_base_url", None) or "appview"):
+        return client.get_post(rkey, handle)
 
 
-def label_account(client: Client, handle: str, label_value: List[str]):
+def label_account(
+    client: "Client", handle: str, label_value: List[str], negate_value: Optional[List[str]] = None
+):
     """
-    Apply a label to an account with the specified handle
+    Apply a label to an account with the specified handle (or DID), optionally negating
+    previously applied labels in the same event
     """
-    did = did_from_handle(handle)
+    from atproto import models
+    from atproto_client.models.com.atproto.admin.defs import RepoRef
+
+    did = handle if handle.startswith("did:") else did_from_handle(handle)
     data = models.ToolsOzoneModerationEmitEvent.Data(
         created_by=client.me.did,
         event=models.ToolsOzoneModerationDefs.ModEventLabel(
             create_label_vals=label_value,
-            negate_label_vals=[],
+            negate_label_vals=negate_value or [],
         ),
         subject=RepoRef(did=did),
         subject_blob_cids=[],
@@ -60,18 +94,29 @@ def label_account(client: Client, handle: str, label_value: List[str]):
 
 
 def label_post(
-    client: Client, labeler_client: Client, post_url: str, label_value: List[str]
+    client: "Client",
+    labeler_client: "Client",
+    post_url: str,
+    label_value: List[str],
+    negate_value: Optional[List[str]] = None,
+    post=None,
 ):
     """
-    Apply a label to a post with the specified URL
+    Apply a label to a post with the specified URL, optionally negating previously
+    applied labels in the same event. An already fetched post (or anything with its uri
+    and cid) can be passed to avoid fetching it again.
     """
-    post = post_from_url(client, post_url)
+    from atproto import models
+    from atproto_client.models.com.atproto.repo.strong_ref import Main
+
+    if post is None:
+        post = post_from_url(client, post_url)
     post_ref = Main(cid=post.cid, uri=post.uri)
     data = models.ToolsOzoneModerationEmitEvent.Data(
         created_by=client.me.did,
         event=models.ToolsOzoneModerationDefs.ModEventLabel(
             create_label_vals=label_value,
-            negate_label_vals=[],
+            negate_label_vals=negate_value or [],
         ),
         subject=post_ref,
         subject_blob_cids=[],
@@ -79,11 +124,67 @@ def label_post(
     return labeler_client.tools.ozone.moderation.emit_event(data)
 
 
+def sync_post_labels(
+    client: "Client",
+    labeler_client: "Client",
+    post_url: str,
+    label_value: List[str],
+    ledger: "LabelLedger",
+    managed: Optional[Set[str]] = None,
+    post=None,
+):
+    """
+    Bring the labels on a post in line with a verdict, emitting only the delta
+
+    Creates the labels the post is missing and negates the managed labels that no longer
+    apply, in one event. Nothing is emitted if the ledger shows the labels are current.
+    The post (or anything with its uri and cid, such as the PostVerdict the labeler
+    returned) can be passed to avoid fetching it again.
+
+    Returns:
+        The emit_event response, or None if nothing changed
+    """
+    if post is None:
+        post = post_from_url(client, post_url)
+    create, negate = ledger.diff(post.uri, label_value, managed)
+    if not create and not negate:
+        ledger.skipped += 1
+        return None
+    result = label_post(client, labeler_client, post_url, create, negate, post=post)
+    ledger.apply(post.uri, create, negate)
+    ledger.emitted += 1
+    return result
+
+
+def sync_account_labels(
+    client: "Client",
+    handle: str,
+    label_value: List[str],
+    ledger: "LabelLedger",
+    managed: Optional[Set[str]] = None,
+):
+    """
+    Bring the labels on an account in line with a verdict, emitting only the delta
+
+    Returns:
+        The emit_event response, or None if nothing changed
+    """
+    did = handle if handle.startswith("did:") else did_from_handle(handle)
+    create, negate = ledger.diff(did, label_value, managed)
+    if not create and not negate:
+        ledger.skipped += 1
+        return None
+    result = label_account(client, did, create, negate)
+    ledger.apply(did, create, negate)
+    ledger.emitted += 1
+    return result
+
+
 def main():
     """
     Main function for command-line tool.
     """
-    client = Client()
+    client = make_client()
     client.login(USERNAME, PW)
     did = did_from_handle(USERNAME)
     labeler_client = client.with_proxy("atproto_labeler", did)
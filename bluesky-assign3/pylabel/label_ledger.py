@@ -0,0 +1,154 @@
+"""Local ledger of the labels currently applied to each subject
+
+Emitting a label event for every verdict re-sends labels that are already applied and
+never removes labels that no longer apply. The ledger remembers the labels applied to
+each subject (a post URI or an account DID), diffs a new verdict against them and yields
+one create/negate delta, which is only emitted when something changed.
+
+The ledger can be seeded in bulk by replaying the labeler's existing label events from
+Ozone, so a fresh ledger does not start by re-emitting everything.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Iterable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+LABEL_EVENT_TYPE = "tools.ozone.moderation.defs#modEventLabel"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+    subject TEXT PRIMARY KEY,
+    labels TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class LabelLedger:
+    """
+    SQLite-backed map of subject -> labels currently applied by this labeler
+
+    The connection is opened lazily per process, like VerdictStore.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        """
+        Args:
+            path: SQLite database file, or ':memory:' for a ledger that lasts one run
+        """
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self.emitted = 0
+        self.skipped = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            if self.path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def current(self, subject: str) -> Set[str]:
+        """Return the labels currently applied to a subject"""
+        row = self._connection().execute(
+            'SELECT labels FROM labels WHERE subject = ?', (subject,)
+        ).fetchone()
+        return set(json.loads(row[0])) if row else set()
+
+    def diff(self, subject: str, labels: Iterable[str],
+             managed: Optional[Set[str]] = None) -> Tuple[List[str], List[str]]:
+        """
+        Compare a new verdict with the labels currently applied to a subject
+
+        Args:
+            subject: Post URI or account DID
+            labels: Complete set of labels the subject should now carry
+            managed: Labels this labeler is responsible for; applied labels outside this
+                set are never negated. All applied labels are managed when omitted.
+
+        Returns:
+            Tuple of (labels to create, labels to negate), both sorted
+        """
+        wanted, applied = set(labels), self.current(subject)
+        removable = applied if managed is None else applied & set(managed)
+        return sorted(wanted - applied), sorted(removable - wanted)
+
+    def apply(self, subject: str, create: Iterable[str] = (), negate: Iterable[str] = ()):
+        """Record that labels were created and/or negated on a subject"""
+        self._apply(subject, create, negate)
+        self._connection().commit()
+
+    def _apply(self, subject: str, create: Iterable[str], negate: Iterable[str]):
+        # Update one subject without committing, so bulk updates share one transaction
+        labels = (self.current(subject) | set(create)) - set(negate)
+        conn = self._connection()
+        if labels:
+            conn.execute(
+                'INSERT OR REPLACE INTO labels (subject, labels, updated_at) VALUES (?, ?, ?)',
+                (subject, json.dumps(sorted(labels)), time.time()),
+            )
+        else:
+            conn.execute('DELETE FROM labels WHERE subject = ?', (subject,))
+
+    def seed_from_events(self, labeler_client: "Client", created_by: Optional[str] = None,
+                         page_size: int = 100) -> int:
+        """
+        Rebuild the ledger by replaying the labeler's label events from Ozone, oldest first
+
+        Args:
+            labeler_client: Client proxied to the labeler service
+            created_by: Only replay events emitted by this DID
+            page_size: Events requested per page
+
+        Returns:
+            Number of label events replayed
+        """
+        from atproto import models
+
+        conn = self._connection()
+        replayed, cursor = 0, None
+        # One transaction for the whole replay: a commit per event would sync the file per
+        # event, and a failed replay is rolled back, leaving the previous ledger in place
+        with conn:
+            conn.execute('DELETE FROM labels')
+            while True:
+                params = models.ToolsOzoneModerationQueryEvents.Params(
+                    types=[LABEL_EVENT_TYPE],
+                    sort_direction='asc',
+                    created_by=created_by,
+                    limit=page_size,
+                    cursor=cursor,
+                )
+                response = labeler_client.tools.ozone.moderation.query_events(params)
+                for event_view in response.events:
+                    subject = getattr(event_view.subject, 'uri', None) or getattr(event_view.subject, 'did', None)
+                    if subject is None:
+                        continue
+                    self._apply(
+                        subject,
+                        create=event_view.event.create_label_vals or [],
+                        negate=event_view.event.negate_label_vals or [],
+                    )
+                    replayed += 1
+                cursor = response.cursor
+                if not cursor or not response.events:
+                    break
+        return replayed
+
+    def stats(self) -> dict:
+        """Return the number of emitted and skipped (unchanged) label updates"""
+        return {'emitted': self.emitted, 'skipped': self.skipped}
+
+    def close(self):
+        """Close the database connection"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,167 @@
+"""Per-post latency budgets with graceful degradation to text-only verdicts
+
+Without a deadline, a post with several slow images can hold up moderation for the sum
+of every HEAD and GET timeout. A LatencyBudget gives each post a Deadline when moderation
+starts. Network calls made for the post use the remaining time as their timeout (never
+more than their usual timeout), image downloads are streamed and abandoned as soon as the
+deadline passes, and image work stops with BudgetExceeded once it has run out.
+
+The labeler then returns the text verdict alone, marked degraded: the budget counts it
+and keeps the post URL so it can be rechecked later, off the latency-critical path. An
+incomplete image verdict is never stored in the verdict store, so the recheck runs the
+image stage again.
+"""
+
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from .concurrency import limit
+from .negative_cache import TIMEOUT, NegativeCache, blob_key
+
+
+class BudgetExceeded(Exception):
+    """Raised when a post's latency budget runs out before its moderation finished"""
+
+
+class Deadline:
+    """Point in time by which moderation of one post must finish"""
+
+    def __init__(self, seconds: float):
+        self.start = time.monotonic()
+        self.expires_at = self.start + seconds
+
+    def remaining(self) -> float:
+        """Return the seconds left, which may be negative"""
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self):
+        """Raise BudgetExceeded if the deadline has passed"""
+        if self.expired():
+            raise BudgetExceeded()
+
+    def timeout(self, default: float) -> float:
+        """
+        Return the timeout to use for a network call made before the deadline
+
+        Args:
+            default: Timeout the call would use without a budget
+
+        Returns:
+            The smaller of default and the remaining time
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise BudgetExceeded()
+        return min(default, remaining)
+
+
+def download(url: str, deadline: Optional[Deadline] = None, timeout: float = 10,
+             chunk_size: int = 64 * 1024,
+             negative_cache: Optional[NegativeCache] = None) -> Optional[bytes]:
+    """
+    Download a URL, giving up when the deadline passes
+
+    Args:
+        url: URL to download
+        deadline: Deadline of the post being moderated, if any
+        timeout: Connect and read timeout used without a deadline
+        chunk_size: Bytes read between deadline checks
+        negative_cache: Optional cache of failed blobs; a recently failed blob is not
+            requested again, and not-found, forbidden and timed out responses are recorded
+
+    Returns:
+        The response body, or None if the response status is not 200 or the blob
+        recently failed
+    """
+    import requests
+
+    key = blob_key(url)
+    if negative_cache is not None and negative_cache.get(key) is not None:
+        return None
+    try:
+        if deadline is None:
+            with limit(url) as request:
+                response = requests.get(url, timeout=timeout)
+                request.record(response)
+            if response.status_code != 200:
+                if negative_cache is not None:
+                    negative_cache.record_status(key, response.status_code)
+                return None
+            return response.content
+
+        with limit(url, deadline) as request, \
+                requests.get(url, timeout=deadline.timeout(timeout), stream=True) as response:
+            request.record(response)
+            if response.status_code != 200:
+                if negative_cache is not None:
+                    negative_cache.record_status(key, response.status_code)
+                return None
+            chunks = []
+            for chunk in response.iter_content(chunk_size):
+                deadline.check()
+                chunks.append(chunk)
+        return b''.join(chunks)
+    except requests.Timeout:
+        # A timeout cut short by the post's own budget says nothing about the blob
+        if negative_cache is not None and (deadline is None or not deadline.expired()):
+            negative_cache.put(key, TIMEOUT)
+        raise
+
+
+class LatencyBudget:
+    """
+    Per-post time-to-label budget and counters of posts that exceeded it
+
+    Usage:
+        budget = LatencyBudget(2.0)
+        labeler = AutomatedLabeler(client, input_dir, latency_budget=budget)
+        ...
+        print(budget.stats())
+        recheck(budget.degraded_urls)
+    """
+
+    def __init__(self, seconds: float, max_degraded_urls: int = 10_000):
+        """
+        Args:
+            seconds: Time allowed for moderating one post
+            max_degraded_urls: Number of most recent degraded post URLs kept for rechecks
+        """
+        self.seconds = seconds
+        self.degraded_urls: Deque[str] = deque(maxlen=max_degraded_urls)
+        self.posts = 0
+        self.exceeded = 0
+        self.degraded = 0
+
+    def deadline(self) -> Deadline:
+        """Start the budget of a post"""
+        return Deadline(self.seconds)
+
+    def record(self, url: str, deadline: Deadline, degraded: bool):
+        """
+        Count a finished post
+
+        Args:
+            url: URL of the post
+            deadline: Deadline the post was moderated under
+            degraded: Whether image work was cut short and only the text verdict was used
+        """
+        self.posts += 1
+        if deadline.expired():
+            self.exceeded += 1
+        if degraded:
+            self.degraded += 1
+            self.degraded_urls.append(url)
+
+    def stats(self) -> dict:
+        """Return the number of posts that exceeded the budget and were degraded"""
+        return {
+            'budget_seconds': self.seconds,
+            'posts': self.posts,
+            'exceeded': self.exceeded,
+            'degraded': self.degraded,
+            'degraded_rate': self.degraded / self.posts if self.posts else 0,
+        }
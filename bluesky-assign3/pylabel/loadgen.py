@@ -0,0 +1,689 @@
+"""Synthetic load generator with a local stand-in for the appview and the image CDN
+
+The test fixtures hold a few hundred URLs of live posts, too few to measure capacity and
+too slow and rate limited to saturate anything but Bluesky. A SyntheticCorpus generates
+post records and their images from a LoadProfile (text length, hashtag density, rate of
+labeler terms, images per post, image sizes, duplicate blobs, deleted posts), each one
+derived from the seed and its index, so a corpus of any size costs no memory and is the
+same on every run.
+
+A StandInServer serves the corpus over HTTP like the services the labelers talk to, the
+appview and the CDN each on its own port so per-host limits see two hosts:
+
+    POST /xrpc/com.atproto.server.createSession      login (also refreshSession)
+    GET  /xrpc/app.bsky.actor.getProfile             profile fetched by Client.login
+    GET  /xrpc/com.atproto.identity.resolveHandle    author handles, for sharding by DID
+    GET  /xrpc/com.atproto.repo.getRecord            post records read by client.get_post
+    GET  /img/feed_{fullsize,thumbnail}/plain/...    JPEG blobs, as on cdn.bsky.app
+
+and injects latency, throttling (429), server errors (500) and a concurrency capacity
+beyond which requests are throttled, separately for the appview and the CDN. While the
+server is running, server.client() returns an atproto Client logged in against it and
+image URLs resolve to its CDN paths, so labelers, LabelerRunner and HostLimiters run
+against it unchanged.
+
+Usage:
+    corpus = SyntheticCorpus(LoadProfile(posts=10_000), terms=load_terms("labeler-inputs"))
+    with StandInServer(corpus, cdn=FaultProfile(latency_ms=40, capacity=32)) as server:
+        runner = LabelerRunner(server.client(), [AutomatedLabeler(...), PolicyProposalLabeler(...)])
+        for url in corpus.urls():
+            runner.moderate_post(url)
+        print(server.stats())
+
+    python -m pylabel.loadgen run labeler-inputs --posts 5000 --threads 32 --adaptive_concurrency --cdn_capacity 24
+    python -m pylabel.loadgen serve --port 8765 --urls_csv synthetic-posts.csv
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import TYPE_CHECKING, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qs
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+# Bluesky caps post text at 300 characters and serves thumbnails at most 1000px wide
+MAX_TEXT_LENGTH = 300
+THUMBNAIL_SIDE = 1000
+LOGIN_HANDLE = "labeler.loadgen.test"
+LOGIN_DID = "did:plc:loadgenlabeler"
+
+_FILLER_WORDS = (
+    "the a and to of in is it that for on with this was just my so what about day today "
+    "time people new good really love think know see going get one like look all back "
+    "morning night weekend coffee photo walk city park friends work home music book game "
+    "art garden rain sun summer winter finally still again here there more some never"
+).split()
+
+_HANDLE = re.compile(r'^user(\d+)\.loadgen\.test$')
+_DID = re.compile(r'^did:plc:loadgen(\d+)$')
+_RKEY = re.compile(r'^3loadgen(\d+)$')
+_BLOB = re.compile(r'^bafyload(?:u(\d+)x(\d+)|p(\d+)|f(\d+))$')
+_IMAGE_PATH = re.compile(r'^/img/(feed_fullsize|feed_thumbnail)/plain/([^/]+)/([^/@]+)@jpeg$')
+
+
+class LoadProfile(NamedTuple):
+    """Distributions the synthetic posts are drawn from"""
+
+    posts: int = 1000
+    authors: int = 100
+    text_words_mean: float = 25       # words per post, log-normally distributed
+    text_words_sigma: float = 0.6
+    hashtag_density: float = 0.1      # fraction of words written as hashtags
+    term_hit_rate: float = 0.1        # fraction of posts containing a labeler term
+    images_per_post: Tuple[float, ...] = (0.6, 0.25, 0.1, 0.05)  # P(0 images), P(1), ...
+    image_sides: Tuple[int, int] = (256, 2048)  # range of the longer image side
+    duplicate_blob_ratio: float = 0.2  # fraction of images reusing a popular blob
+    image_file_rate: float = 0.0      # fraction of images taken from the image files
+    deleted_rate: float = 0.0         # fraction of posts answered with RecordNotFound
+    seed: int = 0
+
+
+class FaultProfile(NamedTuple):
+    """Latency and failures injected into the responses of one service"""
+
+    latency_ms: float = 0.0           # median added latency
+    latency_sigma: float = 0.5        # log-normal spread of the added latency
+    error_rate: float = 0.0           # fraction answered with 500
+    throttle_rate: float = 0.0        # fraction answered with 429
+    capacity: Optional[int] = None    # requests in flight beyond which 429 is returned
+
+
+def load_terms(input_dir: str) -> List[str]:
+    """Return the T&S words and sexual terms of a labeler inputs directory, for term hits"""
+    from .inputs import read_csv_column
+
+    terms = []
+    words_path = os.path.join(input_dir, 't-and-s-words.csv')
+    if os.path.exists(words_path):
+        terms += read_csv_column(words_path, 'Word')
+    sexual_terms_path = os.path.join(input_dir, 'sexual_terms.json')
+    if os.path.exists(sexual_terms_path):
+        with open(sexual_terms_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        terms += data if isinstance(data, list) else [term for values in data.values() for term in values]
+    return terms
+
+
+class SyntheticCorpus:
+    """Posts and images generated deterministically from a LoadProfile"""
+
+    def __init__(self, profile: LoadProfile = LoadProfile(), terms: Sequence[str] = (),
+                 image_files: Sequence[str] = (), image_cache_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            profile: Distributions of the generated posts
+            terms: Labeler terms inserted into term_hit_rate of the posts
+            image_files: Images served for image_file_rate of the attached images, e.g.
+                the reference images so some images match
+            image_cache_bytes: Size of the encoded JPEGs kept for repeated requests
+        """
+        self.profile = profile
+        self.terms = list(terms)
+        self.image_files = sorted(image_files)
+        self.popular_blobs = max(1, profile.posts // 20)
+        self.image_cache_bytes = image_cache_bytes
+        # (cid, thumbnail) -> JPEG bytes, least recently served first
+        self._images: "OrderedDict[Tuple[str, bool], Optional[bytes]]" = OrderedDict()
+        self._cached_bytes = 0
+        self._images_lock = threading.Lock()
+
+    def author(self, index: int) -> Tuple[str, str]:
+        """Return the handle and DID of the author of a post"""
+        author = index % self.profile.authors
+        return f"user{author}.loadgen.test", f"did:plc:loadgen{author:06d}"
+
+    def url(self, index: int) -> str:
+        handle, _ = self.author(index)
+        return f"https://bsky.app/profile/{handle}/post/3loadgen{index:08d}"
+
+    def urls(self) -> Iterator[str]:
+        """Yield the URLs of every post in the corpus"""
+        return (self.url(index) for index in range(self.profile.posts))
+
+    def _text(self, rng: random.Random) -> str:
+        profile = self.profile
+        mu = math.log(max(profile.text_words_mean, 1)) - profile.text_words_sigma ** 2 / 2
+        words = max(1, round(rng.lognormvariate(mu, profile.text_words_sigma)))
+        term = rng.choice(self.terms) if self.terms and rng.random() < profile.term_hit_rate else None
+        if term is not None and rng.random() < profile.hashtag_density:
+            term = '#' + term.replace(' ', '')
+        budget = MAX_TEXT_LENGTH - (len(term) + 1 if term else 0)
+
+        tokens, length = [], 0
+        for _ in range(words):
+            word = rng.choice(_FILLER_WORDS)
+            if rng.random() < profile.hashtag_density:
+                word = '#' + word
+            if length + len(word) + 1 > budget:
+                break
+            tokens.append(word)
+            length += len(word) + 1
+        if term is not None:
+            tokens.insert(rng.randrange(len(tokens) + 1), term)
+        return ' '.join(tokens)
+
+    def _blobs(self, index: int, rng: random.Random) -> List[str]:
+        profile = self.profile
+        count = rng.choices(range(len(profile.images_per_post)), weights=profile.images_per_post)[0]
+        blobs = []
+        for position in range(min(count, 4)):
+            if self.image_files and rng.random() < profile.image_file_rate:
+                blobs.append(f"bafyloadf{rng.randrange(len(self.image_files))}")
+            elif rng.random() < profile.duplicate_blob_ratio:
+                blobs.append(f"bafyloadp{rng.randrange(self.popular_blobs)}")
+            else:
+                blobs.append(f"bafyloadu{index}x{position}")
+        return blobs
+
+    def post(self, index: int) -> Optional[dict]:
+        """
+        Generate a post
+
+        Returns:
+            getRecord response body of the post, or None if the post is deleted
+        """
+        rng = random.Random(f"{self.profile.seed}:{index}")
+        if rng.random() < self.profile.deleted_rate:
+            return None
+        _, did = self.author(index)
+        created_at = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(1_735_689_600 + index))
+        value = {"$type": "app.bsky.feed.post", "text": self._text(rng), "createdAt": created_at, "langs": ["en"]}
+        blobs = self._blobs(index, rng)
+        if blobs:
+            value["embed"] = {
+                "$type": "app.bsky.embed.images",
+                "images": [{"alt": "", "image": {"$type": "blob", "ref": {"$link": cid},
+                                                 "mimeType": "image/jpeg", "size": self._blob_bytes(cid)}}
+                           for cid in blobs],
+            }
+        return {"uri": f"at://{did}/app.bsky.feed.post/3loadgen{index:08d}",
+                "cid": f"bafyreiload{self.profile.seed}x{index}", "value": value}
+
+    def lookup(self, repo: str, rkey: str) -> Tuple[bool, Optional[dict]]:
+        """
+        Find a post by repo (handle or DID) and record key
+
+        Returns:
+            Whether the post exists in the corpus, and its record (None if deleted)
+        """
+        author, match = _HANDLE.match(repo) or _DID.match(repo), _RKEY.match(rkey)
+        if author is None or match is None:
+            return False, None
+        index = int(match.group(1))
+        if index >= self.profile.posts or index % self.profile.authors != int(author.group(1)):
+            return False, None
+        return True, self.post(index)
+
+    def _blob_size(self, cid: str) -> Tuple[int, int]:
+        rng = random.Random(f"{self.profile.seed}:{cid}")
+        side = rng.randint(*self.profile.image_sides)
+        aspect = rng.choice((1.0, 4 / 3, 3 / 2, 16 / 9))
+        other = max(1, round(side / aspect))
+        return (side, other) if rng.random() < 0.5 else (other, side)
+
+    def _blob_bytes(self, cid: str) -> int:
+        match = _BLOB.match(cid)
+        if match and match.group(4) is not None:
+            return os.path.getsize(self.image_files[int(match.group(4))])
+        width, height = self._blob_size(cid)
+        return width * height // 10
+
+    def image(self, cid: str, thumbnail: bool = False) -> Optional[bytes]:
+        """
+        Return the JPEG bytes of a blob, encoding it on first use
+
+        Args:
+            cid: Blob CID from a generated post
+            thumbnail: Return the feed thumbnail, at most THUMBNAIL_SIDE pixels wide
+
+        Returns:
+            JPEG bytes, or None if the CID is not one of the corpus's blobs
+        """
+        key = (cid, thumbnail)
+        with self._images_lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return self._images[key]
+        content = self._encode_image(cid, thumbnail)
+        with self._images_lock:
+            if key not in self._images:
+                self._images[key] = content
+                self._cached_bytes += len(content or b'')
+                while self._cached_bytes > self.image_cache_bytes and len(self._images) > 1:
+                    _, evicted = self._images.popitem(last=False)
+                    self._cached_bytes -= len(evicted or b'')
+        return content
+
+    def _encode_image(self, cid: str, thumbnail: bool) -> Optional[bytes]:
+        import numpy as np
+        from PIL import Image
+
+        match = _BLOB.match(cid)
+        if match is None:
+            return None
+        if match.group(4) is not None:
+            index = int(match.group(4))
+            if index >= len(self.image_files):
+                return None
+            if not thumbnail:
+                with open(self.image_files[index], 'rb') as f:
+                    return f.read()
+            image = Image.open(self.image_files[index]).convert('RGB')
+        else:
+            # Smooth random color fields compress like photos rather than like noise
+            seed = int.from_bytes(hashlib.sha256(f"{self.profile.seed}:{cid}".encode()).digest()[:8], 'big')
+            grid = np.random.default_rng(seed).integers(0, 256, (6, 6, 3), dtype=np.uint8)
+            image = Image.fromarray(grid).resize(self._blob_size(cid), Image.BICUBIC)
+        if thumbnail:
+            image.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        return buffer.getvalue()
+
+
+def _jwt(did: str, scope: str, lifetime: int) -> str:
+    """Return an unsigned JWT; the client only reads its payload"""
+    def encode(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b'=').decode()
+
+    now = int(time.time())
+    payload = {"scope": scope, "sub": did, "iat": now, "exp": now + lifetime}
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode(payload)}.bG9hZGdlbg"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.standin.handle(self, self.server.service, 'GET')
+
+    def do_HEAD(self):
+        self.server.standin.handle(self, self.server.service, 'HEAD')
+
+    def do_POST(self):
+        self.server.standin.handle(self, self.server.service, 'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer:
+    """
+    Local HTTP stand-in for the appview and cdn.bsky.app, serving a SyntheticCorpus
+
+    Entering the server starts it and points image URL resolution at it; leaving stops
+    it and restores the CDN URL.
+    """
+
+    def __init__(self, corpus: SyntheticCorpus, appview: FaultProfile = FaultProfile(),
+                 cdn: FaultProfile = FaultProfile(), host: str = '127.0.0.1', port: int = 0):
+        """
+        Args:
+            corpus: Posts and images to serve
+            appview: Faults injected into XRPC responses
+            cdn: Faults injected into image responses
+            host: Interface to listen on
+            port: Port of the appview; the CDN listens on the next one. 0 picks free ports
+        """
+        self.corpus = corpus
+        self.faults = {'appview': appview, 'cdn': cdn}
+        self._httpds = {}
+        for offset, service in enumerate(self.faults):
+            httpd = ThreadingHTTPServer((host, port + offset if port else 0), _Handler)
+            httpd.daemon_threads = True
+            httpd.standin = self
+            httpd.service = service
+            self._httpds[service] = httpd
+        self._threads: List[threading.Thread] = []
+        self._previous_cdn_url: Optional[str] = None
+        self._lock = threading.Lock()
+        self._rng = random.Random(corpus.profile.seed)
+        self.in_flight = Counter()
+        self.max_in_flight = Counter()
+        self.requests = Counter()
+        self.bytes_sent = Counter()
+        self.statuses: Dict[str, Counter] = {'appview': Counter(), 'cdn': Counter()}
+
+    def _url(self, service: str) -> str:
+        host, port = self._httpds[service].server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def xrpc_url(self) -> str:
+        return f"{self._url('appview')}/xrpc"
+
+    @property
+    def cdn_url(self) -> str:
+        return self._url('cdn')
+
+    def start(self):
+        """Serve requests from background threads"""
+        if not self._threads:
+            for httpd in self._httpds.values():
+                thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        if self._threads:
+            for httpd in self._httpds.values():
+                httpd.shutdown()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        for httpd in self._httpds.values():
+            httpd.server_close()
+
+    def install(self):
+        """Resolve image URLs to this server's CDN paths"""
+        from .post_context import set_cdn_url
+
+        if self._previous_cdn_url is None:
+            self._previous_cdn_url = set_cdn_url(self.cdn_url)
+
+    def uninstall(self):
+        from .post_context import set_cdn_url
+
+        if self._previous_cdn_url is not None:
+            set_cdn_url(self._previous_cdn_url)
+            self._previous_cdn_url = None
+
+    def __enter__(self) -> "StandInServer":
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+        self.stop()
+
+    def client(self) -> "Client":
+        """Return an atproto Client logged in against this server"""
+        from atproto import Client
+
+        client = Client(base_url=self.xrpc_url)
+        client.login(LOGIN_HANDLE, "loadgen")
+        return client
+
+    def handle(self, handler: BaseHTTPRequestHandler, service: str, method: str):
+        """Answer one request, injecting the faults of its service"""
+        path, _, query = handler.path.partition('?')
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            handler.rfile.read(length)
+        faults = self.faults[service]
+        with self._lock:
+            self.requests[service] += 1
+            self.in_flight[service] += 1
+            self.max_in_flight[service] = max(self.max_in_flight[service], self.in_flight[service])
+            overloaded = faults.capacity is not None and self.in_flight[service] > faults.capacity
+            draw = self._rng.random()
+            delay = (faults.latency_ms / 1000 * self._rng.lognormvariate(0, faults.latency_sigma)
+                     if faults.latency_ms else 0)
+        status = 500
+        try:
+            if overloaded:
+                status, content_type, body = 429, *_xrpc_error("RateLimitExceeded", "Over capacity")
+            else:
+                if delay:
+                    time.sleep(delay)
+                if draw < faults.throttle_rate:
+                    status, content_type, body = 429, *_xrpc_error("RateLimitExceeded", "Rate limit exceeded")
+                elif draw < faults.throttle_rate + faults.error_rate:
+                    status, content_type, body = 500, *_xrpc_error("InternalServerError", "Injected error")
+                else:
+                    status, content_type, body = self._route(service, path, parse_qs(query))
+            handler.send_response(status)
+            handler.send_header('Content-Type', content_type)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            if method != 'HEAD':
+                handler.wfile.write(body)
+                with self._lock:
+                    self.bytes_sent[service] += len(body)
+        finally:
+            with self._lock:
+                self.in_flight[service] -= 1
+                self.statuses[service][status] += 1
+
+    def _route(self, service: str, path: str, params: Dict[str, List[str]]) -> Tuple[int, str, bytes]:
+        if service == 'cdn':
+            match = _IMAGE_PATH.match(path)
+            image = match and self.corpus.image(match.group(3), thumbnail=match.group(1) == 'feed_thumbnail')
+            if not image:
+                return 404, 'text/plain', b'Not Found'
+            return 200, 'image/jpeg', image
+
+        def param(name):
+            return params.get(name, [''])[0]
+
+        if path in ('/xrpc/com.atproto.server.createSession', '/xrpc/com.atproto.server.refreshSession'):
+            return _json(200, {"did": LOGIN_DID, "handle": LOGIN_HANDLE, "active": True,
+                               "accessJwt": _jwt(LOGIN_DID, "com.atproto.access", 3600),
+                               "refreshJwt": _jwt(LOGIN_DID, "com.atproto.refresh", 86400)})
+        if path == '/xrpc/app.bsky.actor.getProfile':
+            actor = param('actor')
+            did = LOGIN_DID if actor in (LOGIN_HANDLE, LOGIN_DID) else f"did:plc:{actor.split('.')[0]}"
+            return _json(200, {"did": did, "handle": actor})
+        if path == '/xrpc/com.atproto.identity.resolveHandle':
+            match = _HANDLE.match(param('handle').lower())
+            if match is None or int(match.group(1)) >= self.corpus.profile.authors:
+                return (400, *_xrpc_error("InvalidRequest", "Unable to resolve handle"))
+            return _json(200, {"did": self.corpus.author(int(match.group(1)))[1]})
+        if path == '/xrpc/com.atproto.repo.getRecord':
+            exists, record = self.corpus.lookup(param('repo'), param('rkey'))
+            if record is None:
+                message = "Could not locate record" if exists else "Unknown repo or record key"
+                return (400, *_xrpc_error("RecordNotFound", message))
+            return _json(200, record)
+        return (501, *_xrpc_error("MethodNotImplemented", f"{path} is not served by the stand-in"))
+
+    def stats(self) -> Dict[str, dict]:
+        """Return requests, statuses, peak concurrency and bytes sent per service"""
+        with self._lock:
+            return {service: {
+                'requests': self.requests[service],
+                'statuses': dict(sorted(self.statuses[service].items())),
+                'max_in_flight': self.max_in_flight[service],
+                'bytes_sent': self.bytes_sent[service],
+            } for service in self.faults}
+
+
+def _json(status: int, obj) -> Tuple[int, str, bytes]:
+    return status, 'application/json', json.dumps(obj).encode('utf-8')
+
+
+def _xrpc_error(error: str, message: str) -> Tuple[str, bytes]:
+    return 'application/json', json.dumps({"error": error, "message": message}).encode('utf-8')
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _add_profile_args(parser: argparse.ArgumentParser):
+    defaults = LoadProfile()
+    parser.add_argument("--posts", type=int, default=defaults.posts)
+    parser.add_argument("--authors", type=int, default=defaults.authors)
+    parser.add_argument("--text_words", type=float, nargs=2, metavar=("MEAN", "SIGMA"),
+                        default=(defaults.text_words_mean, defaults.text_words_sigma),
+                        help="Log-normal distribution of words per post")
+    parser.add_argument("--hashtag_density", type=float, default=defaults.hashtag_density)
+    parser.add_argument("--term_hit_rate", type=float, default=defaults.term_hit_rate)
+    parser.add_argument("--images_per_post", type=float, nargs="+", default=defaults.images_per_post,
+                        help="Weights of 0, 1, 2, ... images per post")
+    parser.add_argument("--image_sides", type=int, nargs=2, metavar=("MIN", "MAX"), default=defaults.image_sides)
+    parser.add_argument("--duplicate_blob_ratio", type=float, default=defaults.duplicate_blob_ratio)
+    parser.add_argument("--image_dir", type=str, help="Directory of images served for --image_file_rate of images")
+    parser.add_argument("--image_file_rate", type=float, default=defaults.image_file_rate)
+    parser.add_argument("--deleted_rate", type=float, default=defaults.deleted_rate)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    for service in ("appview", "cdn"):
+        parser.add_argument(f"--{service}_latency_ms", type=float, default=0.0)
+        parser.add_argument(f"--{service}_error_rate", type=float, default=0.0)
+        parser.add_argument(f"--{service}_throttle_rate", type=float, default=0.0)
+        parser.add_argument(f"--{service}_capacity", type=int,
+                            help="Requests in flight beyond which the service answers 429")
+
+
+def _build_server(args, terms: Sequence[str], port: int = 0) -> StandInServer:
+    profile = LoadProfile(
+        posts=args.posts, authors=args.authors, text_words_mean=args.text_words[0],
+        text_words_sigma=args.text_words[1], hashtag_density=args.hashtag_density,
+        term_hit_rate=args.term_hit_rate, images_per_post=tuple(args.images_per_post),
+        image_sides=tuple(args.image_sides), duplicate_blob_ratio=args.duplicate_blob_ratio,
+        image_file_rate=args.image_file_rate, deleted_rate=args.deleted_rate, seed=args.seed)
+    image_files = []
+    if args.image_dir:
+        image_files = [os.path.join(args.image_dir, name) for name in os.listdir(args.image_dir)
+                       if name.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    faults = {service: FaultProfile(
+        latency_ms=getattr(args, f"{service}_latency_ms"), error_rate=getattr(args, f"{service}_error_rate"),
+        throttle_rate=getattr(args, f"{service}_throttle_rate"), capacity=getattr(args, f"{service}_capacity"))
+        for service in ("appview", "cdn")}
+    return StandInServer(SyntheticCorpus(profile, terms, image_files), port=port, **faults)
+
+
+def _serve(args):
+    terms = load_terms(args.terms_dir) if args.terms_dir else []
+    server = _build_server(args, terms, args.port)
+    if args.urls_csv:
+        import csv
+
+        with open(args.urls_csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["URL"])
+            writer.writerows([url] for url in server.corpus.urls())
+    server.start()
+    print(f"Serving {args.posts} synthetic posts: XRPC at {server.xrpc_url}, CDN at {server.cdn_url}")
+    print(f"Point the CLIs at it with APPVIEW_URL={server.xrpc_url} CDN_URL={server.cdn_url} "
+          f"(or --appview_url / --cdn_url)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Stand-in: {server.stats()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+def _run(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .automated_labeler import AutomatedLabeler
+    from .cascade import ImageCascade
+    from .concurrency import HostLimiters
+    from .latency_budget import LatencyBudget
+    from .negative_cache import NegativeCache
+    from .policy_proposal_labeler import PolicyProposalLabeler
+    from .runner import LabelerRunner, _moderate_or_error
+
+    with _build_server(args, load_terms(args.labeler_inputs_dir)) as server:
+        client = server.client()
+        factories = {"automated": AutomatedLabeler, "policy": PolicyProposalLabeler}
+        cascade = ImageCascade(args.cascade_margin) if args.cascade_margin is not None else None
+        labelers = [factories[name](client, args.labeler_inputs_dir, cascade=cascade) for name in args.labelers]
+        latency_budget = LatencyBudget(args.latency_budget) if args.latency_budget else None
+        negative_cache = NegativeCache() if args.negative_cache else None
+        runner = LabelerRunner(client, labelers, latency_budget=latency_budget, negative_cache=negative_cache)
+        limiters = HostLimiters() if args.adaptive_concurrency else None
+        if limiters is not None:
+            limiters.install()
+
+        def moderate(url):
+            start = time.perf_counter()
+            _, _, labeler_errors, error = _moderate_or_error(runner, url)
+            if error is None and labeler_errors:
+                error = '; '.join(f"{name}: {e}" for name, e in labeler_errors.items())
+            return time.perf_counter() - start, error
+
+        latencies, errors = [], Counter()
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(args.threads) as pool:
+                for _ in range(args.passes):
+                    for elapsed, error in pool.map(moderate, server.corpus.urls()):
+                        latencies.append(elapsed)
+                        if error is not None:
+                            errors[error.split('(')[0]] += 1
+        finally:
+            if limiters is not None:
+                limiters.uninstall()
+        seconds = time.perf_counter() - start
+
+        report = {
+            'posts': len(latencies),
+            'threads': args.threads,
+            'seconds': round(seconds, 3),
+            'posts_per_second': round(len(latencies) / seconds, 2) if seconds else 0,
+            'latency': {name: round(_percentile(latencies, fraction), 4)
+                        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+            'errors': dict(errors),
+            'runner': runner.stats(),
+            'server': server.stats(),
+        }
+        if latency_budget is not None:
+            report['latency_budget'] = latency_budget.stats()
+        if cascade is not None:
+            report['cascade'] = cascade.stats()
+        if negative_cache is not None:
+            report['negative_cache'] = negative_cache.stats()
+        if limiters is not None:
+            report['concurrency_limits'] = limiters.stats()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    """Main function for serving synthetic posts or load-testing the labelers against them"""
+    parser = argparse.ArgumentParser(description="Synthetic load against a local stand-in appview and CDN")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Serve synthetic posts until interrupted")
+    _add_profile_args(serve)
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--terms_dir", type=str, help="Labeler inputs directory the term hits are drawn from")
+    serve.add_argument("--urls_csv", type=str, help="CSV file the post URLs are written to (URL column)")
+
+    run = commands.add_parser("run", help="Moderate every synthetic post and report throughput and latency")
+    _add_profile_args(run)
+    run.add_argument("labeler_inputs_dir", type=str)
+    run.add_argument("--labelers", nargs="+", choices=["automated", "policy"], default=["automated", "policy"])
+    run.add_argument("--threads", type=int, default=8, help="Number of posts moderated concurrently")
+    run.add_argument("--passes", type=int, default=1, help="Times the corpus is moderated")
+    run.add_argument("--adaptive_concurrency", action="store_true",
+                     help="Limit in-flight requests per host, adapting the limit to latency and 429s")
+    run.add_argument("--latency_budget", type=float, help="Seconds allowed per post")
+    run.add_argument("--negative_cache", action="store_true",
+                     help="Skip deleted posts and failed blobs seen earlier in the run")
+    run.add_argument("--cascade_margin", type=float,
+                     help="Screen images by their thumbnail; fetch the fullsize image only within this distance of a match")
+    run.add_argument("--output", type=str, help="JSON file the report is written to")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        _serve(args)
+    else:
+        _run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Negative cache of deleted posts and failed image blobs
+
+A post that was deleted, an account that blocks the labeler, or a blob that times out or
+cannot be decoded fails the same way on every retry and re-run, each time at full timeout
+cost. The negative cache remembers such failures, keyed by post (author and record key
+from the post URL) or blob (CDN variant and CID, since a thumbnail that fails says nothing
+about the fullsize image), with the reason of the failure:
+
+    not-found     404/410, or a RecordNotFound error from the appview
+    forbidden     403, or an XRPC error for a blocked, taken-down or deactivated account
+    timeout       the request timed out
+    undecodable   the blob was downloaded but is not an image we can decode
+
+A 401 means our own session is invalid, not that the post is unavailable, so it is never
+cached. Each reason has its own time to live, so a timeout is retried after minutes while a
+deleted post stays skipped for days. Fetch paths consult the cache first and
+short-circuit on a hit; hits are counted per reason.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+NOT_FOUND = "not-found"
+FORBIDDEN = "forbidden"
+TIMEOUT = "timeout"
+UNDECODABLE = "undecodable"
+
+DEFAULT_TTLS = {
+    NOT_FOUND: 7 * 24 * 3600,
+    FORBIDDEN: 24 * 3600,
+    TIMEOUT: 15 * 60,
+    UNDECODABLE: 30 * 24 * 3600,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    key TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    expires_at REAL NOT NULL
+)
+"""
+
+_CDN_BLOB = re.compile(r'/img/([^/]+)/plain/([^/]+)/([^/@?]+)')
+_NOT_FOUND_ERRORS = {"RecordNotFound", "NotFound", "PostNotFound"}
+_FORBIDDEN_ERRORS = {"BlockedActor", "BlockedByActor", "AccountTakedown", "AccountDeactivated"}
+
+
+class NegativeCacheHit(Exception):
+    """Raised instead of fetching something that recently failed"""
+
+    def __init__(self, key: str, reason: str):
+        super().__init__(f"{key} skipped: {reason} (negative cache)")
+        self.key = key
+        self.reason = reason
+
+
+def post_key(url: str) -> str:
+    """
+    Return the cache key of a post URL: the author as written in the URL and the record key
+
+    The author is not resolved, as that would cost a request per post, so a post linked
+    once by handle and once by DID has two entries.
+    """
+    parts = url.rstrip("/").split("/")
+    author = parts[-3] if parts[-3].startswith("did:") else parts[-3].lower()
+    return f"post:{author}/{parts[-1]}"
+
+
+def blob_key(image_url: str) -> str:
+    """Return the cache key of an image URL: the CDN variant and blob CID for CDN URLs, else the URL"""
+    match = _CDN_BLOB.search(image_url)
+    return f"blob:{match.group(1)}/{match.group(3)}" if match else image_url
+
+
+def classify_status(status_code: int) -> Optional[str]:
+    """Return the failure reason of an HTTP status, or None if it should not be cached"""
+    if status_code in (404, 410):
+        return NOT_FOUND
+    if status_code == 403:
+        return FORBIDDEN
+    if status_code in (408, 504):
+        return TIMEOUT
+    return None
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """Return the failure reason of a fetch exception, or None if it should not be cached"""
+    response = getattr(error, 'response', None)
+    xrpc_error = getattr(getattr(response, 'content', None), 'error', None)
+    if xrpc_error in _NOT_FOUND_ERRORS:
+        return NOT_FOUND
+    if xrpc_error in _FORBIDDEN_ERRORS:
+        return FORBIDDEN
+    status_code = getattr(response, 'status_code', None)
+    if status_code is not None:
+        return classify_status(status_code)
+    if any('Timeout' in cls.__name__ for cls in type(error).__mro__):
+        return TIMEOUT
+    return None
+
+
+class NegativeCache:
+    """
+    SQLite-backed cache of recent fetch failures with per-reason TTLs
+
+    Like VerdictStore, the connection is opened lazily per process; it is shared by the
+    threads of a process.
+    """
+
+    def __init__(self, path: str = ':memory:', ttls: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.time):
+        """
+        Args:
+            path: SQLite database file, or ':memory:' for a cache that lasts one run
+            ttls: Seconds a failure is remembered, per reason; missing reasons use
+                DEFAULT_TTLS
+            clock: Time source
+        """
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.clock = clock
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.hits = {reason: 0 for reason in self.ttls}
+        self.recorded = {reason: 0 for reason in self.ttls}
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+            if self.path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a key
+
+        Returns:
+            The reason of the remembered failure, or None if there is none or it expired
+        """
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT reason, expires_at FROM failures WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= self.clock():
+                return None
+            self.hits[row[0]] = self.hits.get(row[0], 0) + 1
+            return row[0]
+
+    def check(self, key: str):
+        """Raise NegativeCacheHit if the key failed recently"""
+        reason = self.get(key)
+        if reason is not None:
+            raise NegativeCacheHit(key, reason)
+
+    def put(self, key: str, reason: str):
+        """Remember a failure for the TTL of its reason"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO failures (key, reason, expires_at) VALUES (?, ?, ?)',
+                         (key, reason, self.clock() + self.ttls[reason]))
+            conn.commit()
+            self.recorded[reason] = self.recorded.get(reason, 0) + 1
+
+    def record_error(self, key: str, error: BaseException) -> Optional[str]:
+        """Remember a fetch exception if it is a cacheable failure; return its reason"""
+        reason = classify_error(error)
+        if reason is not None:
+            self.put(key, reason)
+        return reason
+
+    def record_status(self, key: str, status_code: int) -> Optional[str]:
+        """Remember a failed HTTP status if it is cacheable; return its reason"""
+        reason = classify_status(status_code)
+        if reason is not None:
+            self.put(key, reason)
+        return reason
+
+    def forget(self, key: str):
+        """Drop a key, e.g. after a post was restored"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('DELETE FROM failures WHERE key = ?', (key,))
+            conn.commit()
+
+    def purge_expired(self) -> int:
+        """
+        Delete expired failures
+
+        Returns:
+            Number of failures deleted
+        """
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute('DELETE FROM failures WHERE expires_at <= ?', (self.clock(),))
+            conn.commit()
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        """Return live entries per reason and this process's hits and recorded failures"""
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT reason, COUNT(*) FROM failures WHERE expires_at > ? GROUP BY reason',
+                (self.clock(),)).fetchall()
+        return {
+            'entries': dict(rows),
+            'hits': dict(self.hits),
+            'recorded': dict(self.recorded),
+            'total_hits': sum(self.hits.values()),
+        }
+
+    def close(self):
+        """Close the database connection"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
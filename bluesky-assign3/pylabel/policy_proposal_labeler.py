@@ -8,38 +8,76 @@ techniques to identify inappropriate content patterns.
 The labeler attaches a "sexual-content" label to posts that match detection criteria.
 """
 
-from typing import List, Optional, Dict, Any, Set, Tuple
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Iterable, Set, Tuple
 import re
 import os
 import json
-import requests
-import numpy as np
 import time
-from perception import hashers
-from PIL import Image
-from io import BytesIO
-from atproto import Client
 
-from .label import post_from_url
+from .cascade import ImageCascade
+from .evaluation import EvaluationJournal, compute_metrics, pending_cases
+from .image_fingerprint import ImageFingerprinter, load_reference_sets, make_hasher, parse_hash
+from .latency_budget import BudgetExceeded, Deadline, LatencyBudget, download
+from .negative_cache import NegativeCache
+from .post_context import IMAGE_RESOLUTION_VERSION, PostContext, PostVerdict, resolve_image_urls
+from .profiling import stage as profile_stage
+from .text_fingerprint import NearDuplicateIndex, minhash
+from .verdict_store import VerdictStore, ruleset_hash
+
+# perception, PIL and requests are heavy imports; they are loaded by the code
+# paths that need them
+if TYPE_CHECKING:
+    from atproto import Client
+
+    from .account_aggregator import AccountAggregator
 
 # Define the label we'll use
 SEXUAL_CONTENT_LABEL = "sexual-content"
 
+# Patterns indicating more explicit content, matched against the lowercased text
+EXPLICIT_INDICATORS = [
+    re.compile(r'\b(?:sex|sexual|sexually)\b'),
+    re.compile(r'\b(?:nsfw|18\+|xxx)\b'),
+    re.compile(r'(?:🔞|🍑|🍆|💦)'),  # Emojis often used to indicate sexual content
+]
+
 class PolicyProposalLabeler:
     """
     Labeler implementation for unwanted sexual content
     This focuses on detecting sexually explicit text and image content that may be unwanted
     """
 
-    def __init__(self, client: Client, input_dir: str):
+    name = "policy-proposal"
+
+    def __init__(self, client: "Client", input_dir: str, verdict_store: Optional[VerdictStore] = None,
+                 account_aggregator: Optional["AccountAggregator"] = None,
+                 text_index: Optional[NearDuplicateIndex] = None,
+                 latency_budget: Optional[LatencyBudget] = None,
+                 negative_cache: Optional[NegativeCache] = None,
+                 cascade: Optional[ImageCascade] = None):
         """
         Initialize the labeler with necessary components
         
         Args:
             client: AT Protocol client for accessing posts
             input_dir: Directory containing input files for the labeler
+            verdict_store: Optional store used to reuse verdicts of unchanged posts
+            account_aggregator: Optional aggregator that per-post verdicts are fed into
+            text_index: Optional near-duplicate index used to reuse text verdicts
+            latency_budget: Optional per-post time budget; image work that does not fit
+                in it is abandoned and the text verdict is returned alone
+            negative_cache: Optional cache of deleted or forbidden posts and failed image
+                blobs, which are skipped until their failure expires
+            cascade: Optional thumbnail-first image matching; fullsize images are only
+                fetched for thumbnails close to a reference hash
         """
         self.client = client
+        self.verdict_store = verdict_store
+        self.account_aggregator = account_aggregator
+        self.text_index = text_index
+        self.latency_budget = latency_budget
+        self.negative_cache = negative_cache
+        self.cascade = cascade
         self.input_dir = input_dir
         self.image_hash_threshold = 10  # Threshold for perceptual hash matching (lower = stricter)
         
@@ -63,6 +101,25 @@ class PolicyProposalLabeler:
             r'\b(?:policy|policies|guidelines|terms|rules|moderation|safety)\b',
             r'\b(?:report|reporting|flagging|harmful|abusive)\b'
         ]
+
+        # Compile every pattern once so the matchers can be shared read-only by worker processes
+        self._compile_patterns()
+
+        # Every label this labeler can apply
+        self.label_values = {SEXUAL_CONTENT_LABEL}
+
+        # Version each moderation stage by the rules it uses, so stored verdicts are
+        # invalidated when (and only when) the relevant inputs change
+        image_rules = [self.image_hash_threshold,
+                       [reference.version() for reference in self.reference_sets],
+                       IMAGE_RESOLUTION_VERSION]
+        if self.cascade is not None:
+            image_rules.append(self.cascade.version())
+        self.ruleset_versions = {
+            'text': ruleset_hash(sorted(self.primary_terms), self.solicitation_patterns,
+                                 self.legitimate_context_patterns),
+            'image': ruleset_hash(*image_rules),
+        }
     
     def _load_dictionaries(self):
         """Load dictionaries of terms from files or define them inline"""
@@ -84,10 +141,24 @@ class PolicyProposalLabeler:
         except Exception as e:
             print(f"Warning: Could not load sexual terms file: {e}")
     
+    def _compile_patterns(self):
+        """Compile the term dictionary and context patterns into reusable regex objects"""
+        escaped_terms = [re.escape(term) for term in sorted(self.primary_terms)]
+        self.term_patterns = [re.compile(r'\b' + term + r'\b') for term in escaped_terms]
+        self.any_term_pattern = re.compile(r'\b(?:' + '|'.join(escaped_terms) + r')\b') if escaped_terms else re.compile(r'(?!)')
+        self.solicitation_regexes = [re.compile(pattern) for pattern in self.solicitation_patterns]
+        self.legitimate_context_regexes = [re.compile(pattern) for pattern in self.legitimate_context_patterns]
+    
     def _init_image_database(self):
-        """Initialize the image database for matching potentially inappropriate images"""
-        self.image_hasher = hashers.PHash()
-        self.known_nsfw_hashes = []
+        """
+        Initialize the image database for matching potentially inappropriate images
+        
+        nsfw_image_hashes.json holds a plain list of PHashes, or reference sets of any
+        supported hash type (see image_fingerprint.load_reference_sets). PHash lists match
+        images with fewer than image_hash_threshold differing bits.
+        """
+        self.image_hasher = make_hasher('phash')
+        self.reference_sets = []
         
         # Ideally, load hashes from a database file
         # For this implementation, we'll use a sample approach
@@ -95,12 +166,16 @@ class PolicyProposalLabeler:
             # Try to load image hashes from a sample file if it exists
             sample_hashes_file = os.path.join(self.input_dir, "nsfw_image_hashes.json")
             if os.path.exists(sample_hashes_file):
-                with open(sample_hashes_file, 'r') as f:
-                    self.known_nsfw_hashes = json.load(f)
+                self.reference_sets = load_reference_sets(
+                    sample_hashes_file, 'phash', (self.image_hash_threshold - 1) / self.image_hasher.hash_length)
             else:
                 print("No image hash database found. Will rely on other detection methods.")
         except Exception as e:
             print(f"Warning: Could not load image hash database: {e}")
+        
+        # Decode each image once and compute every hash type the reference sets use
+        self.image_hash_types = {reference.hash_type for reference in self.reference_sets} or {'phash'}
+        self.fingerprinter = ImageFingerprinter(self.image_hash_types)
     
     def _check_for_hashtags(self, text: str) -> bool:
         """
@@ -136,9 +211,8 @@ class PolicyProposalLabeler:
         text_lower = text.lower()
         
         # Check for primary sexual terms
-        for term in self.primary_terms:
-            if re.search(r'\b' + re.escape(term) + r'\b', text_lower):
-                return True
+        if self.any_term_pattern.search(text_lower):
+            return True
         
         # Check for hashtags containing sexual terms
         if self._check_for_hashtags(text):
@@ -158,8 +232,8 @@ class PolicyProposalLabeler:
         """
         text_lower = text.lower()
         
-        for pattern in self.solicitation_patterns:
-            if re.search(pattern, text_lower):
+        for pattern in self.solicitation_regexes:
+            if pattern.search(text_lower):
                 return True
                 
         return False
@@ -176,8 +250,8 @@ class PolicyProposalLabeler:
         """
         text_lower = text.lower()
         
-        for pattern in self.legitimate_context_patterns:
-            if re.search(pattern, text_lower):
+        for pattern in self.legitimate_context_regexes:
+            if pattern.search(text_lower):
                 return True
                 
         return False
@@ -238,8 +312,7 @@ class PolicyProposalLabeler:
         text_lower = text.lower()
         
         # Count occurrences of sexual terms
-        term_count = sum(1 for term in self.primary_terms 
-                         if re.search(r'\b' + re.escape(term) + r'\b', text_lower))
+        term_count = sum(1 for pattern in self.term_patterns if pattern.search(text_lower))
         
         if term_count > 5:
             score += 2
@@ -256,18 +329,29 @@ class PolicyProposalLabeler:
             score += 1
             
         # Check for patterns indicating more explicit content
-        explicit_indicators = [
-            r'\b(?:sex|sexual|sexually)\b',
-            r'\b(?:nsfw|18\+|xxx)\b',
-            r'(?:🔞|🍑|🍆|💦)'  # Emojis often used to indicate sexual content
-        ]
-        
-        for pattern in explicit_indicators:
-            if re.search(pattern, text_lower):
-                score += 1
+        score += sum(self._explicit_markers(text_lower))
                 
         return min(score, 5)  # Cap at 5
     
+    def _explicit_markers(self, text_lower: str) -> Tuple[bool, ...]:
+        """Return which EXPLICIT_INDICATORS match a lowercased text"""
+        return tuple(bool(pattern.search(text_lower)) for pattern in EXPLICIT_INDICATORS)
+    
+    def _decisive_features(self, text: str) -> Tuple[bool, ...]:
+        """
+        Return the cheap text features any of which can flip _analyze_post_content
+        
+        Two texts with the same features differ at most in their explicit intensity,
+        so near-duplicates among them may share a verdict.
+        """
+        text_lower = text.lower()
+        return (len(text.split()) < 3,
+                bool(self.any_term_pattern.search(text_lower)),
+                self._check_for_hashtags(text),
+                self._indicates_solicitation(text),
+                self._indicates_legitimate_context(text),
+                *self._explicit_markers(text_lower))
+    
     def _extract_image_urls(self, post):
         """
         Extract image URLs from a post
@@ -278,21 +362,7 @@ class PolicyProposalLabeler:
         Returns:
             List of image URLs found in the post
         """
-        image_urls = []
-        
-        # Check if post has embedded images
-        if hasattr(post, 'embed') and post.embed:
-            # Handle different embed types
-            if hasattr(post.embed, 'images'):
-                for img in post.embed.images:
-                    if hasattr(img, 'fullsize'):
-                        image_urls.append(img.fullsize)
-            elif hasattr(post.embed, 'media') and hasattr(post.embed.media, 'images'):
-                for img in post.embed.media.images:
-                    if hasattr(img, 'fullsize'):
-                        image_urls.append(img.fullsize)
-                        
-        return image_urls
+        return resolve_image_urls(post)
     
     def _analyze_image(self, image_url: str) -> bool:
         """
@@ -304,33 +374,75 @@ class PolicyProposalLabeler:
         Returns:
             True if the image is flagged as inappropriate, False otherwise
         """
+        return bool(self._image_verdict(image_url))
+    
+    def _image_verdict(self, image_url: str, deadline: Optional[Deadline] = None) -> Optional[bool]:
+        """
+        Analyze an image, distinguishing a clean image from one that could not be analyzed
+        
+        Args:
+            image_url: URL of the image to analyze
+            deadline: Deadline of the post being moderated, if any
+            
+        Returns:
+            True if the image is flagged, False if it is not, None if it could not be
+            downloaded or hashed
+            
+        Raises:
+            BudgetExceeded: If the deadline passed before the image was analyzed
+        """
         try:
             # Download the image
-            response = requests.get(image_url, timeout=10)
-            if response.status_code != 200:
+            with profile_stage('download'):
+                content = download(image_url, deadline, timeout=10, negative_cache=self.negative_cache)
+            if content is None:
                 print(f"Failed to download image: {image_url}")
-                return False
+                return None
                 
-            # Process the image
-            img = Image.open(BytesIO(response.content))
-            
-            # Compute perceptual hash
-            img_hash = self.image_hasher.compute(img)
-            
-            # Compare with known NSFW image hashes
-            for known_hash in self.known_nsfw_hashes:
-                # Check if the hash is close enough to a known NSFW hash
-                if self.image_hasher.compare(img_hash, known_hash) < self.image_hash_threshold:
-                    return True
+            # Decode the image once and compute its perceptual hashes
+            with profile_stage('hash'):
+                fingerprint = self.fingerprinter.fingerprint(content)
             
             # Additional image analysis could be added here
             # For example, skin tone detection, pose detection, etc.
             
-            return False
+            # Compare with known NSFW image hashes
+            with profile_stage('match'):
+                return self._matches_known_fingerprint(fingerprint)
             
+        except BudgetExceeded:
+            raise
         except Exception as e:
+            if deadline is not None and deadline.expired():
+                raise BudgetExceeded() from e
             print(f"Error analyzing image {image_url}: {e}")
-            return False
+            return None
+    
+    def _matches_known_hash(self, img_hash) -> bool:
+        """
+        Compare a PHash with the known NSFW image hashes of that type
+        
+        Args:
+            img_hash: PHash string or vector computed by self.image_hasher
+            
+        Returns:
+            True if the hash is close enough to a known NSFW hash, False otherwise
+        """
+        if isinstance(img_hash, str):
+            img_hash = parse_hash('phash', img_hash)
+        return self._matches_known_fingerprint({'phash': img_hash})
+    
+    def _matches_known_fingerprint(self, fingerprint: Dict[str, Any]) -> bool:
+        """
+        Compare an image fingerprint with every reference set of known NSFW images
+        
+        Args:
+            fingerprint: Hash type -> hash vector, from self.fingerprinter
+            
+        Returns:
+            True if any reference set matches the hash of its type, False otherwise
+        """
+        return any(reference.matches(fingerprint) for reference in self.reference_sets)
     
     def _analyze_post_images(self, post) -> bool:
         """
@@ -342,135 +454,202 @@ class PolicyProposalLabeler:
         Returns:
             True if any image is flagged as inappropriate, False otherwise
         """
-        # Extract image URLs from the post
-        image_urls = self._extract_image_urls(post)
+        return bool(self._moderate_images(PostContext(post.uri, post, self.fingerprinter))[0])
+    
+    def _moderate_text(self, text: str) -> List[str]:
+        """
+        Text stage of moderation
         
-        # If no images, no need to label based on images
-        if not image_urls:
-            return False
+        With a near-duplicate index, the verdict of a recently scored text that is at
+        least the index's minimum similarity is reused instead of scoring the text again,
+        as long as it was scored under the same text rules and has the same decisive
+        features (see _decisive_features): a one-token edit that adds a sexual term, a
+        solicitation phrase, a legitimate-context word or an "18+" must not reuse a stale
+        verdict. Only the explicit intensity scoring is skipped.
+        
+        Args:
+            text: Post text
             
-        # Analyze each image
-        for image_url in image_urls:
-            if self._analyze_image(image_url):
-                return True
+        Returns:
+            List containing the label if the text should be labeled, else an empty list
+        """
+        if self.text_index is None:
+            return [SEXUAL_CONTENT_LABEL] if self._analyze_post_content(text) else []
+        
+        signature = minhash(text, self.text_index.num_perm)
+        key = (self.ruleset_versions['text'], self._decisive_features(text))
+        verdict = self.text_index.lookup(signature, key=key)
+        if verdict is None:
+            verdict = [SEXUAL_CONTENT_LABEL] if self._analyze_post_content(text) else []
+            self.text_index.add(signature, verdict, key=key)
+        return list(verdict)
+    
+    def _moderate_images(self, context: PostContext) -> Tuple[List[str], bool]:
+        """
+        Image stage of moderation
+        
+        Args:
+            context: Post context the images are read from, so they are downloaded and
+                decoded once however many labelers check them; with a cascade, images
+                are screened by their thumbnail first
+            
+        Returns:
+            Tuple of (labels, complete) where complete is False if an image could not be
+            analyzed and no other image was flagged
+            
+        Raises:
+            BudgetExceeded: If the deadline passed before every image was analyzed
+        """
+        complete = True
+        
+        # If no images, no need to label based on images
+        for image_url in context.image_urls():
+            context.check_deadline()
+            if self.cascade is not None:
+                matched = self.cascade.match(context, image_url, self.reference_sets, self.image_hash_types)
+            else:
+                fingerprint = context.fingerprint(image_url, self.image_hash_types)
+                with profile_stage('match'):
+                    matched = None if fingerprint is None else self._matches_known_fingerprint(fingerprint)
+            if matched is None:
+                complete = False
+            elif matched:
+                return [SEXUAL_CONTENT_LABEL], True
                 
-        return False
+        return [], complete
     
     def moderate_post(self, url: str) -> Optional[str]:
         """
         Apply moderation to the post specified by the given URL
         
+        With a latency budget, image work is abandoned when the budget runs out and the
+        text verdict is returned alone; the budget records the post as degraded.
+        
         Args:
             url: URL to the Bluesky post
             
         Returns:
             Label to apply, or None if no label should be applied
         """
+        return self.moderate_post_verdict(url)[0]
+    
+    def moderate_post_verdict(self, url: str) -> PostVerdict:
+        """
+        Moderate a post like moderate_post and report whether the verdict is degraded
+        
+        Args:
+            url: URL to the Bluesky post
+            
+        Returns:
+            PostVerdict with the label or None, whether it is the text verdict alone, and
+            the post's URI and CID
+        """
+        deadline = self.latency_budget.deadline() if self.latency_budget is not None else None
         try:
             # Fetch the post content
-            post = post_from_url(self.client, url)
+            context = PostContext.fetch(self.client, url, self.fingerprinter, deadline, self.negative_cache,
+                                        probe_fullsize=self.cascade is None)
+            label = self.moderate_context(context)
             
-            if not post or not hasattr(post, 'value'):
-                print(f"Warning: Could not retrieve post {url}")
-                return None
-                
-            # Check text content if available
-            if hasattr(post.value, 'text'):
-                post_text = post.value.text
-                if self._analyze_post_content(post_text):
-                    return SEXUAL_CONTENT_LABEL
-            
-            # Check image content if available
-            if self._analyze_post_images(post.value):
-                return SEXUAL_CONTENT_LABEL
-                
-            return None
+            if self.latency_budget is not None:
+                self.latency_budget.record(url, deadline, context.degraded)
+            return context.verdict(label)
                 
         except Exception as e:
             print(f"Error moderating post {url}: {e}")
+            return PostVerdict(None)
+    
+    def moderate_context(self, context: PostContext) -> Optional[str]:
+        """
+        Apply moderation to a fetched post, reading its text and images from the context
+        
+        With a verdict store, the text and image verdicts of an unchanged post are reused
+        as long as the rules of the corresponding stage have not changed. With an account
+        aggregator, the verdict is also counted towards the author's account-level rules.
+        If the context's deadline passes during the image stage, the text verdict is
+        returned alone and the context is marked degraded.
+        
+        Args:
+            context: Post context
+            
+        Returns:
+            Label to apply, or None if no label should be applied
+        """
+        post = context.post
+        if not post or not hasattr(post, 'value'):
+            print(f"Warning: Could not retrieve post {context.url}")
             return None
+            
+        label = None
+        
+        # Check text content if available
+        if hasattr(post.value, 'text'):
+            post_text = post.value.text
+            if self._run_stage(post, 'text', lambda: (self._moderate_text(post_text), True)):
+                label = SEXUAL_CONTENT_LABEL
+        
+        # Check image content if available, unless the time budget runs out first
+        try:
+            if label is None and self._run_stage(post, 'image', lambda: self._moderate_images(context)):
+                label = SEXUAL_CONTENT_LABEL
+        except BudgetExceeded:
+            context.degraded = True
+        
+        # Count the verdict towards the author's account-level rules; a degraded verdict is
+        # incomplete, so the post is counted when it is rechecked
+        if self.account_aggregator is not None and not context.degraded:
+            self.account_aggregator.record_post(post, [label] if label else [])
+            
+        return label
+    
+    def _run_stage(self, post, stage: str, compute) -> List[str]:
+        """
+        Run a moderation stage, going through the verdict store if one is configured
+        
+        Args:
+            post: Bluesky post object
+            stage: Stage name ('text' or 'image')
+            compute: Callable returning (labels, complete) for the stage
+            
+        Returns:
+            List of labels produced by the stage
+        """
+        with profile_stage(stage):
+            if self.verdict_store is None:
+                return compute()[0]
+            return self.verdict_store.cached(self.name, post, stage, self.ruleset_versions[stage], compute)
     
-    def test_labeler(self, test_posts: List[Dict[str, str]]) -> Dict[str, Any]:
+    def test_labeler(self, test_posts: Iterable[Dict[str, str]],
+                     journal: Optional[EvaluationJournal] = None,
+                     include_results: bool = True) -> Dict[str, Any]:
         """
         Test the labeler on a list of posts
         
         Args:
-            test_posts: List of dictionaries with 'url' and 'expected_label' keys
+            test_posts: Iterable of dictionaries with 'url' and 'expected_label' keys
+            journal: Optional journal that results are appended to as they finish; posts
+                already in the journal are skipped, so an interrupted run can be resumed
+            include_results: Include the per-URL success map in the returned metrics
             
         Returns:
             Dictionary with test results and metrics
         """
-        results = {}
-        true_positives = 0
-        false_positives = 0
-        false_negatives = 0
-        true_negatives = 0
+        if journal is None:
+            journal = EvaluationJournal()
         
-        # Track processing times
-        processing_times = []
-        
-        for post in test_posts:
-            url = post['url']
-            expected_label = post.get('expected_label')
-            
+        cases = ((post['url'], post.get('expected_label')) for post in test_posts)
+        for url, expected_label in pending_cases(cases, journal):
             # Time the processing
             start_time = time.time()
-            actual_label = self.moderate_post(url)
+            verdict = self.moderate_post_verdict(url)
             end_time = time.time()
-            processing_times.append(end_time - start_time)
-            
-            # Determine if this was a success
-            success = (actual_label == expected_label) or \
-                    (actual_label is None and expected_label is None)
-                    
-            results[url] = success
-            
-            # Update confusion matrix
-            if expected_label and actual_label == expected_label:
-                true_positives += 1
-            elif expected_label and actual_label != expected_label:
-                false_negatives += 1
-            elif not expected_label and actual_label:
-                false_positives += 1
-            else:
-                true_negatives += 1
             
-            if not success:
+            actual_label = verdict.labels
+            record = journal.append(url, expected_label, actual_label, end_time - start_time, verdict.degraded)
+            if verdict.degraded:
+                print(f"Degraded verdict for {url}; it stays pending in the journal")
+            elif not record['success']:
                 print(f"Test failed for {url}: expected {expected_label}, got {actual_label}")
         
-        # Calculate metrics
-        total = len(results)
-        accuracy = sum(1 for success in results.values() if success) / total if total > 0 else 0
-        
-        precision = true_positives / (true_positives + false_positives) if (true_positives + false_positives) > 0 else 0
-        recall = true_positives / (true_positives + false_negatives) if (true_positives + false_negatives) > 0 else 0
-        f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0
-        
-        # Calculate processing time statistics
-        avg_time = np.mean(processing_times) if processing_times else 0
-        max_time = np.max(processing_times) if processing_times else 0
-        min_time = np.min(processing_times) if processing_times else 0
-        std_time = np.std(processing_times) if processing_times else 0
-        
-        # Prepare the final metrics dictionary
-        metrics = {
-            "results": results,
-            "accuracy": accuracy,
-            "precision": precision,
-            "recall": recall,
-            "f1": f1,
-            "confusion_matrix": {
-                "true_positives": true_positives,
-                "false_positives": false_positives,
-                "false_negatives": false_negatives,
-                "true_negatives": true_negatives
-            },
-            "performance": {
-                "avg_processing_time": avg_time,
-                "max_processing_time": max_time,
-                "min_processing_time": min_time,
-                "std_processing_time": std_time
-            }
-        }
-        
-        return metrics
\ No newline at end of file
+        # Calculate metrics by streaming the journal
+        return compute_metrics(journal.iter_records(), include_results=include_results)
@@ -0,0 +1,287 @@
+"""Per-post context shared by every labeler that moderates the post
+
+A PostContext is built once per post: the post is fetched once, its image URLs are
+resolved once, and each image is downloaded, decoded and hashed at most once no matter
+how many labelers read it. Images are keyed by URL and, after download, by the digest of
+their bytes, so the same blob attached twice (or served under two URLs) is decoded once.
+A labeler asking for hash types another labeler did not need reuses the decoded pixels.
+
+Image URLs come from the post record's blob references (the CDN fullsize image when it
+exists, the thumbnail otherwise), or from hydrated image views when the embed has them.
+With probe_fullsize=False the fullsize URL is used without the HEAD request that checks it
+exists; an ImageCascade reads the thumbnail first and falls back to it when the fullsize
+image turns out to be missing.
+The CDN host is cdn.bsky.app unless the CDN_URL environment variable or set_cdn_url()
+points it elsewhere, e.g. at the load generator's stand-in server.
+
+With a NegativeCache, a post that was recently not found or forbidden is not fetched
+again (NegativeCacheHit), and blobs that failed to download or decode are skipped.
+"""
+
+import hashlib
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional
+
+from .concurrency import limit
+from .image_fingerprint import ImageFingerprinter
+from .label import post_from_url
+from .latency_budget import BudgetExceeded, Deadline, download
+from .negative_cache import UNDECODABLE, NegativeCache, blob_key, post_key
+from .profiling import stage
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+CDN_URL = os.getenv("CDN_URL", "https://cdn.bsky.app").rstrip("/")
+CDN_FULLSIZE = "{cdn}/img/feed_fullsize/plain/{did}/{cid}@jpeg"
+CDN_THUMBNAIL = "{cdn}/img/feed_thumbnail/plain/{did}/{cid}@jpeg"
+
+# Part of every image ruleset version; bump when resolve_image_urls finds different images
+IMAGE_RESOLUTION_VERSION = 2
+
+
+def set_cdn_url(url: str) -> str:
+    """
+    Point image URL resolution at another CDN host
+
+    Returns:
+        The previous CDN URL, to restore it later
+    """
+    global CDN_URL
+    previous, CDN_URL = CDN_URL, url.rstrip("/")
+    return previous
+
+
+def thumbnail_url(image_url: str) -> Optional[str]:
+    """Return the feed thumbnail URL of a CDN fullsize image URL, or None if it has none"""
+    if '/img/feed_fullsize/' not in image_url:
+        return None
+    return image_url.replace('/img/feed_fullsize/', '/img/feed_thumbnail/', 1)
+
+
+def _embedded_images(record) -> List[Any]:
+    embed = getattr(record, 'embed', None)
+    if not embed:
+        return []
+    images = getattr(embed, 'images', None)
+    if images is None:
+        images = getattr(getattr(embed, 'media', None), 'images', None)
+    return list(images or [])
+
+
+def resolve_image_urls(post, deadline: Optional[Deadline] = None, probe_fullsize: bool = True) -> List[str]:
+    """
+    Resolve the URLs of the images attached to a post
+
+    Args:
+        post: Bluesky post as returned by post_from_url
+        deadline: Deadline of the post being moderated, if any; bounds the HEAD requests
+        probe_fullsize: Whether to check with a HEAD request that the fullsize image
+            exists before choosing it over the thumbnail
+
+    Returns:
+        List of image URLs, in the order the images are attached
+    """
+    import requests
+
+    image_urls = []
+    record = getattr(post, 'value', post)
+    for image in _embedded_images(record):
+        # Hydrated views already carry the CDN URL
+        if getattr(image, 'fullsize', None):
+            image_urls.append(image.fullsize)
+            continue
+        ref = getattr(getattr(image, 'image', None), 'ref', None)
+        if ref is None or not hasattr(post, 'uri'):
+            continue
+        did, cid = post.uri.split('/')[2], ref.link
+
+        # Try feed_fullsize first, fall back to feed_thumbnail
+        full_url = CDN_FULLSIZE.format(cdn=CDN_URL, did=did, cid=cid)
+        if not probe_fullsize:
+            image_urls.append(full_url)
+            continue
+        try:
+            with stage('resolve'), limit(full_url, deadline) as request:
+                response = requests.head(full_url, timeout=deadline.timeout(3) if deadline else 3)
+                request.record(response)
+            if response.status_code == 200:
+                image_urls.append(full_url)
+                continue
+        except requests.RequestException:
+            pass
+        image_urls.append(CDN_THUMBNAIL.format(cdn=CDN_URL, did=did, cid=cid))
+    return image_urls
+
+
+class PostVerdict(NamedTuple):
+    """Labels of a moderated post, whether they are degraded, and the post's strong ref
+
+    uri and cid let label_post and sync_post_labels emit without fetching the post again;
+    they are None when the post could not be fetched.
+    """
+    labels: Any
+    degraded: bool = False
+    uri: Optional[str] = None
+    cid: Optional[str] = None
+
+
+class PostContext:
+    """
+    A fetched post with its images, downloaded, decoded and hashed on first use
+
+    Usage:
+        context = PostContext.fetch(client, url, fingerprinter, deadline)
+        for image_url in context.image_urls():
+            fingerprint = context.fingerprint(image_url, ['phash'])
+    """
+
+    def __init__(self, url: str, post, fingerprinter: Optional[ImageFingerprinter] = None,
+                 deadline: Optional[Deadline] = None, negative_cache: Optional[NegativeCache] = None,
+                 probe_fullsize: bool = True):
+        """
+        Args:
+            url: URL of the post
+            post: Post as returned by post_from_url
+            fingerprinter: Decodes and hashes images; hash types it is not configured
+                with are computed on demand
+            deadline: Deadline of the post being moderated, if any
+            negative_cache: Optional cache of failed blobs, skipped without a request
+            probe_fullsize: Whether image URL resolution checks that fullsize images
+                exist; False when every image is matched through an ImageCascade
+        """
+        self.url = url
+        self.post = post
+        self.fingerprinter = fingerprinter or ImageFingerprinter()
+        self.deadline = deadline
+        self.negative_cache = negative_cache
+        self.probe_fullsize = probe_fullsize
+        # Set by a labeler whose image stage ran out of time
+        self.degraded = False
+        self._image_urls: Optional[List[str]] = None
+        self._digests: Dict[str, Optional[str]] = {}
+        self._pixels: Dict[str, Any] = {}
+        self._fingerprints: Dict[str, Dict[str, Any]] = {}
+        self.image_requests = 0
+        self.downloads = 0
+        self.decodes = 0
+        self.bytes_downloaded = 0
+        self.pixels_decoded = 0
+
+    @classmethod
+    def fetch(cls, client: "Client", url: str, fingerprinter: Optional[ImageFingerprinter] = None,
+              deadline: Optional[Deadline] = None, negative_cache: Optional[NegativeCache] = None,
+              probe_fullsize: bool = True) -> "PostContext":
+        """
+        Fetch a post and wrap it in a context
+
+        Raises:
+            NegativeCacheHit: If the post was recently not found or forbidden
+        """
+        if negative_cache is None:
+            with stage('fetch'):
+                post = post_from_url(client, url)
+            return cls(url, post, fingerprinter, deadline, probe_fullsize=probe_fullsize)
+
+        key = post_key(url)
+        negative_cache.check(key)
+        try:
+            with stage('fetch'):
+                post = post_from_url(client, url)
+        except Exception as e:
+            negative_cache.record_error(key, e)
+            raise
+        return cls(url, post, fingerprinter, deadline, negative_cache, probe_fullsize)
+
+    def verdict(self, labels: Any) -> PostVerdict:
+        """Wrap the labels a labeler produced for this post in a PostVerdict"""
+        return PostVerdict(labels, self.degraded, getattr(self.post, 'uri', None), getattr(self.post, 'cid', None))
+
+    @property
+    def text(self) -> str:
+        return getattr(getattr(self.post, 'value', None), 'text', None) or ''
+
+    def check_deadline(self):
+        """Raise BudgetExceeded if the post's deadline has passed"""
+        if self.deadline is not None:
+            self.deadline.check()
+
+    def image_urls(self) -> List[str]:
+        """Return the URLs of the post's images, resolving them on first use"""
+        if self._image_urls is None:
+            self._image_urls = resolve_image_urls(self.post, self.deadline, self.probe_fullsize)
+        return self._image_urls
+
+    def _digest(self, image_url: str) -> Optional[str]:
+        """Download and decode an image once; return the digest of its bytes, None on failure"""
+        if image_url in self._digests:
+            return self._digests[image_url]
+        if self.negative_cache is not None and self.negative_cache.get(blob_key(image_url)) is not None:
+            self._digests[image_url] = None
+            return None
+        digest = None
+        try:
+            with stage('download'):
+                content = download(image_url, self.deadline, timeout=10, negative_cache=self.negative_cache)
+            self.downloads += 1
+            if content is None:
+                print(f"Failed to download image: {image_url}")
+            else:
+                self.bytes_downloaded += len(content)
+                digest = hashlib.sha1(content).hexdigest()
+                if digest not in self._pixels:
+                    with stage('hash'):
+                        try:
+                            self._pixels[digest] = self.fingerprinter.decode(content)
+                        except Exception:
+                            if self.negative_cache is not None:
+                                self.negative_cache.put(blob_key(image_url), UNDECODABLE)
+                            raise
+                    self.decodes += 1
+                    self.pixels_decoded += self._pixels[digest].shape[0] * self._pixels[digest].shape[1]
+                    self._fingerprints[digest] = {}
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            if self.deadline is not None and self.deadline.expired():
+                raise BudgetExceeded() from e
+            print(f"Failed to process image {image_url}: {e}")
+            digest = None
+        self._digests[image_url] = digest
+        return digest
+
+    def fingerprint(self, image_url: str, hash_types: Iterable[str]) -> Optional[Dict[str, Any]]:
+        """
+        Return hashes of an image, computing only those not computed before
+
+        Args:
+            image_url: URL of one of the post's images
+            hash_types: Hash types the caller needs
+
+        Returns:
+            Dictionary of hash type -> boolean hash vector, or None if the image could not
+            be downloaded or decoded
+
+        Raises:
+            BudgetExceeded: If the deadline passed before the image was processed
+        """
+        self.image_requests += 1
+        digest = self._digest(image_url)
+        if digest is None:
+            return None
+        fingerprint = self._fingerprints[digest]
+        missing = [hash_type for hash_type in hash_types if hash_type not in fingerprint]
+        if missing:
+            with stage('hash'):
+                fingerprint.update(self.fingerprinter.hash(self._pixels[digest], missing))
+        return fingerprint
+
+    def stats(self) -> dict:
+        """Return how many image requests were served and how much work they needed"""
+        return {
+            'image_requests': self.image_requests,
+            'downloads': self.downloads,
+            'decodes': self.decodes,
+            'bytes_downloaded': self.bytes_downloaded,
+            'pixels_decoded': self.pixels_decoded,
+        }
@@ -0,0 +1,257 @@
+"""Run several labelers on each post with one fetch and one decode per image
+
+Each labeler fetching its own copy of a post repeats the getRecord call, the image URL
+resolution and the download and decode of every image, so I/O and decode cost grow with
+the number of labelers. A LabelerRunner fetches the post once into a PostContext, lets
+every labeler's rules read the text and images from it, and merges their labels. The
+context's fingerprinter computes the union of the hash types the labelers need, each
+only when a labeler first asks for it.
+
+A LabelerRunner exposes moderate_post(url), client and label_values like a single
+labeler, so it can be used anywhere a labeler is (test scripts, ShardedSupervisor,
+PriorityScheduler.drain).
+
+A labeler that raises does not cost the post the other labelers' verdicts: its error is
+recorded next to them, and the merged verdict is marked degraded so it is rechecked.
+Only when every labeler fails does the error propagate.
+
+Usage:
+    runner = LabelerRunner(client, [AutomatedLabeler(client, inputs), PolicyProposalLabeler(client, inputs)])
+    labels = runner.moderate_post(url)          # merged labels
+    verdicts, errors = runner.moderate_all(url) # labeler name -> labels, labeler name -> error
+
+    python -m pylabel.runner labeler-inputs test-data/input-posts-dogs.csv --output verdicts.jsonl
+    python -m pylabel.runner labeler-inputs posts.csv --threads 32 --adaptive_concurrency
+"""
+
+import argparse
+import json
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+from .evaluation import as_label_list
+from .image_fingerprint import ImageFingerprinter
+from .latency_budget import LatencyBudget
+from .negative_cache import NegativeCache
+from .post_context import PostContext, PostVerdict, set_cdn_url
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+
+class LabelerRunner:
+    """Moderate each post with several labelers from a single shared PostContext"""
+
+    name = "runner"
+
+    def __init__(self, client: "Client", labelers: Sequence[Any],
+                 latency_budget: Optional[LatencyBudget] = None,
+                 negative_cache: Optional[NegativeCache] = None):
+        """
+        Args:
+            client: AT Protocol client used to fetch posts
+            labelers: Labelers exposing name and moderate_context(context)
+            latency_budget: Optional per-post time budget shared by all labelers; image
+                work that does not fit in it is abandoned and the post is recorded as
+                degraded
+            negative_cache: Optional cache of deleted or forbidden posts and failed image
+                blobs; the shared context skips them without a request
+        """
+        names = [labeler.name for labeler in labelers]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Labeler names must be unique, got {names}")
+        self.client = client
+        self.labelers = list(labelers)
+        self.latency_budget = latency_budget
+        self.negative_cache = negative_cache
+        hash_types = set()
+        for labeler in self.labelers:
+            hash_types |= set(getattr(labeler, 'image_hash_types', ()))
+        self.fingerprinter = ImageFingerprinter(hash_types or ('phash',))
+        # Fullsize images need no HEAD check when every labeler screens images by thumbnail
+        self.cascaded = all(getattr(labeler, 'cascade', None) is not None for labeler in self.labelers)
+        self.label_values = set()
+        for labeler in self.labelers:
+            self.label_values |= set(getattr(labeler, 'label_values', ()))
+        self._lock = threading.Lock()
+        self.posts = 0
+        self.image_requests = 0
+        self.downloads = 0
+        self.decodes = 0
+        self.bytes_downloaded = 0
+        self.pixels_decoded = 0
+        self.labeler_errors: Counter = Counter()
+
+    def moderate_all(self, url: str) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+        """
+        Fetch a post once and moderate it with every labeler
+
+        Args:
+            url: URL to the Bluesky post
+
+        Returns:
+            Dictionary of labeler name -> sorted list of labels, for the labelers that
+            succeeded, and dictionary of labeler name -> error, for those that raised
+
+        Raises:
+            Exception: The first labeler's error, if every labeler raised
+        """
+        verdicts, errors, _ = self._moderate(url)
+        return verdicts, errors
+
+    def _moderate(self, url: str) -> Tuple[Dict[str, List[str]], Dict[str, str], PostContext]:
+        deadline = self.latency_budget.deadline() if self.latency_budget is not None else None
+        context = PostContext.fetch(self.client, url, self.fingerprinter, deadline, self.negative_cache,
+                                    probe_fullsize=not self.cascaded)
+        verdicts, errors, first_error = {}, {}, None
+        for labeler in self.labelers:
+            try:
+                verdicts[labeler.name] = as_label_list(labeler.moderate_context(context))
+            except Exception as e:
+                errors[labeler.name] = repr(e)
+                first_error = first_error or e
+
+        if self.latency_budget is not None:
+            self.latency_budget.record(url, deadline, context.degraded)
+        with self._lock:
+            self.posts += 1
+            self.labeler_errors.update(errors.keys())
+            self.image_requests += context.image_requests
+            self.downloads += context.downloads
+            self.decodes += context.decodes
+            self.bytes_downloaded += context.bytes_downloaded
+            self.pixels_decoded += context.pixels_decoded
+        if errors and not verdicts:
+            raise first_error
+        return verdicts, errors, context
+
+    def moderate_post(self, url: str) -> List[str]:
+        """
+        Moderate a post with every labeler and merge the labels
+
+        Args:
+            url: URL to the Bluesky post
+
+        Returns:
+            Sorted list of the labels applied by any labeler
+        """
+        return self.moderate_post_verdict(url)[0]
+
+    def moderate_post_verdict(self, url: str) -> PostVerdict:
+        """
+        Moderate a post like moderate_post and report whether the verdict is degraded
+
+        Returns:
+            PostVerdict with the merged labels, whether they are the text verdict alone
+            or miss the labels of a labeler that raised, and the post's URI and CID
+        """
+        verdicts, errors, context = self._moderate(url)
+        labels = set()
+        for verdict in verdicts.values():
+            labels.update(verdict)
+        verdict = context.verdict(sorted(labels))
+        return verdict._replace(degraded=True) if errors else verdict
+
+    def stats(self) -> dict:
+        """Return posts moderated, image requests served vs. downloads and decodes done, and their size"""
+        return {
+            'labelers': [labeler.name for labeler in self.labelers],
+            'posts': self.posts,
+            'image_requests': self.image_requests,
+            'downloads': self.downloads,
+            'decodes': self.decodes,
+            'downloads_saved': self.image_requests - self.downloads,
+            'bytes_downloaded': self.bytes_downloaded,
+            'pixels_decoded': self.pixels_decoded,
+            'labeler_errors': dict(self.labeler_errors),
+        }
+
+
+def _moderate_or_error(runner: LabelerRunner, url: str):
+    try:
+        return (url, *runner.moderate_all(url), None)
+    except Exception as e:
+        return url, None, None, repr(e)
+
+
+def main():
+    """Main function for running every labeler over a list of posts"""
+    from .automated_labeler import AutomatedLabeler
+    from .cascade import ImageCascade
+    from .concurrency import HostLimiters
+    from .inputs import read_csv_column
+    from .label import PW, USERNAME, make_client
+    from .policy_proposal_labeler import PolicyProposalLabeler
+
+    parser = argparse.ArgumentParser(description="Run several labelers on each post, fetching it once")
+    parser.add_argument("labeler_inputs_dir", type=str)
+    parser.add_argument("input_urls", type=str, help="CSV file with a URL column")
+    parser.add_argument("--labelers", nargs="+", choices=["automated", "policy"], default=["automated", "policy"])
+    parser.add_argument("--latency_budget", type=float,
+                        help="Seconds allowed per post; image checks that do not fit are skipped (degraded)")
+    parser.add_argument("--threads", type=int, default=1, help="Number of posts moderated concurrently")
+    parser.add_argument("--adaptive_concurrency", action="store_true",
+                        help="Limit in-flight requests per host, adapting the limit to latency and 429s")
+    parser.add_argument("--negative_cache", type=str, metavar="FILE",
+                        help="SQLite file remembering deleted or forbidden posts and failed image blobs, skipped until they expire")
+    parser.add_argument("--cascade_margin", type=float,
+                        help="Screen images by their thumbnail; fetch the fullsize image only within this distance of a match")
+    parser.add_argument("--output", type=str, help="JSONL file the per-labeler verdicts are written to")
+    parser.add_argument("--appview_url", type=str,
+                        help="XRPC base URL to fetch posts from (default: APPVIEW_URL or bsky.social)")
+    parser.add_argument("--cdn_url", type=str, help="Image CDN base URL (default: CDN_URL or cdn.bsky.app)")
+    args = parser.parse_args()
+
+    if args.cdn_url:
+        set_cdn_url(args.cdn_url)
+    client = make_client(args.appview_url)
+    client.login(USERNAME, PW)
+    factories = {"automated": AutomatedLabeler, "policy": PolicyProposalLabeler}
+    cascade = ImageCascade(args.cascade_margin) if args.cascade_margin is not None else None
+    labelers = [factories[name](client, args.labeler_inputs_dir, cascade=cascade) for name in args.labelers]
+    latency_budget = LatencyBudget(args.latency_budget) if args.latency_budget else None
+    negative_cache = NegativeCache(args.negative_cache) if args.negative_cache else None
+    runner = LabelerRunner(client, labelers, latency_budget=latency_budget, negative_cache=negative_cache)
+    limiters = HostLimiters() if args.adaptive_concurrency else None
+    if limiters is not None:
+        limiters.install()
+
+    urls = read_csv_column(args.input_urls, "URL")
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    pool = None
+    try:
+        if args.threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            pool = ThreadPoolExecutor(args.threads)
+            results = pool.map(lambda url: _moderate_or_error(runner, url), urls)
+        else:
+            results = (_moderate_or_error(runner, url) for url in urls)
+        for url, verdicts, errors, error in results:
+            if error is not None:
+                print(f"For {url}, runner failed: {error}")
+                continue
+            print(f"{url}: {verdicts}")
+            for name, labeler_error in errors.items():
+                print(f"For {url}, {name} failed: {labeler_error}")
+            if output is not None:
+                output.write(json.dumps({"url": url, "verdicts": verdicts, "errors": errors}) + "\n")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if output is not None:
+            output.close()
+    print(f"Runner: {runner.stats()}")
+    if latency_budget is not None:
+        print(f"Latency budget: {latency_budget.stats()}")
+    if cascade is not None:
+        print(f"Image cascade: {cascade.stats()}")
+    if negative_cache is not None:
+        print(f"Negative cache: {negative_cache.stats()}")
+    if limiters is not None:
+        print(f"Concurrency limits: {limiters.stats()}")
+
+
+if __name__ == "__main__":
+    main()
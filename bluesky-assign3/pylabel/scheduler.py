@@ -0,0 +1,324 @@
+"""Priority scheduling and load shedding in front of moderate_post
+
+Posts are queued by priority class instead of being moderated strictly in arrival order:
+
+    REPORTED         posts reported by users
+    REPEAT_AUTHOR    posts by authors whose earlier posts were labeled
+    IMAGES           posts with images
+    NORMAL           everything else
+
+The scheduler always serves the highest non-empty class, so during a traffic spike
+high-risk posts keep a low time-to-label while low-risk posts wait. Every class has a
+bounded queue and an optional maximum wait. A post that arrives at a full queue, or that
+waited longer than its class allows, is either shed (dropped and counted) or deferred:
+deferred posts go to a bounded overflow queue that is only served when every class queue
+is empty, i.e. once the spike is over.
+
+A post's class can rise while it waits: once one post of an author is labeled,
+promote() moves that author's queued posts up to REPEAT_AUTHOR.
+
+Queue depths, shed/deferred counts and wait times per class are exposed through stats().
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from .workers import author_from_url
+
+SHED = "shed"
+DEFER = "defer"
+
+
+class Priority(IntEnum):
+    """Priority classes, highest first"""
+    REPORTED = 0
+    REPEAT_AUTHOR = 1
+    IMAGES = 2
+    NORMAL = 3
+
+
+class ClassPolicy(NamedTuple):
+    """Queue limits of a priority class and what to do with posts beyond them"""
+    max_depth: int = 10_000
+    max_wait: Optional[float] = None
+    overflow: str = DEFER
+
+
+DEFAULT_POLICIES = {
+    Priority.REPORTED: ClassPolicy(max_depth=100_000, overflow=DEFER),
+    Priority.REPEAT_AUTHOR: ClassPolicy(max_depth=50_000, overflow=DEFER),
+    Priority.IMAGES: ClassPolicy(max_depth=20_000, overflow=DEFER),
+    Priority.NORMAL: ClassPolicy(max_depth=10_000, overflow=SHED),
+}
+
+
+class Task(NamedTuple):
+    """A post waiting for moderation"""
+    url: str
+    priority: Priority
+    enqueued_at: float
+    payload: Any = None
+
+
+class RiskClassifier:
+    """
+    Assign posts to priority classes from the hints available before moderation
+
+    Authors whose posts received a label are remembered (bounded, least recently labeled
+    forgotten first), so their next posts are moderated ahead of the rest.
+    """
+
+    def __init__(self, max_authors: int = 100_000):
+        self.max_authors = max_authors
+        self._flagged_authors: "OrderedDict[str, None]" = OrderedDict()
+
+    def priority(self, url: str, reported: bool = False, has_images: bool = False) -> Priority:
+        """
+        Return the priority class of a post
+
+        Args:
+            url: URL of the post
+            reported: Whether the post was reported
+            has_images: Whether the post has images
+        """
+        if reported:
+            return Priority.REPORTED
+        if author_from_url(url) in self._flagged_authors:
+            return Priority.REPEAT_AUTHOR
+        if has_images:
+            return Priority.IMAGES
+        return Priority.NORMAL
+
+    def observe(self, url: str, labels: Iterable[str]):
+        """Remember the author of a post that received labels"""
+        if not labels:
+            return
+        author = author_from_url(url)
+        self._flagged_authors[author] = None
+        self._flagged_authors.move_to_end(author)
+        while len(self._flagged_authors) > self.max_authors:
+            self._flagged_authors.popitem(last=False)
+
+
+class _ClassStats:
+    def __init__(self, recent_waits: int):
+        self.submitted = 0
+        self.promoted = 0
+        self.processed = 0
+        self.shed = 0
+        self.deferred = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=recent_waits)
+
+    def record_wait(self, wait: float):
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def as_dict(self, depth: int) -> dict:
+        waits = sorted(self.recent_waits)
+        return {
+            'depth': depth,
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'promoted': self.promoted,
+            'processed': self.processed,
+            'shed': self.shed,
+            'deferred': self.deferred,
+            'mean_wait': self.total_wait / self.processed if self.processed else 0,
+            'p95_wait': waits[int(0.95 * (len(waits) - 1))] if waits else 0,
+            'max_wait': self.max_wait,
+        }
+
+
+class PriorityScheduler:
+    """
+    Bounded per-class queues served in strict priority order, with load shedding
+
+    Producers call submit() and one or more consumers call get(); both are thread-safe.
+
+    Usage:
+        scheduler = PriorityScheduler()
+        scheduler.submit(url, classifier.priority(url, has_images=True))
+        for task, labels, error in scheduler.drain(labeler.moderate_post):
+            if labels:
+                classifier.observe(task.url, labels)
+                author = author_from_url(task.url)
+                scheduler.promote(lambda queued: author_from_url(queued.url) == author,
+                                  Priority.REPEAT_AUTHOR)
+    """
+
+    def __init__(self, policies: Optional[Dict[Priority, ClassPolicy]] = None,
+                 max_deferred: int = 100_000, recent_waits: int = 1000,
+                 on_shed: Optional[Callable[[Task], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            policies: Queue limits per priority class; defaults to DEFAULT_POLICIES
+            max_deferred: Size of the overflow queue; deferred posts beyond it are shed
+            recent_waits: Number of recent wait times per class used for percentiles
+            on_shed: Called with every shed task, e.g. to log it for a later backfill
+            clock: Time source
+        """
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.max_deferred = max_deferred
+        self.on_shed = on_shed
+        self.clock = clock
+        self._queues: Dict[Priority, Deque[Task]] = {priority: deque() for priority in Priority}
+        self._deferred: Deque[Task] = deque()
+        self._stats = {priority: _ClassStats(recent_waits) for priority in Priority}
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _overflow(self, task: Task):
+        stats = self._stats[task.priority]
+        if self.policies[task.priority].overflow == DEFER and len(self._deferred) < self.max_deferred:
+            stats.deferred += 1
+            self._deferred.append(task)
+            return
+        stats.shed += 1
+        if self.on_shed is not None:
+            self.on_shed(task)
+
+    def submit(self, url: str, priority: Priority = Priority.NORMAL, payload: Any = None) -> bool:
+        """
+        Queue a post
+
+        Args:
+            url: URL of the post
+            priority: Priority class of the post
+            payload: Anything the consumer needs along with the URL
+
+        Returns:
+            False if the class queue was full and the post was shed or deferred
+        """
+        task = Task(url, priority, self.clock(), payload)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed")
+            stats = self._stats[priority]
+            stats.submitted += 1
+            queue = self._queues[priority]
+            if len(queue) >= self.policies[priority].max_depth:
+                self._overflow(task)
+                return False
+            queue.append(task)
+            stats.max_depth = max(stats.max_depth, len(queue))
+            self._condition.notify()
+            return True
+
+    def promote(self, predicate: Callable[[Task], bool], priority: Priority) -> int:
+        """
+        Move queued posts matching a predicate from lower classes up to a priority class
+
+        Promoted posts keep their enqueue time, so their wait is measured from submission.
+        Deferred posts stay in the overflow queue.
+
+        Args:
+            predicate: Called with each queued task of a lower class
+            priority: Class the matching posts are moved to
+
+        Returns:
+            Number of posts promoted
+        """
+        with self._condition:
+            promoted = []
+            for lower in Priority:
+                if lower <= priority:
+                    continue
+                queue = self._queues[lower]
+                kept = deque()
+                for task in queue:
+                    if predicate(task):
+                        promoted.append(task._replace(priority=priority))
+                    else:
+                        kept.append(task)
+                self._queues[lower] = kept
+            if promoted:
+                queue = self._queues[priority]
+                # Keep the class queue ordered by enqueue time for _expire
+                self._queues[priority] = deque(sorted([*queue, *promoted], key=lambda task: task.enqueued_at))
+                stats = self._stats[priority]
+                stats.promoted += len(promoted)
+                stats.max_depth = max(stats.max_depth, len(self._queues[priority]))
+            return len(promoted)
+
+    def _expire(self, now: float):
+        for priority, queue in self._queues.items():
+            max_wait = self.policies[priority].max_wait
+            if max_wait is None:
+                continue
+            while queue and now - queue[0].enqueued_at > max_wait:
+                self._overflow(queue.popleft())
+
+    def _pop(self) -> Optional[Task]:
+        now = self.clock()
+        self._expire(now)
+        for priority in Priority:
+            queue = self._queues[priority]
+            if queue:
+                task = queue.popleft()
+                break
+        else:
+            if not self._deferred:
+                return None
+            task = self._deferred.popleft()
+        self._stats[task.priority].record_wait(now - task.enqueued_at)
+        return task
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[Task]:
+        """
+        Take the next post to moderate
+
+        Returns:
+            The next task, or None if nothing is queued (after waiting when block is
+            True) or the scheduler is closed and empty
+        """
+        with self._condition:
+            task = self._pop()
+            if task is None and block and not self._closed:
+                self._condition.wait_for(lambda: self._closed or self.depth() > 0, timeout)
+                task = self._pop()
+            return task
+
+    def depth(self) -> int:
+        """Return the number of queued posts, including deferred ones"""
+        return sum(len(queue) for queue in self._queues.values()) + len(self._deferred)
+
+    def close(self):
+        """Stop accepting posts and wake waiting consumers"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def drain(self, handler: Callable[[str], Any]) -> Iterator[Tuple[Task, Any, Optional[str]]]:
+        """
+        Moderate queued posts in priority order until the queues are empty
+
+        Args:
+            handler: Called with each post URL, e.g. labeler.moderate_post
+
+        Returns:
+            Iterator over (task, result, error) tuples; error is None on success
+        """
+        while True:
+            task = self.get(block=False)
+            if task is None:
+                return
+            try:
+                yield task, handler(task.url), None
+            except Exception as e:
+                yield task, None, repr(e)
+
+    def stats(self) -> dict:
+        """Return queue depth, shed/deferred counts and wait times (seconds) per class"""
+        with self._condition:
+            classes = {priority.name.lower(): self._stats[priority].as_dict(len(self._queues[priority]))
+                       for priority in Priority}
+            return {'classes': classes, 'deferred_depth': len(self._deferred), 'depth': self.depth()}
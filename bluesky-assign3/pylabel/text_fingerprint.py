@@ -0,0 +1,210 @@
+"""Near-duplicate text fingerprinting to reuse text verdicts across spam waves
+
+Spam and solicitation waves post the same, or almost the same, text many times. Each
+post text is reduced to a MinHash signature of its token set (words, hashtags, and each
+symbol or emoji on its own, so "18+" and "🔞" are part of the fingerprint): the fraction
+of positions where two signatures agree estimates the Jaccard similarity of the two
+texts' tokens.
+MinHash is used rather than SimHash because posts are short; with only a dozen or so
+words, SimHash flips several bits for a one-word edit and cannot tell small edits apart
+from unrelated texts, while a Jaccard estimate handles that well.
+
+Recent verdicts are kept in an LSH index that splits each signature into bands; texts
+whose similarity is well above the band threshold share at least one band with high
+probability, so candidates are found with one dictionary lookup per band. Candidates
+are then checked against the configured minimum similarity. Entries can carry a key, e.g.
+the hash of the text rules plus the rule features a one-token edit must not flip; a
+verdict is only reused for a lookup with the same key, so a rule change or a differing
+feature never reuses a stale verdict.
+
+The index holds a bounded number of entries, each expiring after a fixed time, so memory
+stays bounded during long runs and stale verdicts do not outlive a ruleset change by long.
+"""
+
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Set
+
+# Words and hashtags, and every other non-space character (symbols, emoji) on its own
+_TOKEN_PATTERN = re.compile(r'#?\w+|[^\w\s]')
+_MASK64 = (1 << 64) - 1
+
+
+def _permutations(num_perm: int, seed: int = 1):
+    """Return odd multipliers and offsets for num_perm multiply-shift hash functions"""
+    import numpy as np
+
+    digest = hashlib.blake2b(f"minhash-{seed}".encode('utf-8'), digest_size=64).digest()
+    values = []
+    counter = 0
+    while len(values) < 2 * num_perm:
+        block = hashlib.blake2b(digest + counter.to_bytes(4, 'little'), digest_size=64).digest()
+        values.extend(int.from_bytes(block[i:i + 8], 'little') for i in range(0, 64, 8))
+        counter += 1
+    multipliers = np.array([value | 1 for value in values[:num_perm]], dtype=np.uint64)
+    offsets = np.array(values[num_perm:2 * num_perm], dtype=np.uint64)
+    return multipliers, offsets
+
+
+_PERMUTATION_CACHE: Dict[int, tuple] = {}
+
+
+def minhash(text: str, num_perm: int = 64):
+    """
+    Compute the MinHash signature of the set of tokens (words, hashtags, symbols) in a text
+
+    Args:
+        text: Text to fingerprint
+        num_perm: Number of hash functions (signature length)
+
+    Returns:
+        NumPy uint32 array of length num_perm
+    """
+    import numpy as np
+
+    if num_perm not in _PERMUTATION_CACHE:
+        _PERMUTATION_CACHE[num_perm] = _permutations(num_perm)
+    multipliers, offsets = _PERMUTATION_CACHE[num_perm]
+
+    tokens = set(_TOKEN_PATTERN.findall(text.lower()))
+    if not tokens:
+        return np.zeros(num_perm, dtype=np.uint32)
+    digests = b''.join(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest() for token in tokens)
+    hashes = np.frombuffer(digests, dtype=np.uint64)
+    # Multiply-shift hashing: (a * h + b) mod 2^64, keeping the high 32 bits
+    permuted = (hashes[:, None] * multipliers[None, :] + offsets[None, :]) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def estimate_similarity(signature_a, signature_b) -> float:
+    """Estimate the Jaccard similarity of two texts from their MinHash signatures"""
+    return float((signature_a == signature_b).mean())
+
+
+class NearDuplicateIndex:
+    """
+    LSH index of recent text verdicts keyed by MinHash signature
+
+    Usage:
+        index = NearDuplicateIndex(min_similarity=0.8)
+        signature = minhash(text)
+        verdict = index.lookup(signature, key=ruleset_version)
+        if verdict is None:
+            verdict = score(text)
+            index.add(signature, verdict, key=ruleset_version)
+    """
+
+    def __init__(self, min_similarity: float = 0.8, num_perm: int = 64, num_bands: int = 16,
+                 capacity: int = 100_000, ttl_seconds: float = 3600):
+        """
+        Args:
+            min_similarity: Smallest estimated Jaccard similarity at which a stored
+                verdict is reused (1.0 reuses verdicts for identical word sets only)
+            num_perm: Signature length; must match the signatures passed in
+            num_bands: Number of LSH bands; more bands find less similar candidates
+            capacity: Maximum number of signatures kept
+            ttl_seconds: Time after which a stored verdict is no longer reused
+        """
+        if num_perm % num_bands:
+            raise ValueError("num_perm must be a multiple of num_bands")
+        self.min_similarity = min_similarity
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._rows = num_perm // num_bands
+        self._tables: List[Dict[bytes, Set[tuple]]] = [{} for _ in range(num_bands)]
+
+        # (key, signature bytes) -> (signature, verdict, time added), oldest first
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.exact_hits = 0
+
+    def _band_keys(self, signature) -> List[bytes]:
+        return [signature[band * self._rows:(band + 1) * self._rows].tobytes()
+                for band in range(self.num_bands)]
+
+    def _remove(self, key: tuple):
+        signature = self._entries.pop(key)[0]
+        for table, band_key in zip(self._tables, self._band_keys(signature)):
+            bucket = table.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del table[band_key]
+
+    def _expire(self, now: float):
+        while self._entries:
+            key, (_, _, added) = next(iter(self._entries.items()))
+            if now - added < self.ttl_seconds and len(self._entries) <= self.capacity:
+                break
+            self._remove(key)
+
+    def lookup(self, signature, now: Optional[float] = None, key: Hashable = None) -> Optional[Any]:
+        """
+        Find the verdict of a stored text at least min_similarity similar to the signature
+
+        Args:
+            signature: MinHash signature of the text
+            now: Current time; defaults to now
+            key: Only verdicts added with the same key are reused
+
+        Returns:
+            The stored verdict of the most similar match, or None
+        """
+        now = time.time() if now is None else now
+        self._expire(now)
+        self.lookups += 1
+
+        entry = self._entries.get((key, signature.tobytes()))
+        if entry is not None:
+            self.hits += 1
+            self.exact_hits += 1
+            return entry[1]
+
+        best, best_similarity = None, self.min_similarity
+        seen = set()
+        for table, band_key in zip(self._tables, self._band_keys(signature)):
+            for entry_key in table.get(band_key, ()):
+                if entry_key[0] != key or entry_key in seen:
+                    continue
+                seen.add(entry_key)
+                similarity = estimate_similarity(signature, self._entries[entry_key][0])
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_key, similarity
+        if best is None:
+            return None
+        self.hits += 1
+        return self._entries[best][1]
+
+    def add(self, signature, verdict: Any, now: Optional[float] = None, key: Hashable = None):
+        """
+        Store the verdict for a signature
+
+        Args:
+            signature: MinHash signature of the scored text
+            verdict: Verdict to reuse for near-duplicates
+            now: Current time; defaults to now
+            key: Key a lookup must pass for the verdict to be reused
+        """
+        now = time.time() if now is None else now
+        entry_key = (key, signature.tobytes())
+        if entry_key in self._entries:
+            self._remove(entry_key)
+        self._entries[entry_key] = (signature, verdict, now)
+        for table, band_key in zip(self._tables, self._band_keys(signature)):
+            table.setdefault(band_key, set()).add(entry_key)
+        self._expire(now)
+
+    def stats(self) -> dict:
+        """Return lookup counts and the verdict reuse rate"""
+        return {
+            'entries': len(self._entries),
+            'lookups': self.lookups,
+            'reused': self.hits,
+            'exact_reused': self.exact_hits,
+            'reuse_rate': self.hits / self.lookups if self.lookups else 0,
+        }
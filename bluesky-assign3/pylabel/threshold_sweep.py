@@ -0,0 +1,364 @@
+"""Single-pass threshold sweep for tuning the labelers' detection parameters
+
+Tuning THRESH (dog image distance), image_hash_threshold (NSFW hash bits) or the
+_explicit_intensity(text) > 2 cutoff used to mean a full test run, with every post and
+image fetched again, per candidate value. The sweep instead fetches each labeled test
+post once and caches the raw, threshold-independent features in a JSON Lines file:
+
+    automated  text labels, minimum distance from the post's images to the dog references
+    policy     signal flags (enough words, sexual terms, sexual hashtags, solicitation,
+               legitimate context), intensity score, minimum distance to the NSFW hashes
+
+Every grid point is then evaluated with vectorized NumPy over the cached feature matrix,
+with the same success rule and confusion-matrix definition as compute_metrics, and the
+resulting precision/recall curve is written as CSV.
+
+Usage:
+    python -m pylabel.threshold_sweep automated labeler-inputs test-data/input-posts-dogs.csv \\
+        --features dogs-features.jsonl --output dogs-sweep.csv
+    python -m pylabel.threshold_sweep policy labeler-inputs test_posts.json \\
+        --features policy-features.jsonl --output policy-sweep.csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+from .evaluation import as_label_list
+from .image_fingerprint import ImageFingerprinter
+from .inputs import iter_csv_records, iter_json_records
+from .label import post_from_url
+from .latency_budget import download
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+    from .automated_labeler import AutomatedLabeler
+    from .policy_proposal_labeler import PolicyProposalLabeler
+
+
+class FeatureCache:
+    """
+    Append-only JSON Lines cache of per-post features, keyed by URL
+
+    Like EvaluationJournal, each record is flushed as soon as it is computed, so an
+    interrupted extraction resumes where it stopped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._records: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._records[record['url']] = record
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._records
+
+    def add(self, record: Dict[str, Any]):
+        self._records[record['url']] = record
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def records(self, urls: Iterable[str]) -> List[Dict[str, Any]]:
+        """Return the cached records of the given URLs, in order"""
+        return [self._records[url] for url in urls if url in self._records]
+
+    def close(self):
+        self._file.close()
+
+
+def _min_image_distance(image_urls: Iterable[str], reference_sets, fingerprinter: ImageFingerprinter,
+                        fingerprints: Dict[str, Optional[dict]]) -> Tuple[Optional[float], int]:
+    """
+    Return the smallest distance from any image to any reference hash, and the number of
+    images that could not be fetched or decoded. Fingerprints are memoized by URL.
+    """
+    best, failed = None, 0
+    for image_url in image_urls:
+        if image_url not in fingerprints:
+            try:
+                content = download(image_url)
+                fingerprints[image_url] = None if content is None else fingerprinter.fingerprint(content)
+            except Exception as e:
+                print(f"Failed to fingerprint {image_url}: {e}")
+                fingerprints[image_url] = None
+        fingerprint = fingerprints[image_url]
+        if fingerprint is None:
+            failed += 1
+            continue
+        for reference in reference_sets:
+            distance = reference.min_distance(fingerprint)
+            if distance is not None and (best is None or distance < best):
+                best = distance
+    return best, failed
+
+
+def automated_features(labeler: "AutomatedLabeler", post, fingerprints: Dict[str, Optional[dict]]) -> Dict[str, Any]:
+    """Compute the threshold-independent features of a post for the automated labeler"""
+    distance, failed = _min_image_distance(labeler._extract_image_urls(post), labeler.dog_reference_sets,
+                                           labeler.fingerprinter, fingerprints)
+    return {
+        'text_labels': sorted(labeler._moderate_text(post.value.text)),
+        'dog_distance': distance,
+        'failed_images': failed,
+    }
+
+
+def policy_features(labeler: "PolicyProposalLabeler", post, fingerprints: Dict[str, Optional[dict]]) -> Dict[str, Any]:
+    """Compute the threshold-independent features of a post for the policy labeler"""
+    text = getattr(post.value, 'text', '') or ''
+    distance, failed = _min_image_distance(labeler._extract_image_urls(post), labeler.reference_sets,
+                                           labeler.fingerprinter, fingerprints)
+    return {
+        'long_enough': len(text.split()) >= 3,
+        'sexual_terms': labeler._contains_sexual_terms(text),
+        'sexual_hashtags': labeler._check_for_hashtags(text),
+        'solicitation': labeler._indicates_solicitation(text),
+        'legitimate': labeler._indicates_legitimate_context(text),
+        'intensity': labeler._explicit_intensity(text),
+        'nsfw_distance': distance,
+        'failed_images': failed,
+    }
+
+
+def extract_features(client: "Client", labeler, kind: str, cases: Iterable[Tuple[str, Any]],
+                     cache: FeatureCache) -> int:
+    """
+    Fetch each uncached post once and cache its features
+
+    Args:
+        client: Authenticated client used to fetch posts
+        labeler: AutomatedLabeler or PolicyProposalLabeler
+        kind: 'automated' or 'policy'
+        cases: Iterable of (url, expected label(s))
+        cache: Feature cache
+
+    Returns:
+        Number of posts fetched
+    """
+    compute = automated_features if kind == 'automated' else policy_features
+    fingerprints: Dict[str, Optional[dict]] = {}
+    fetched = 0
+    for url, expected in cases:
+        if url in cache:
+            continue
+        try:
+            post = post_from_url(client, url)
+            record = compute(labeler, post, fingerprints)
+        except Exception as e:
+            # Not cached, so the post is retried on the next run
+            print(f"Failed to extract features for {url}: {e}")
+            continue
+        record.update(url=url, expected=as_label_list(expected))
+        cache.add(record)
+        fetched += 1
+    return fetched
+
+
+def _grid_metrics(match, actual_positive, expected_positive) -> Dict[str, Any]:
+    """
+    Confusion counts and metrics over the last axis, as defined by compute_metrics
+
+    Args:
+        match: Boolean array (..., N), True where the verdict equals the expected labels
+        actual_positive: Boolean array (..., N), True where the verdict has labels
+        expected_positive: Boolean array (N,), True where labels are expected
+    """
+    import numpy as np
+
+    tp = (expected_positive & match).sum(axis=-1)
+    fn = (expected_positive & ~match).sum(axis=-1)
+    fp = (~expected_positive & actual_positive).sum(axis=-1)
+    tn = (~expected_positive & ~actual_positive).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    accuracy = match.sum(axis=-1) / max(match.shape[-1], 1)
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+            'precision': precision, 'recall': recall, 'f1': f1, 'accuracy': accuracy}
+
+
+def _distances(records: List[Dict[str, Any]], field: str):
+    import numpy as np
+
+    return np.array([np.nan if r[field] is None else r[field] for r in records], dtype=np.float64)
+
+
+def sweep_automated(records: List[Dict[str, Any]], thresholds: Iterable[float],
+                    image_label: str = 'dog') -> List[Dict[str, Any]]:
+    """
+    Evaluate the automated labeler for every dog distance threshold
+
+    Args:
+        records: Cached automated features
+        thresholds: Candidate THRESH values (normalized Hamming distance, inclusive)
+        image_label: Label applied on an image match
+
+    Returns:
+        One row of metrics per threshold
+    """
+    import numpy as np
+
+    thresholds = np.asarray(list(thresholds), dtype=np.float64)
+    expected_positive = np.array([bool(r['expected']) for r in records])
+    expected_image = np.array([image_label in r['expected'] for r in records])
+    text_ok = np.array([set(r['text_labels']) == set(r['expected']) - {image_label} for r in records])
+    text_positive = np.array([bool(r['text_labels']) for r in records])
+    distance = _distances(records, 'dog_distance')
+
+    # (K, N): does the image stage fire at each threshold
+    with np.errstate(invalid='ignore'):
+        image_hit = distance[None, :] <= thresholds[:, None]
+    match = text_ok[None, :] & (image_hit == expected_image[None, :])
+    metrics = _grid_metrics(match, text_positive[None, :] | image_hit, expected_positive)
+    return [dict({'thresh': float(t)}, **{key: _scalar(value[k]) for key, value in metrics.items()})
+            for k, t in enumerate(thresholds)]
+
+
+def sweep_policy(records: List[Dict[str, Any]], hash_thresholds: Iterable[int],
+                 intensity_cutoffs: Iterable[int], hash_length: int = 64,
+                 label: str = 'sexual-content') -> List[Dict[str, Any]]:
+    """
+    Evaluate the policy labeler for every (image_hash_threshold, intensity cutoff) pair
+
+    Args:
+        records: Cached policy features
+        hash_thresholds: Candidate image_hash_threshold values (match below this many bits)
+        intensity_cutoffs: Candidate cutoffs c in _explicit_intensity(text) > c
+        hash_length: Bits per hash, to convert normalized distances to bits
+        label: Label applied by the labeler
+
+    Returns:
+        One row of metrics per grid point
+    """
+    import numpy as np
+
+    hash_thresholds = np.asarray(list(hash_thresholds))
+    intensity_cutoffs = np.asarray(list(intensity_cutoffs))
+
+    def column(field):
+        return np.array([r[field] for r in records])
+
+    expected_positive = np.array([bool(r['expected']) for r in records])
+    expected_label = np.array([r['expected'] == [label] for r in records])
+    eligible = column('long_enough') & column('sexual_terms')
+    legitimate = column('legitimate')
+    always = eligible & (column('sexual_hashtags') | (column('solicitation') & ~legitimate))
+    intensity = column('intensity')
+    bits = _distances(records, 'nsfw_distance') * hash_length
+
+    # (C, N) text verdicts and (B, N) image verdicts, combined to (B, C, N)
+    text_hit = always[None, :] | (eligible & ~legitimate)[None, :] & (intensity[None, :] > intensity_cutoffs[:, None])
+    with np.errstate(invalid='ignore'):
+        image_hit = bits[None, :] < hash_thresholds[:, None]
+    hit = text_hit[None, :, :] | image_hit[:, None, :]
+    metrics = _grid_metrics(hit == expected_label, hit, expected_positive)
+
+    rows = []
+    for b, hash_threshold in enumerate(hash_thresholds):
+        for c, cutoff in enumerate(intensity_cutoffs):
+            row = {'image_hash_threshold': int(hash_threshold), 'intensity_cutoff': int(cutoff)}
+            row.update({key: _scalar(value[b, c]) for key, value in metrics.items()})
+            rows.append(row)
+    return rows
+
+
+def _scalar(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _frange(start: float, stop: float, step: float) -> List[float]:
+    count = int(round((stop - start) / step)) + 1
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+def main():
+    """Main function for the threshold sweep command"""
+    parser = argparse.ArgumentParser(description="Sweep detection thresholds over cached post features")
+    parser.add_argument("labeler", choices=["automated", "policy"])
+    parser.add_argument("labeler_inputs_dir", type=str)
+    parser.add_argument("test_cases", type=str,
+                        help="CSV with URL and Labels columns (automated) or JSON/JSONL with url and "
+                             "expected_label (policy)")
+    parser.add_argument("--features", type=str, required=True,
+                        help="JSONL feature cache; posts already in it are not fetched again")
+    parser.add_argument("--output", type=str, help="CSV file for the precision/recall curve")
+    parser.add_argument("--thresh", type=float, nargs=3, default=[0.0, 0.5, 0.01], metavar=("START", "STOP", "STEP"),
+                        help="THRESH grid for the automated labeler")
+    parser.add_argument("--hash_bits", type=int, nargs=2, default=[0, 32], metavar=("MIN", "MAX"),
+                        help="image_hash_threshold grid (inclusive) for the policy labeler")
+    parser.add_argument("--intensity", type=int, nargs=2, default=[0, 5], metavar=("MIN", "MAX"),
+                        help="Intensity cutoff grid (inclusive) for the policy labeler")
+    args = parser.parse_args()
+
+    if args.labeler == "automated":
+        from .automated_labeler import THRESH, AutomatedLabeler
+
+        cases = [(row["URL"], json.loads(row["Labels"])) for row in iter_csv_records(args.test_cases)]
+        labeler = AutomatedLabeler(None, args.labeler_inputs_dir)
+    else:
+        from .policy_proposal_labeler import PolicyProposalLabeler
+
+        cases = [(post["url"], post.get("expected_label")) for post in iter_json_records(args.test_cases)]
+        labeler = PolicyProposalLabeler(None, args.labeler_inputs_dir)
+
+    cache = FeatureCache(args.features)
+    if any(url not in cache for url, _ in cases):
+        from atproto import Client
+
+        from .label import PW, USERNAME
+
+        client = Client()
+        client.login(USERNAME, PW)
+        labeler.client = client
+        start = time.perf_counter()
+        fetched = extract_features(client, labeler, args.labeler, cases, cache)
+        print(f"Fetched and cached features of {fetched} posts in {time.perf_counter() - start:.1f}s")
+    records = cache.records(url for url, _ in cases)
+    cache.close()
+
+    start = time.perf_counter()
+    if args.labeler == "automated":
+        rows = sweep_automated(records, _frange(*args.thresh))
+        current = [row for row in rows if abs(row['thresh'] - THRESH) < 1e-9]
+    else:
+        rows = sweep_policy(records, range(args.hash_bits[0], args.hash_bits[1] + 1),
+                            range(args.intensity[0], args.intensity[1] + 1),
+                            hash_length=labeler.image_hasher.hash_length)
+        current = [row for row in rows if row['image_hash_threshold'] == labeler.image_hash_threshold
+                   and row['intensity_cutoff'] == 2]
+    elapsed = time.perf_counter() - start
+    print(f"Evaluated {len(rows)} grid points over {len(records)} posts in {elapsed * 1000:.1f} ms "
+          f"({elapsed * 1000 / max(len(rows), 1):.3f} ms per point)")
+
+    best = max(rows, key=lambda row: (row['f1'], row['precision']))
+    print(f"Best F1: {best}")
+    if current:
+        print(f"Current: {current[0]}")
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Precision/recall curve written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
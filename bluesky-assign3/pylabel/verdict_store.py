@@ -0,0 +1,155 @@
+"""Persistent store of labeler verdicts keyed by post and ruleset version
+
+Each labeler splits moderation into stages (text and image). The verdict of a stage is
+stored under the post URI together with the post CID and a content hash of the rules
+the stage used (keyword lists, thresholds, reference hashes). A stored verdict is reused
+only when both still match, so an edited post or a changed ruleset is re-moderated
+automatically. Because stages are versioned separately, editing a keyword list only
+re-runs the cheap text stage, and stored image verdicts stay valid.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    labeler TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    ruleset TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (labeler, uri, stage)
+)
+"""
+
+
+def ruleset_hash(*parts: Any) -> str:
+    """
+    Compute a stable content hash of the rules a moderation stage uses
+
+    Args:
+        parts: JSON-serializable values (lists are hashed in the order given, so callers
+            should sort unordered collections)
+
+    Returns:
+        Hex digest identifying the ruleset version
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class VerdictStore:
+    """
+    SQLite-backed store of per-stage verdicts
+
+    The connection is opened lazily per process, so a store created before the workers
+    of a ShardedSupervisor fork can be used by all of them.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        """
+        Args:
+            path: SQLite database file, or ':memory:' for a store that lasts one run
+        """
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            if self.path != ':memory:':
+                # Several worker processes may write to the same store
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def get(self, labeler: str, uri: str, cid: str, stage: str, ruleset: str) -> Optional[List[str]]:
+        """
+        Look up a stored verdict
+
+        Returns:
+            The stored labels, or None if there is no verdict for this CID and ruleset
+        """
+        row = self._connection().execute(
+            'SELECT labels FROM verdicts WHERE labeler = ? AND uri = ? AND stage = ? AND cid = ? AND ruleset = ?',
+            (labeler, uri, stage, cid, ruleset),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, labeler: str, uri: str, cid: str, stage: str, ruleset: str, labels: List[str]):
+        """Store a verdict, replacing any verdict for an older CID or ruleset"""
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO verdicts (labeler, uri, stage, cid, ruleset, labels, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (labeler, uri, stage, cid, ruleset, json.dumps(sorted(labels)), time.time()),
+        )
+        conn.commit()
+
+    def cached(self, labeler: str, post: Any, stage: str, ruleset: str,
+               compute: Callable[[], Tuple[List[str], bool]]) -> List[str]:
+        """
+        Return the stored verdict for a post's stage, computing and storing it on a miss
+
+        Args:
+            labeler: Name of the labeler
+            post: Post record with uri and cid attributes
+            stage: Moderation stage name
+            ruleset: Ruleset version of the stage
+            compute: Callable returning the stage's labels and whether the verdict is
+                complete; incomplete verdicts (e.g. an image failed to download) are
+                returned but not stored, so they are retried next time
+
+        Returns:
+            List of labels for the stage
+        """
+        labels = self.get(labeler, post.uri, post.cid, stage, ruleset)
+        if labels is None:
+            labels, complete = compute()
+            if complete:
+                self.put(labeler, post.uri, post.cid, stage, ruleset, labels)
+        return labels
+
+    def purge_stale(self, labeler: str, stage: str, ruleset: str) -> int:
+        """
+        Delete the verdicts of a stage that were produced by another ruleset version
+
+        Returns:
+            Number of verdicts deleted
+        """
+        conn = self._connection()
+        cursor = conn.execute(
+            'DELETE FROM verdicts WHERE labeler = ? AND stage = ? AND ruleset != ?',
+            (labeler, stage, ruleset),
+        )
+        conn.commit()
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        """Return hit and miss counts for this process"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+    def close(self):
+        """Close the database connection"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
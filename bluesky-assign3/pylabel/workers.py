@@ -0,0 +1,483 @@
+"""Sharded multi-process worker mode for the labelers
+
+A ShardedSupervisor runs N worker processes, each with its own task queue, and routes
+every post to a worker chosen by hashing the post author so any per-account state a
+labeler keeps stays local to one process. Each worker sends its results back through a
+pipe of its own, which the supervisor waits on together with the worker processes.
+
+The author is taken from the post URL, where an account may appear by DID or by handle.
+Handles are lowercased, and with a resolver such as handle_resolver(client) they are
+mapped to their DID, so both forms of an account land on the same shard. Without a
+resolver, or when a handle cannot be resolved, an account linked by handle and by DID can
+still be split across two shards.
+
+A worker that dies without finishing its queue (killed by the OOM killer, a segfault in
+an image library) never reports back. The supervisor watches the worker processes while
+it waits for results: a dead worker counts as finished, and every post it had been given
+but not answered is returned as an error result, so callers can retry it. Since no
+worker writes to another worker's pipe, one killed in the middle of sending a result
+cannot block the others.
+
+Workers are started with the "fork" start method after the labeler has been built in
+the parent. The compiled keyword matchers, term dictionaries and reference hash lists are
+therefore shared with every worker through copy-on-write pages instead of being rebuilt
+per worker. gc.freeze() is called before forking so the garbage collector does not touch
+(and thereby copy) those pages in the children.
+"""
+
+import gc
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from atproto import Client
+
+# Marker a worker puts on the result queue once it has drained its task queue
+_WORKER_DONE = "__worker_done__"
+
+
+def author_from_url(url: str) -> str:
+    """
+    Extract the author (DID or handle) from a Bluesky post URL
+
+    Args:
+        url: URL of the form https://bsky.app/profile/<author>/post/<rkey>
+
+    Returns:
+        The author segment of the URL
+    """
+    parts = url.rstrip("/").split("/")
+    return parts[-3]
+
+
+def author_key(author: str) -> str:
+    """Return the author of a post URL as a shard key: DIDs as they are, handles lowercased"""
+    return author if author.startswith("did:") else author.lower()
+
+
+def handle_resolver(client: "Client", max_handles: int = 100_000) -> Callable[[str], str]:
+    """
+    Build a resolver that maps the author of a post URL to the account's DID
+
+    Each handle is resolved once; the most recently used max_handles are kept. A handle
+    that cannot be resolved is keyed by its lowercased form.
+
+    Args:
+        client: Logged-in AT Protocol client
+        max_handles: Number of resolved handles kept
+
+    Returns:
+        Callable taking a DID or handle and returning a shard key
+    """
+    resolved: "OrderedDict[str, str]" = OrderedDict()
+    lock = threading.Lock()
+
+    def resolve(author: str) -> str:
+        key = author_key(author)
+        if key.startswith("did:"):
+            return key
+        with lock:
+            if key in resolved:
+                resolved.move_to_end(key)
+                return resolved[key]
+        try:
+            did = client.resolve_handle(key).did
+        except Exception as e:
+            print(f"Could not resolve handle {key}, sharding by the handle: {type(e).__name__}")
+            did = key
+        with lock:
+            resolved[key] = did
+            while len(resolved) > max_handles:
+                resolved.popitem(last=False)
+        return did
+
+    return resolve
+
+
+def shard_for(author: str, num_shards: int) -> int:
+    """
+    Map an author to a shard using a hash that is stable across processes and runs
+
+    Args:
+        author: DID or handle of the post author
+        num_shards: Number of shards (worker processes)
+
+    Returns:
+        Shard index in [0, num_shards)
+    """
+    return zlib.crc32(author.encode("utf-8")) % num_shards
+
+
+def session_client_factory(client: "Client") -> Callable[[], "Client"]:
+    """
+    Build a factory that gives each worker its own client sharing the parent's session
+
+    A forked child must not reuse the parent's HTTP connection pool, and logging in again
+    from every worker would run into the createSession rate limit, so the workers resume
+    the parent's exported session instead.
+
+    Args:
+        client: Logged-in AT Protocol client
+
+    Returns:
+        Callable that returns a fresh logged-in client
+    """
+    session_string = client.export_session_string()
+
+    base_url = getattr(client, "_base_url", None)
+
+    def factory() -> "Client":
+        from atproto import Client
+
+        # Talk to the same appview as the parent, e.g. the load generator's stand-in
+        worker_client = Client(base_url=base_url) if base_url else Client()
+        worker_client.login(session_string=session_string)
+        return worker_client
+
+    return factory
+
+
+def _worker_main(shard: int, labeler: Any, method: str, client_factory: Optional[Callable[[], "Client"]],
+                 report: Optional[Callable[[Any], Any]], tasks: Any, results: Any):
+    """Worker loop: moderate posts from the shard's task queue until a sentinel arrives"""
+    def send(url, result, error):
+        try:
+            results.send((url, result, error))
+        except Exception as e:
+            # The result could not be pickled; the supervisor still needs an answer
+            results.send((url, None, repr(e)))
+
+    # The supervisor owns shutdown; a Ctrl-C must not kill work that is already queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if client_factory is not None:
+        labeler.client = client_factory()
+    moderate = getattr(labeler, method)
+
+    while True:
+        url = tasks.get()
+        if url is None:
+            break
+        try:
+            result = moderate(url)
+        except Exception as e:
+            send(url, None, repr(e))
+        else:
+            send(url, result, None)
+
+    summary, error = None, None
+    if report is not None:
+        try:
+            summary = report(labeler)
+        except Exception as e:
+            error = repr(e)
+    results.send((_WORKER_DONE, summary, error))
+    results.close()
+
+
+class ShardedSupervisor:
+    """
+    Supervisor running a labeler across several worker processes
+
+    Usage:
+        supervisor = ShardedSupervisor(labeler, num_workers=8,
+                                       client_factory=session_client_factory(client),
+                                       report=lambda labeler: labeler.latency_budget.stats())
+        for url, labels, error in supervisor.map(urls):
+            ...
+        print(supervisor.reports)   # shard -> what report returned in that worker
+    """
+
+    def __init__(self, labeler: Any, num_workers: Optional[int] = None,
+                 client_factory: Optional[Callable[[], "Client"]] = None,
+                 queue_size: int = 256, method: str = "moderate_post", poll_interval: float = 1.0,
+                 resolve_author: Callable[[str], str] = author_key,
+                 report: Optional[Callable[[Any], Any]] = None):
+        """
+        Args:
+            labeler: Fully initialized labeler exposing moderate_post(url)
+            num_workers: Number of worker processes (defaults to the CPU count)
+            client_factory: Optional callable run in each worker to replace labeler.client
+            queue_size: Maximum number of pending posts per worker queue
+            method: Labeler method the workers call with each URL; its return value is
+                the result, e.g. "moderate_post_verdict" for a PostVerdict
+            poll_interval: Longest wait between checks for dead workers; the supervisor also
+                wakes as soon as a worker process exits
+            resolve_author: Maps the author in a post URL to its shard key, e.g.
+                handle_resolver(client) so an account's handle and DID share a shard
+            report: Optional callable run in each worker with its labeler once the
+                worker's queue is drained, e.g. to collect the stats of the labeler's
+                caches; its return values are kept in reports by shard
+        """
+        self.labeler = labeler
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.client_factory = client_factory
+        self.queue_size = queue_size
+        self.method = method
+        self.poll_interval = poll_interval
+        self.resolve_author = resolve_author
+        self.report = report
+        # Per shard: what report returned in the worker, or the error it raised
+        self.reports: Dict[int, Any] = {}
+        self.report_errors: Dict[int, str] = {}
+        self._ctx = mp.get_context("fork")
+        self._task_queues = []
+        # Per shard: receiving end of the worker's result pipe
+        self._result_conns: List[Any] = []
+        self._processes = []
+        self._running = 0
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        # Per shard: URLs given to the worker and not answered yet
+        self._in_flight: List[Counter] = []
+        self._finished: Set[int] = set()
+        # Results read from the pipes, and errors for posts of dead workers, not returned yet
+        self._ready: Deque[Tuple[str, Any, Optional[str]]] = deque()
+        self.submitted = 0
+        self.completed = 0
+        # (shard, exit code) of workers that died before finishing their queue
+        self.dead_workers: List[Tuple[int, Optional[int]]] = []
+
+    def start(self):
+        """Fork the worker processes"""
+        if self._processes:
+            raise RuntimeError("Supervisor already started")
+        self._stopping.clear()
+        self._in_flight = [Counter() for _ in range(self.num_workers)]
+        self._finished = set()
+        self._ready.clear()
+        self.reports = {}
+        self.report_errors = {}
+        # Move everything built so far out of the GC's reach so it is never written to
+        # (and copied) in the children
+        gc.collect()
+        gc.freeze()
+        try:
+            for shard in range(self.num_workers):
+                tasks = self._ctx.Queue(self.queue_size)
+                receiver, sender = self._ctx.Pipe(duplex=False)
+                process = self._ctx.Process(
+                    target=_worker_main,
+                    args=(shard, self.labeler, self.method, self.client_factory, self.report, tasks, sender),
+                    name=f"pylabel-worker-{shard}",
+                    daemon=True,
+                )
+                process.start()
+                # Closed before the next fork, so only this worker holds the sending end and
+                # the pipe reports end-of-file once it exits
+                sender.close()
+                self._task_queues.append(tasks)
+                self._result_conns.append(receiver)
+                self._processes.append(process)
+        finally:
+            gc.unfreeze()
+        self._running = self.num_workers
+
+    def submit(self, url: str, author: Optional[str] = None):
+        """
+        Queue a post on the worker owning its author; blocks while that worker's queue is full
+
+        Args:
+            url: URL of the post to moderate
+            author: Author DID or handle; parsed from the URL when omitted
+        """
+        shard = shard_for(self.resolve_author(author or author_from_url(url)), self.num_workers)
+        self.submitted += 1
+        with self._lock:
+            if shard in self._finished:
+                self._ready.append((url, None, f"Worker {shard} is no longer running"))
+                return
+            self._in_flight[shard][url] += 1
+        # If the worker died, the post stays in flight and _reap reports it as failed
+        self._put(shard, url)
+
+    def _put(self, shard: int, item: Optional[str]) -> bool:
+        """Put an item on a worker's queue, giving up if the worker died; return whether it was queued"""
+        while True:
+            try:
+                self._task_queues[shard].put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                if not self._processes[shard].is_alive():
+                    return False
+
+    def _handle(self, shard: int, url: str, result: Any, error: Optional[str]):
+        """Account for a message read from a worker's result pipe"""
+        if url == _WORKER_DONE:
+            if error is not None:
+                self.report_errors[shard] = error
+            elif self.report is not None:
+                self.reports[shard] = result
+            self._finished.add(shard)
+            self._running -= 1
+            return
+        with self._lock:
+            in_flight = self._in_flight[shard]
+            in_flight[url] -= 1
+            if in_flight[url] <= 0:
+                del in_flight[url]
+        self._ready.append((url, result, error))
+
+    def _read(self, shard: int) -> bool:
+        """Read one message from a worker's result pipe; return False once the pipe is closed"""
+        try:
+            message = self._result_conns[shard].recv()
+        except (EOFError, OSError):
+            return False
+        self._handle(shard, *message)
+        return True
+
+    def _reap(self):
+        """Treat workers that died without their sentinel as finished, failing their posts"""
+        for shard, process in enumerate(self._processes):
+            if shard in self._finished or process.is_alive():
+                continue
+            # Results the worker sent before it died are still in the pipe
+            conn = self._result_conns[shard]
+            while shard not in self._finished and conn.poll(0) and self._read(shard):
+                pass
+            if shard in self._finished:
+                continue
+            self._running -= 1
+            self.dead_workers.append((shard, process.exitcode))
+            error = f"Worker {shard} died with exit code {process.exitcode}"
+            with self._lock:
+                self._finished.add(shard)
+                lost, self._in_flight[shard] = self._in_flight[shard], Counter()
+            for url, count in lost.items():
+                self._ready.extend((url, None, error) for _ in range(count))
+            print(f"{error}; {sum(lost.values())} posts it held are reported as failed")
+
+    def _receive(self, timeout: float):
+        """Wait until a worker sends a result or exits, and read what is ready"""
+        live = [shard for shard in range(len(self._processes)) if shard not in self._finished]
+        conns = {self._result_conns[shard]: shard for shard in live}
+        sentinels = {self._processes[shard].sentinel: shard for shard in live}
+        ready = mp.connection.wait([*conns, *sentinels], timeout)
+        exited = not ready
+        for item in ready:
+            if item in sentinels:
+                exited = True
+            elif not self._read(conns[item]):
+                exited = True
+        if exited:
+            self._reap()
+
+    def get_result(self, timeout: Optional[float] = None) -> Optional[Tuple[str, Any, Optional[str]]]:
+        """
+        Wait for the next result from any worker
+
+        Posts held by a worker that died are returned as results with an error.
+
+        Returns:
+            Tuple of (url, labels, error), or None once every worker has drained or died
+
+        Raises:
+            queue.Empty: If no result arrived within the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._ready:
+                self.completed += 1
+                return self._ready.popleft()
+            if self._running <= 0:
+                return None
+            wait = self.poll_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                wait = min(wait, remaining)
+            self._receive(wait)
+
+    def drain(self) -> Iterator[Tuple[str, Any, Optional[str]]]:
+        """
+        Stop accepting work, let every worker finish its queue and yield the remaining results
+        """
+        for shard in range(len(self._task_queues)):
+            self._put(shard, None)
+        while True:
+            result = self.get_result()
+            if result is None:
+                break
+            yield result
+        self.join()
+
+    def join(self, timeout: Optional[float] = None):
+        """Wait for the worker processes to exit"""
+        for process in self._processes:
+            process.join(timeout)
+        for conn in self._result_conns:
+            conn.close()
+        self._task_queues = []
+        self._result_conns = []
+        self._processes = []
+
+    def terminate(self):
+        """Stop the workers immediately, discarding queued work"""
+        for process in self._processes:
+            process.terminate()
+        self.join()
+        self._running = 0
+
+    def map(self, urls: Iterable[str]) -> Iterator[Tuple[str, Any, Optional[str]]]:
+        """
+        Moderate every post in urls and yield (url, labels, error) as results arrive
+
+        Results are yielded in completion order, not input order. Submission runs on a
+        feeder thread so bounded worker queues cannot deadlock against result collection.
+        On Ctrl-C submission stops and the posts already queued are drained; a second
+        Ctrl-C terminates the workers.
+
+        Args:
+            urls: Iterable of post URLs
+
+        Returns:
+            Iterator over (url, labels, error) tuples
+        """
+        self.start()
+        feeder_error: List[BaseException] = []
+
+        def feed():
+            try:
+                for url in urls:
+                    if self._stopping.is_set():
+                        break
+                    self.submit(url)
+            except BaseException as e:
+                feeder_error.append(e)
+            finally:
+                for shard in range(len(self._task_queues)):
+                    self._put(shard, None)
+
+        feeder = threading.Thread(target=feed, name="pylabel-feeder", daemon=True)
+        feeder.start()
+        try:
+            try:
+                while True:
+                    result = self.get_result()
+                    if result is None:
+                        break
+                    yield result
+            except KeyboardInterrupt:
+                print("Interrupted: draining queued posts (Ctrl-C again to abort)")
+                self._stopping.set()
+                while True:
+                    result = self.get_result()
+                    if result is None:
+                        break
+                    yield result
+        except BaseException:
+            self.terminate()
+            raise
+        feeder.join()
+        self.join()
+        if feeder_error:
+            raise feeder_error[0]
@@ -3,51 +3,251 @@
 import argparse
 import json
 import os
+import time
+from collections import deque
 
-import pandas as pd
-from atproto import Client
 from dotenv import load_dotenv
 
-from pylabel import AutomatedLabeler, label_post, did_from_handle
+from pylabel import (AccountAggregator, AutomatedLabeler, EvaluationJournal, ImageCascade, LabelLedger,
+                     LatencyBudget, NegativeCache, Priority, PriorityScheduler, RiskClassifier,
+                     ShardedSupervisor, VerdictStore, account_labeler, author_from_url, compute_metrics,
+                     handle_resolver, iter_csv_records, label_post, make_client, maybe_profile,
+                     parse_account_rule, pending_cases, session_client_factory, set_cdn_url, sync_post_labels)
 
 load_dotenv(override=True)
 USERNAME = os.getenv("USERNAME")
 PW = os.getenv("PW")
 
+def moderate_serially(labeler, rows):
+    """
+    Moderate (url, row) pairs one at a time, yielding (url, row, PostVerdict, error, elapsed seconds)
+    """
+    for url, row in rows:
+        start = time.time()
+        try:
+            verdict = labeler.moderate_post_verdict(url)
+        except Exception as e:
+            yield url, row, None, repr(e), None
+            continue
+        yield url, row, verdict, None, time.time() - start
+
+def moderate_by_priority(labeler, rows, lookahead=1000):
+    """
+    Moderate (url, row) pairs in priority order (reported, repeat authors, images, the
+    rest), yielding (url, row, PostVerdict, error, elapsed seconds). Optional Reported and
+    HasImages columns of the input rows are used as hints; once a post is labeled, the
+    queued posts of its author move up to the repeat-author class.
+
+    Rows are read ahead only until lookahead posts are queued, so memory stays bounded
+    however long the input is; priorities apply within that window. A post the scheduler
+    sheds is yielded with an error, so it is reported and not journaled as done.
+    """
+    classifier = RiskClassifier()
+    shed = deque()
+    scheduler = PriorityScheduler(on_shed=shed.append)
+    rows = iter(rows)
+
+    def refill():
+        if scheduler.depth() >= lookahead:
+            return
+        for url, row in rows:
+            hints = {key: str(row.get(column, "")).lower() in ("1", "true", "yes")
+                     for key, column in (("reported", "Reported"), ("has_images", "HasImages"))}
+            scheduler.submit(url, classifier.priority(url, **hints), payload=row)
+            if scheduler.depth() >= lookahead:
+                return
+
+    def shed_tasks():
+        while shed:
+            task = shed.popleft()
+            yield task.url, task.payload, None, f"Shed by the scheduler ({task.priority.name.lower()} queue full)", None
+
+    refill()
+    yield from shed_tasks()
+    start = time.time()
+    # drain() takes the next post only after the loop body ran, so each refill is seen
+    for task, verdict, error in scheduler.drain(labeler.moderate_post_verdict):
+        if error is None and verdict.labels:
+            classifier.observe(task.url, verdict.labels)
+            author = author_from_url(task.url)
+            scheduler.promote(lambda queued: author_from_url(queued.url) == author, Priority.REPEAT_AUTHOR)
+        yield task.url, task.payload, verdict, error, time.time() - start if error is None else None
+        refill()
+        yield from shed_tasks()
+        start = time.time()
+    print(f"Scheduler: {scheduler.stats()}")
+
+def moderate_sharded(supervisor, rows):
+    """
+    Moderate (url, row) pairs across worker processes, yielding (url, row, PostVerdict,
+    error, None) in completion order. Only the rows of posts in flight are kept.
+    """
+    in_flight = {}
+
+    def submitted():
+        for url, row in rows:
+            in_flight.setdefault(url, []).append(row)
+            yield url
+
+    for url, verdict, error in supervisor.map(submitted()):
+        pending = in_flight[url]
+        row = pending.pop(0)
+        if not pending:
+            del in_flight[url]
+        yield url, row, verdict, error, None
+
+def labeler_report(labeler):
+    """
+    Return the stats of the labeler's stores, caches and budget by name, and the URLs of its
+    degraded posts; run in each worker with --workers
+    """
+    components = (("Verdict store", labeler.verdict_store), ("Account aggregator", labeler.account_aggregator),
+                  ("Image cascade", labeler.cascade), ("Negative cache", labeler.negative_cache),
+                  ("Latency budget", labeler.latency_budget))
+    stats = {name: component.stats() for name, component in components if component is not None}
+    degraded_urls = list(labeler.latency_budget.degraded_urls) if labeler.latency_budget is not None else []
+    return stats, degraded_urls
+
 def main():
     """
     Main function for the test script
     """
-    client = Client()
-    labeler_client = None
-    client.login(USERNAME, PW)
-    did = did_from_handle(USERNAME)
-
     parser = argparse.ArgumentParser()
     parser.add_argument("labeler_inputs_dir", type=str)
     parser.add_argument("input_urls", type=str)
     parser.add_argument("--emit_labels", action="store_true")
+    parser.add_argument("--label_ledger", type=str,
+                        help="SQLite ledger of applied labels; only label changes are emitted")
+    parser.add_argument("--seed_ledger", action="store_true",
+                        help="Rebuild the ledger from the labeler's existing label events first")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes; posts are sharded by author")
+    parser.add_argument("--verdict_db", type=str,
+                        help="SQLite verdict store; unchanged posts are not re-moderated")
+    parser.add_argument("--journal", type=str,
+                        help="JSONL file each result is appended to; rerun with the same file to resume")
+    parser.add_argument("--account_rule", action="append", default=[],
+                        help="Label accounts by their post verdicts: post_label:account_label:min_posts[:min_ratio]")
+    parser.add_argument("--latency_budget", type=float,
+                        help="Seconds allowed per post; image checks that do not fit are skipped (degraded)")
+    parser.add_argument("--degraded_file", type=str,
+                        help="File the URLs of degraded posts are written to, for a later recheck")
+    parser.add_argument("--negative_cache", type=str, metavar="FILE",
+                        help="SQLite file remembering deleted or forbidden posts and failed image blobs, skipped until they expire")
+    parser.add_argument("--cascade_margin", type=float,
+                        help="Screen images by their thumbnail; fetch the fullsize image only within this distance of a match")
+    parser.add_argument("--prioritize", action="store_true",
+                        help="Moderate reported posts, repeat authors and posts with images first")
+    parser.add_argument("--profile", type=str, metavar="PREFIX",
+                        help="Profile the run, writing PREFIX.collapsed (flamegraph input) and PREFIX.txt")
+    parser.add_argument("--profile_mode", choices=["sampling", "deterministic"], default="sampling",
+                        help="sampling: low overhead, hot functions by sample count; deterministic: cProfile, "
+                             "exact call times in PREFIX.txt. PREFIX.collapsed is sampled, with stage labels, in both")
+    parser.add_argument("--profile_allocations", action="store_true",
+                        help="Also report the top allocation sites (tracemalloc; slows the run down)")
+    parser.add_argument("--appview_url", type=str,
+                        help="XRPC base URL to fetch posts from (default: APPVIEW_URL or bsky.social)")
+    parser.add_argument("--cdn_url", type=str, help="Image CDN base URL (default: CDN_URL or cdn.bsky.app)")
     args = parser.parse_args()
+    if args.prioritize and args.workers > 1:
+        parser.error("--prioritize orders posts within one process; it cannot be combined with --workers")
 
+    if args.cdn_url:
+        set_cdn_url(args.cdn_url)
+    client = make_client(args.appview_url)
+    labeler_client = None
+    client.login(USERNAME, PW)
+    did = client.me.did
+    if args.profile and args.workers > 1:
+        print("Profiling covers the supervisor process only; use --workers 1 to profile moderation")
+
+    ledger = None
     if args.emit_labels:
         labeler_client = client.with_proxy("atproto_labeler", did)
+        if args.label_ledger:
+            ledger = LabelLedger(args.label_ledger)
+            if args.seed_ledger:
+                print(f"Seeded label ledger from {ledger.seed_from_events(labeler_client)} label events")
+
+    # Aggregate post verdicts per account; accounts are only labeled with --emit_labels.
+    # With --workers each worker aggregates the accounts of its own shard.
+    aggregator = None
+    if args.account_rule:
+        aggregator = AccountAggregator([parse_account_rule(rule) for rule in args.account_rule],
+                                       on_threshold=account_labeler(labeler_client, ledger,
+                                                                    dry_run=not args.emit_labels))
 
-    labeler = AutomatedLabeler(client, args.labeler_inputs_dir)
+    verdict_store = VerdictStore(args.verdict_db) if args.verdict_db else None
+    latency_budget = LatencyBudget(args.latency_budget) if args.latency_budget else None
+    negative_cache = NegativeCache(args.negative_cache) if args.negative_cache else None
+    cascade = ImageCascade(args.cascade_margin) if args.cascade_margin is not None else None
+    labeler = AutomatedLabeler(client, args.labeler_inputs_dir, verdict_store=verdict_store,
+                               account_aggregator=aggregator, latency_budget=latency_budget,
+                               negative_cache=negative_cache, cascade=cascade)
 
-    urls = pd.read_csv(args.input_urls)
-    num_correct, total = 0, urls.shape[0]
-    for _index, row in urls.iterrows():
-        url, expected_labels = row["URL"], json.loads(row["Labels"])
-        labels = labeler.moderate_post(url)
-        if sorted(labels) == sorted(expected_labels):
-            num_correct += 1
+    with maybe_profile(args.profile, args.profile_mode, args.profile_allocations), EvaluationJournal(args.journal) as journal:
+        # Rows are streamed from the CSV; each carries its expected labels along
+        rows = pending_cases(((row["URL"], row) for row in iter_csv_records(args.input_urls)), journal)
+        if args.prioritize:
+            verdicts = moderate_by_priority(labeler, rows)
+        elif args.workers > 1:
+            session_factory = session_client_factory(client)
+
+            def worker_client():
+                # Runs in each worker: account labels must go out through the worker's own
+                # connection pool, not the labeler client forked from this process
+                worker_client = session_factory()
+                if aggregator is not None and labeler_client is not None:
+                    aggregator.on_threshold = account_labeler(worker_client.with_proxy("atproto_labeler", did),
+                                                              ledger, dry_run=not args.emit_labels)
+                return worker_client
+
+            supervisor = ShardedSupervisor(labeler, num_workers=args.workers, client_factory=worker_client,
+                                           method="moderate_post_verdict", resolve_author=handle_resolver(client),
+                                           report=labeler_report)
+            verdicts = moderate_sharded(supervisor, rows)
         else:
-            print(f"For {url}, labeler produced {labels}, expected {expected_labels}")
-        if args.emit_labels and (len(labels) > 0):
-            label_post(client, labeler_client, url, labels)
+            verdicts = moderate_serially(labeler, rows)
+        for url, row, verdict, error, elapsed in verdicts:
+            expected_labels = json.loads(row["Labels"])
+            if error is not None:
+                # Not journaled, so the post is retried when the run is resumed
+                print(f"For {url}, labeler failed: {error}")
+                continue
+            labels = verdict.labels
+            record = journal.append(url, expected_labels, labels, elapsed, verdict.degraded)
+            if verdict.degraded:
+                # Journaled but left pending, so the images are checked when the run is resumed
+                print(f"For {url}, only the text was checked within the latency budget")
+            elif not record["success"]:
+                print(f"For {url}, labeler produced {labels}, expected {expected_labels}")
+            # The verdict carries the post's URI and CID, so the post is not fetched again
+            if ledger is not None:
+                # A text-only verdict would negate image labels; it is synced after the recheck
+                if not verdict.degraded:
+                    sync_post_labels(client, labeler_client, url, labels, ledger,
+                                     managed=labeler.label_values, post=verdict)
+            elif args.emit_labels and (len(labels) > 0):
+                label_post(client, labeler_client, url, labels, post=verdict)
+        metrics = compute_metrics(journal.iter_records())
+    num_correct, total = metrics["correct"], metrics["total"]
     print(f"The labeler produced {num_correct} correct labels assignments out of {total}")
-    print(f"Overall ratio of correct label assignments {num_correct/total}")
-
+    print(f"Overall ratio of correct label assignments {metrics['accuracy']}")
+    if metrics["degraded"]:
+        print(f"{metrics['degraded']} degraded verdicts were not scored; rerun with the same --journal to recheck them")
+    if ledger is not None:
+        print(f"Label ledger: {ledger.stats()}")
+    # With --workers, every worker reports the stats of its own shard
+    reports = {None: labeler_report(labeler)} if args.workers <= 1 else supervisor.reports
+    for shard, (stats, _) in sorted(reports.items(), key=lambda item: item[0] or 0):
+        suffix = f" (worker {shard})" if shard is not None else ""
+        for name, component_stats in stats.items():
+            print(f"{name}{suffix}: {component_stats}")
+    if args.workers > 1 and len(reports) < args.workers:
+        print(f"Stats of {args.workers - len(reports)} workers are missing: {supervisor.report_errors or 'the workers died'}")
+    if args.degraded_file and latency_budget is not None:
+        with open(args.degraded_file, 'w') as f:
+            f.writelines(f"{url}\n" for _, degraded_urls in reports.values() for url in degraded_urls)
 
 if __name__ == "__main__":
     main()
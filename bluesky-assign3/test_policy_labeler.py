@@ -4,10 +4,12 @@ import argparse
 import os
 import json
 
-from atproto import Client
 from dotenv import load_dotenv
 
-from pylabel import PolicyProposalLabeler
+from pylabel import (AccountAggregator, EvaluationJournal, ImageCascade, LatencyBudget,
+                     NearDuplicateIndex, NegativeCache, PolicyProposalLabeler, VerdictStore,
+                     account_labeler, iter_json_records, make_client, maybe_profile,
+                     parse_account_rule, set_cdn_url)
 
 load_dotenv(override=True)
 USERNAME = os.getenv("USERNAME")
@@ -17,35 +19,82 @@ def main():
     """
     Main function for the test script
     """
-    client = Client()
-    client.login(USERNAME, PW)
-
     parser = argparse.ArgumentParser()
     parser.add_argument("labeler_inputs_dir", type=str, help="Directory containing input files")
     parser.add_argument("test_urls_file", type=str, help="JSON file with test URLs and expected labels")
     parser.add_argument("--emit_labels", action="store_true", help="Whether to emit labels to Bluesky")
     parser.add_argument("--output_file", type=str, help="Output file for detailed results")
+    parser.add_argument("--verdict_db", type=str,
+                        help="SQLite verdict store; unchanged posts are not re-moderated")
+    parser.add_argument("--journal", type=str,
+                        help="JSONL file each result is appended to; rerun with the same file to resume")
+    parser.add_argument("--account_rule", action="append", default=[],
+                        help="Label accounts by their post verdicts: post_label:account_label:min_posts[:min_ratio]")
+    parser.add_argument("--near_duplicate_similarity", type=float,
+                        help="Reuse text verdicts for texts at least this similar (MinHash Jaccard, 0-1)")
+    parser.add_argument("--latency_budget", type=float,
+                        help="Seconds allowed per post; image checks that do not fit are skipped (degraded)")
+    parser.add_argument("--degraded_file", type=str,
+                        help="File the URLs of degraded posts are written to, for a later recheck")
+    parser.add_argument("--negative_cache", type=str, metavar="FILE",
+                        help="SQLite file remembering deleted or forbidden posts and failed image blobs, skipped until they expire")
+    parser.add_argument("--cascade_margin", type=float,
+                        help="Screen images by their thumbnail; fetch the fullsize image only within this distance of a match")
+    parser.add_argument("--profile", type=str, metavar="PREFIX",
+                        help="Profile the run, writing PREFIX.collapsed (flamegraph input) and PREFIX.txt")
+    parser.add_argument("--profile_mode", choices=["sampling", "deterministic"], default="sampling",
+                        help="sampling: low overhead, hot functions by sample count; deterministic: cProfile, "
+                             "exact call times in PREFIX.txt. PREFIX.collapsed is sampled, with stage labels, in both")
+    parser.add_argument("--profile_allocations", action="store_true",
+                        help="Also report the top allocation sites (tracemalloc; slows the run down)")
+    parser.add_argument("--appview_url", type=str,
+                        help="XRPC base URL to fetch posts from (default: APPVIEW_URL or bsky.social)")
+    parser.add_argument("--cdn_url", type=str, help="Image CDN base URL (default: CDN_URL or cdn.bsky.app)")
     args = parser.parse_args()
 
+    if args.cdn_url:
+        set_cdn_url(args.cdn_url)
+    client = make_client(args.appview_url)
+    client.login(USERNAME, PW)
+
+    # Aggregate post verdicts per account; accounts are only labeled with --emit_labels
+    aggregator = None
+    if args.account_rule:
+        labeler_client = client.with_proxy("atproto_labeler", client.me.did) if args.emit_labels else None
+        aggregator = AccountAggregator([parse_account_rule(rule) for rule in args.account_rule],
+                                       on_threshold=account_labeler(labeler_client, dry_run=not args.emit_labels))
+
     # Create the labeler
-    labeler = PolicyProposalLabeler(client, args.labeler_inputs_dir)
+    verdict_store = VerdictStore(args.verdict_db) if args.verdict_db else None
+    text_index = None
+    if args.near_duplicate_similarity is not None:
+        text_index = NearDuplicateIndex(min_similarity=args.near_duplicate_similarity)
+    latency_budget = LatencyBudget(args.latency_budget) if args.latency_budget else None
+    negative_cache = NegativeCache(args.negative_cache) if args.negative_cache else None
+    cascade = ImageCascade(args.cascade_margin) if args.cascade_margin is not None else None
+    labeler = PolicyProposalLabeler(client, args.labeler_inputs_dir, verdict_store=verdict_store,
+                                    account_aggregator=aggregator, text_index=text_index,
+                                    latency_budget=latency_budget, negative_cache=negative_cache,
+                                    cascade=cascade)
     
-    # Load test data
-    with open(args.test_urls_file, 'r') as f:
-        test_posts = json.load(f)
+    # Stream test data (JSON list or JSON Lines) so large evaluations run in constant memory
+    test_posts = iter_json_records(args.test_urls_file)
     
     # Run tests and get metrics
-    print(f"Testing on {len(test_posts)} posts...")
-    metrics = labeler.test_labeler(test_posts)
+    print(f"Testing on posts from {args.test_urls_file}...")
+    with maybe_profile(args.profile, args.profile_mode, args.profile_allocations), EvaluationJournal(args.journal) as journal:
+        metrics = labeler.test_labeler(test_posts, journal=journal,
+                                       include_results=bool(args.output_file))
     
     # Report results
-    results = metrics["results"]
-    success_count = sum(1 for success in results.values() if success)
-    total = len(results)
+    success_count = metrics["correct"]
+    total = metrics["total"]
     
     print(f"\nTEST RESULTS:")
     print(f"The labeler produced {success_count} correct label assignments out of {total}")
     print(f"Overall accuracy: {metrics['accuracy']:.2f}")
+    if metrics["degraded"]:
+        print(f"{metrics['degraded']} degraded verdicts were not scored; rerun with the same --journal to recheck them")
     
     print(f"\nCLASSIFICATION METRICS:")
     print(f"Precision: {metrics['precision']:.2f}")
@@ -66,6 +115,22 @@ def main():
     print(f"Minimum processing time: {perf['min_processing_time']:.4f} seconds")
     print(f"Standard deviation: {perf['std_processing_time']:.4f} seconds")
     
+    if verdict_store is not None:
+        print(f"\nVERDICT STORE: {verdict_store.stats()}")
+    if aggregator is not None:
+        print(f"\nACCOUNT AGGREGATOR: {aggregator.stats()}")
+    if text_index is not None:
+        print(f"\nNEAR-DUPLICATE TEXT REUSE: {text_index.stats()}")
+    if cascade is not None:
+        print(f"\nIMAGE CASCADE: {cascade.stats()}")
+    if negative_cache is not None:
+        print(f"\nNEGATIVE CACHE: {negative_cache.stats()}")
+    if latency_budget is not None:
+        print(f"\nLATENCY BUDGET: {latency_budget.stats()}")
+        if args.degraded_file:
+            with open(args.degraded_file, 'w') as f:
+                f.writelines(f"{url}\n" for url in latency_budget.degraded_urls)
+    
     # Optionally save metrics to a file
     if hasattr(args, 'output_file') and args.output_file:
         with open(args.output_file, 'w') as f: